@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""Synthetic telemetry and benchmarks for the hook, ingest and dashboard paths.
+
+`cubicle bench` builds a scratch ~/.cubicle in a temporary directory, loads a
+seeded stream of Claude, Codex and agy events into it the way `cubicle ingest
+flush` does, runs the real hook scripts against the result and times every
+dashboard_queries query. The report is JSON, so runs on two commits
+can be compared with compare() (`cubicle bench --compare BASELINE`).
+"""
+import inspect
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import db
+from payload import RawPayload
+
+PACKAGE_ROOT = Path(__file__).parent
+DEFAULT_CONFIG = PACKAGE_ROOT / "default_config.yaml"
+HOOK_SCRIPTS = {"claude": "claude_hook.py", "codex": "codex_hook.py", "agy": "agy_hook.py"}
+INSERT_BATCH = 1000
+
+# Relative weights of the generated mix; the first entries are the common ones
+AGENT_WEIGHTS = {"claude": 6, "codex": 3, "agy": 1}
+MODELS = {
+    "claude": (["claude-opus", "claude-sonnet", "claude-haiku"], [5, 4, 1]),
+    "codex": (["gpt-codex", "gpt"], [3, 1]),
+    "agy": (["gemini-pro", "gemini-flash"], [2, 1]),
+}
+TOOLS = (["Bash", "Read", "Edit", "Grep", "Write", "Glob", "WebFetch"], [30, 30, 15, 10, 6, 6, 3])
+REPO_COUNT = 40
+FILES_PER_REPO = 60
+# Share of tool responses that are large (a whole file or long command output)
+LARGE_RESPONSE_RATE = 0.05
+LARGE_RESPONSE_WORDS = (8_000, 80_000)
+WORDS = [
+    "def", "class", "return", "import", "self", "value", "error", "path",
+    "file", "test", "config", "session", "event", "insert", "select", "where", "index",
+    "table", "commit", "query", "cache", "lock", "retry", "payload", "hook", "agent", "model",
+    "tool", "prompt", "result", "status", "true", "false", "none", "list", "dict", "json",
+    "yaml", "sqlite", "wal", "thread", "process", "socket", "buffer", "spool", "shard", "blob",
+    "codec", "page", "offset", "limit", "batch",
+]
+
+# ---------------------------------------------------------------------------
+# GENERATOR
+# ---------------------------------------------------------------------------
+
+def _words(rng, count):
+    return " ".join(rng.choices(WORDS, k=count))
+
+
+def _file_content(repo, path):
+    # The same file reads the same every time, so repeated reads share a blob
+    rng = random.Random(f"{repo}/{path}")
+    return _words(rng, rng.randint(50, 3_000))
+
+
+def _tool_call(rng, repo, cwd):
+    """(tool_name, tool_input, tool_response) for one tool call."""
+    tool = rng.choices(*TOOLS)[0]
+    path = f"{cwd}/src/module_{rng.randrange(FILES_PER_REPO)}.py"
+    if tool == "Read":
+        return tool, {"file_path": path}, {"content": _file_content(repo, path)}
+    if tool in ("Edit", "Write"):
+        change = _words(rng, rng.randint(5, 200))
+        return tool, {"file_path": path, "old_string": _words(rng, 10), "new_string": change}, {"ok": True}
+    if rng.random() < LARGE_RESPONSE_RATE:
+        output = _words(rng, rng.randint(*LARGE_RESPONSE_WORDS))
+    else:
+        output = _words(rng, rng.randint(5, 300))
+    return tool, {"command": _words(rng, rng.randint(2, 12))}, {"stdout": output, "exit_code": 0}
+
+
+def _session(rng, agent, session_id, started):
+    """Yields (cli_event, payload, timestamp) for one session, in order.
+
+    Each payload has the shape its agent's hook receives: Claude and Codex
+    name the event in hook_event_name, agy passes it as an argument.
+    """
+    models, weights = MODELS[agent]
+    model = rng.choices(models, weights)[0]
+    # Repos follow a long tail: a few see most of the sessions
+    repo = f"repo_{min(int(rng.paretovariate(1.2)) - 1, REPO_COUNT - 1)}"
+    cwd = f"/home/dev/src/{repo}"
+    clock = started
+
+    def event(native, **fields):
+        nonlocal clock
+        clock += timedelta(seconds=rng.expovariate(1 / 20))
+        timestamp = clock.strftime("%Y-%m-%d %H:%M:%S")
+        if agent == "agy":
+            return native, {"conversationId": session_id, "modelName": model, "cwd": cwd, **fields}, timestamp
+        payload = {"session_id": session_id, "hook_event_name": native, "cwd": cwd, **fields}
+        if agent == "codex" or native == "SessionStart":
+            payload["model"] = model
+        return None, payload, timestamp
+
+    # agy has no session lifecycle events; its turns start with a model invocation
+    prompt = "PreInvocation" if agent == "agy" else "UserPromptSubmit"
+    if agent != "agy":
+        yield event("SessionStart", source="startup")
+    for _ in range(rng.randint(1, 12)):
+        yield event(prompt, prompt=_words(rng, rng.randint(5, 120)))
+        # Tool calls come in bursts of very different lengths
+        for _ in range(int(rng.expovariate(1 / 6))):
+            tool, tool_input, tool_response = _tool_call(rng, repo, cwd)
+            yield event("PreToolUse", tool_name=tool, tool_input=tool_input)
+            yield event("PostToolUse", tool_name=tool, tool_input=tool_input, tool_response=tool_response)
+        yield event("Stop", last_assistant_message=_words(rng, rng.randint(10, 400)))
+    if agent != "agy":
+        yield event("SessionEnd", reason="exit")
+
+
+def generate(count, seed=0, days=30, end=None):
+    """Yields count synthetic hook events as (agent, cli_event, body, timestamp), oldest first.
+
+    body is the raw stdin the agent's hook would receive. Sessions start at
+    random times over the days before end (now by default). The same seed
+    always yields the same events for the same end.
+    """
+    rng = random.Random(seed)
+    end = end or datetime.now(timezone.utc).replace(microsecond=0)
+    span = timedelta(days=days).total_seconds()
+    # Enough session start times for count events, spread evenly on average
+    starts = sorted(rng.uniform(0, span) for _ in range(max(1, count // 60)))
+    produced = 0
+    for number, offset in enumerate(starts):
+        agent = rng.choices(list(AGENT_WEIGHTS), list(AGENT_WEIGHTS.values()))[0]
+        started = end - timedelta(seconds=span - offset)
+        session_id = f"bench-{seed}-{number:08d}"
+        for cli_event, payload, timestamp in _session(rng, agent, session_id, started):
+            yield agent, cli_event, json.dumps(payload).encode(), timestamp
+            produced += 1
+            if produced == count:
+                return
+    # Rarely the sessions run short of count; top up with more recent ones
+    if produced < count:
+        yield from generate(count - produced, seed + 1, 1, end)
+
+
+# ---------------------------------------------------------------------------
+# BENCHMARKS
+# ---------------------------------------------------------------------------
+
+def percentiles(samples):
+    """p50/p95/p99/max of samples in seconds, as milliseconds."""
+    ordered = sorted(samples)
+
+    def rank(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {"p50_ms": rank(0.50), "p95_ms": rank(0.95), "p99_ms": rank(0.99), "max_ms": rank(1.0)}
+
+
+def _scratch_home(workdir):
+    """Points db at a fresh ~/.cubicle under workdir and returns the parsed config."""
+    import yaml
+
+    config_dir = Path(workdir) / ".cubicle"
+    (config_dir / "data").mkdir(parents=True)
+    shutil.copy2(DEFAULT_CONFIG, config_dir / "config.yaml")
+    db.DB_PATH = config_dir / "data" / "telemetry.db"
+    with open(DEFAULT_CONFIG) as f:
+        return yaml.safe_load(f)
+
+
+def bench_ingest(events, cfg):
+    """Normalizes and inserts events in batched transactions, as a spool flush does."""
+    from ingestd import load_event_mappings, load_hook_modules
+
+    hooks = load_hook_modules()
+    mappings = load_event_mappings(hooks, cfg)
+    storage = cfg.get("storage")
+    loaded = 0
+    started = time.perf_counter()
+    with closing(db.connect()) as conn:
+        batch = []
+        for agent, cli_event, body, timestamp in events:
+            record = hooks[agent].build_record(RawPayload(body), cli_event, mappings[agent], conn)
+            batch.append({**record, "timestamp": timestamp})
+            if len(batch) == INSERT_BATCH:
+                with conn:
+                    db.insert_many(batch, conn, storage)
+                loaded += len(batch)
+                batch = []
+        with conn:
+            db.insert_many(batch, conn, storage)
+        loaded += len(batch)
+    seconds = time.perf_counter() - started
+    return {"events": loaded, "seconds": round(seconds, 3), "events_per_second": round(loaded / seconds)}
+
+
+def bench_hooks(events, home):
+    """Runs each event through its agent's hook script in a fresh process, as the agent would."""
+    env = {key: value for key, value in os.environ.items() if key != db.FAMILY_ENV}
+    env["HOME"] = str(home)
+    samples = []
+    for agent, cli_event, body, _ in events:
+        command = [sys.executable, str(PACKAGE_ROOT / HOOK_SCRIPTS[agent])] + ([cli_event] if cli_event else [])
+        started = time.perf_counter()
+        subprocess.run(command, input=body, env=env, capture_output=True, check=False)
+        samples.append(time.perf_counter() - started)
+    return {"calls": len(samples), **percentiles(samples)} if samples else {"calls": 0}
+
+
+def _query_args():
+    """Arguments for the queries that need them, taken from the busiest session."""
+    with closing(db.connect()) as conn:
+        session_id, = conn.execute("SELECT session_id FROM sessions ORDER BY event_count DESC LIMIT 1").fetchone()
+        event_id, = conn.execute(
+            "SELECT id FROM telemetry WHERE session_id = ? ORDER BY tool_name IS NULL, id DESC LIMIT 1",
+            (session_id,),
+        ).fetchone()
+    return {
+        "get_session": (session_id,),
+        "get_session_timeline": (session_id,),
+        "get_event_payload": (event_id,),
+        "search_events": ("commit",),
+    }
+
+
+def bench_queries(repeats):
+    """Times every dashboard_queries query: the first (cold) call and the median of repeats."""
+    import dashboard_queries
+
+    dashboard_queries.configure()
+    args = _query_args()
+    results = {}
+    for name, query in sorted(dashboard_queries.QUERIES.items()):
+        if name not in args and any(
+            param.default is param.empty for param in inspect.signature(query).parameters.values()
+        ):
+            raise ValueError(f"bench has no arguments for dashboard_queries.{name}")
+        timings = []
+        for _ in range(max(1, repeats)):
+            started = time.perf_counter()
+            result = query(*args.get(name, ()))
+            timings.append(time.perf_counter() - started)
+        results[name] = {
+            "cold_ms": round(timings[0] * 1000, 2),
+            "median_ms": round(statistics.median(timings) * 1000, 2),
+            "rows": dashboard_queries.result_rows(result),
+        }
+    dashboard_queries.configure()  # closes the pooled connections
+    return results
+
+
+def _revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=PACKAGE_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _database_bytes():
+    return sum(path.stat().st_size for path in db.DB_PATH.parent.glob(f"{db.DB_PATH.stem}*"))
+
+
+def run(events=20_000, seed=0, days=30, hook_calls=50, repeats=5):
+    """Runs every benchmark against a scratch database and returns the report."""
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+    original_path = db.DB_PATH
+    with tempfile.TemporaryDirectory(prefix="cubicle-bench-") as home:
+        try:
+            cfg = _scratch_home(home)
+            ingest = bench_ingest(generate(events, seed, days, end), cfg)
+            database_bytes = _database_bytes()
+            queries = bench_queries(repeats)
+            # Hook calls add events of their own, so they run last
+            hooks = bench_hooks(generate(hook_calls, seed + 1, 1, end), home)
+        finally:
+            db.DB_PATH = original_path
+    return {
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "seed": seed,
+        "ingest": ingest,
+        "database_bytes": database_bytes,
+        "hooks": hooks,
+        "queries": queries,
+    }
+
+
+def _flatten(report, prefix=""):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(baseline, current, tolerance=0.2):
+    """Compares the timing and size metrics of two reports.
+
+    Returns (metric, baseline value, current value, regressed) rows. A metric
+    regresses when it is worse than the baseline by more than tolerance (a
+    fraction): slower, larger, or for ingest throughput, lower.
+    """
+    before = dict(_flatten(baseline))
+    rows = []
+    for metric, value in _flatten(current):
+        if metric not in before or not metric.endswith(("_ms", "_bytes", "_per_second")):
+            continue
+        old = before[metric]
+        if metric.endswith("_per_second"):
+            worse = value < old * (1 - tolerance)
+        else:
+            worse = value > old * (1 + tolerance)
+        rows.append((metric, old, value, worse))
+    return rows
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
@@ -1,4 +1,5 @@
 import argparse
+import importlib
 import json
 import os
 import re
@@ -6,6 +7,7 @@ import shutil
 import signal
 import subprocess
 import sys
+import time
 from pathlib import Path
 
 import yaml
@@ -35,6 +37,7 @@ LLM_WRAPPERS = {
 ENV_VAR_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
 DASHBOARD_PID_FILE = CUBICLE_HOME / "data" / "dashboard.pid"
 DEFAULT_DASHBOARD_PORT = 8501
+INGESTD_PID_FILE = CUBICLE_HOME / "data" / "ingestd.pid"
 
 def die(message):
     print(f"Error: {message}", file=sys.stderr)
@@ -400,6 +403,15 @@ AGENT_HOOKS = {
     "agy": "agy_hook.py",
     "copilot": "claude_hook.py",  # copilot uses same model-resolution pattern as claude
 }
+# Modules the installed hook scripts import from ~/.cubicle/hooks
+HOOK_RUNTIME_MODULES = ["db.py", "ingestd.py", "payload.py", "spool.py", "timings.py"]
+
+
+def _hook_runtime(module_name):
+    """Imports a hook runtime module (db, spool, ...) by the flat name the installed hooks use."""
+    if str(PACKAGE_ROOT) not in sys.path:
+        sys.path.insert(0, str(PACKAGE_ROOT))
+    return importlib.import_module(module_name)
 
 
 def _ensure_resources():
@@ -408,10 +420,16 @@ def _ensure_resources():
 
     for hook_file in set(AGENT_HOOKS.values()):
         ensure_copy(PACKAGE_ROOT / hook_file, HOOKS_INSTALL_DIR / hook_file)
-    ensure_copy(PACKAGE_ROOT / "db.py", HOOKS_INSTALL_DIR / "db.py")
+    for module_file in HOOK_RUNTIME_MODULES:
+        ensure_copy(PACKAGE_ROOT / module_file, HOOKS_INSTALL_DIR / module_file)
     shutil.copy2(DEFAULT_CONFIG, CUBICLE_CONFIG)
     print(f"Synced event config to {CUBICLE_CONFIG}")
 
+    db = _hook_runtime("db")
+    db.init_db()
+    print(f"Database schema at version {db.SCHEMA_VERSION} ({db.DB_PATH})")
+
+
 def init_hooks(agent=None):
     _ensure_resources()
 
@@ -503,6 +521,196 @@ def stop_dashboard():
         print("Dashboard was not running (stale PID removed).")
 
 
+def start_ingestd(foreground=False):
+    (CUBICLE_HOME / "data").mkdir(parents=True, exist_ok=True)
+    ingestd_script = PACKAGE_ROOT / "ingestd.py"
+
+    if foreground:
+        os.execv(sys.executable, [sys.executable, str(ingestd_script)])
+
+    if INGESTD_PID_FILE.exists():
+        pid = int(INGESTD_PID_FILE.read_text().strip())
+        try:
+            os.kill(pid, 0)
+            print(f"ingestd already running (PID {pid})")
+            return
+        except OSError:
+            INGESTD_PID_FILE.unlink()
+
+    log_path = CUBICLE_HOME / "data" / "ingestd.log"
+    with open(log_path, "a") as log:
+        proc = subprocess.Popen(
+            [sys.executable, str(ingestd_script)],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    INGESTD_PID_FILE.write_text(str(proc.pid))
+    print(f"ingestd started (PID {proc.pid})")
+    print(f"Logs: {log_path}")
+
+
+def stop_ingestd():
+    if not INGESTD_PID_FILE.exists():
+        print("No ingestd running.")
+        return
+    pid = int(INGESTD_PID_FILE.read_text().strip())
+    try:
+        os.kill(pid, signal.SIGTERM)
+        INGESTD_PID_FILE.unlink()
+        print(f"ingestd stopped (PID {pid})")
+    except OSError:
+        INGESTD_PID_FILE.unlink()
+        print("ingestd was not running (stale PID removed).")
+
+
+def flush_spool(watch=None):
+    spool = _hook_runtime("spool")
+
+    if watch:
+        try:
+            spool.watch(watch)
+        except KeyboardInterrupt:
+            pass
+        return
+    print(f"Loaded {spool.flush()} spooled events")
+
+
+def show_db_health():
+    db = _hook_runtime("db")
+    report = db.health()
+
+    print(f"Database: {db.DB_PATH}")
+    if "journal_mode" in report:
+        print(f"  journal mode:   {report['journal_mode']}")
+        print(f"  schema version: {report['schema_version']}")
+        print(f"  size:           {report['db_bytes']:,} bytes (+ {report['wal_bytes']:,} WAL)")
+    else:
+        print("  (not created yet)")
+    print(f"Write contention ({report['log']}):")
+    for kind, count in report["counts"].items():
+        last = report["last"].get(kind)
+        suffix = f" (last {last['ts']}: {last.get('error') or last.get('event')})" if last else ""
+        print(f"  {kind}: {count}{suffix}")
+
+
+def retain_events(convert_vacuum=False):
+    db = _hook_runtime("db")
+    if not db.DB_PATH.exists():
+        print("No telemetry recorded yet")
+        return
+
+    retention = load_config().get("retention") or {}
+    conn = db.connect()
+    try:
+        report = db.retain(
+            conn,
+            strip_after_days=retention.get("strip_after_days"),
+            drop_after_days=retention.get("drop_after_days"),
+            convert_vacuum=convert_vacuum,
+        )
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        conn.close()
+    print(f"Stripped payloads of {report['stripped']:,} events, dropped {report['dropped']:,} events")
+    print(f"Freed {report['freed_pages'] * page_size:,} bytes")
+    if report["unvacuumed"]:
+        print(f"Free pages in {', '.join(report['unvacuumed'])} were kept: the database predates incremental "
+              "vacuum. Run `cubicle db retain --convert-vacuum` once, while no agents are running, to switch it.")
+
+
+def search_events(terms, limit):
+    db = _hook_runtime("db")
+    if not db.DB_PATH.exists():
+        print("No telemetry recorded yet")
+        return
+
+    conn = db.connect()
+    try:
+        hits = db.search(conn, " ".join(terms), limit)
+    finally:
+        conn.close()
+    if not hits:
+        print("No matching events")
+        return
+    for _, session_id, timestamp, event_type, tool_name, snippet in hits:
+        print(f"{timestamp}  {session_id}  {event_type}{f' ({tool_name})' if tool_name else ''}")
+        print(f"    {' '.join(snippet.split())}")
+
+
+def export_telemetry(dest, fmt, payloads, full, chunk_rows):
+    db = _hook_runtime("db")
+    if not db.DB_PATH.exists():
+        print("No telemetry recorded yet")
+        return
+
+    export = _hook_runtime("export")
+    try:
+        report = export.export(dest, fmt=fmt, payloads=payloads, full=full, chunk_rows=chunk_rows)
+    except (RuntimeError, ValueError) as e:
+        die(str(e))
+    print(f"Exported {report['events']:,} new events to {report['files']:,} files under {dest}")
+    for table, rows in report["tables"].items():
+        print(f"  {table}: {rows:,} rows")
+
+
+def _print_percentiles(title, rows):
+    print(title)
+    print(f"  {'':<20} {'calls':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for name, stats in rows.items():
+        print(
+            f"  {name:<20} {stats['calls']:>7,} {stats['p50']:>9.1f} {stats['p95']:>9.1f} "
+            f"{stats['p99']:>9.1f} {stats['max']:>9.1f}"
+        )
+
+
+def show_hook_stats(hours):
+    timings = _hook_runtime("timings")
+    records = list(timings.read_log(since=time.time() - hours * 3600))
+    if not records:
+        print(f"No hook timings in the last {hours:g} hours. Set {timings.ENV}=1 in the agents' "
+              f"environment (cubicle set-env {timings.ENV} 1) to record them.")
+        return
+
+    summary = timings.summarize(records)
+    _print_percentiles(f"Hook phases over the last {hours:g} hours, in milliseconds:", summary["phases"])
+    for key in ("agent", "event", "path"):
+        print()
+        _print_percentiles(f"Total by {key}:", summary[key])
+
+
+def run_bench(events, seed, hook_calls, repeats, output=None, baseline=None, tolerance=0.2):
+    bench = _hook_runtime("bench")
+    report = bench.run(events=events, seed=seed, hook_calls=hook_calls, repeats=repeats)
+    text = json.dumps(report, indent=2)
+    if output:
+        Path(output).write_text(text + "\n")
+        print(f"Wrote {output}")
+    else:
+        print(text)
+    if baseline is None:
+        return
+
+    rows = bench.compare(json.loads(Path(baseline).read_text()), report, tolerance)
+    regressions = [row for row in rows if row[3]]
+    width = max((len(row[0]) for row in rows), default=0)
+    for metric, before, after, regressed in rows:
+        change = f"{(after - before) / before:+.0%}" if before else "n/a"
+        print(f"{metric:<{width}}  {before:>12,}  {after:>12,}  {change:>6}{'  REGRESSED' if regressed else ''}")
+    if regressions:
+        die(f"{len(regressions)} metrics regressed by more than {tolerance:.0%} against {baseline}")
+
+
+def run_stress(agents, rate, duration, mode, daemon, hold_lock_ms, seed):
+    stress = _hook_runtime("stress")
+    report = stress.run(
+        agents=agents, rate=rate, duration=duration, mode=mode, daemon=daemon, hold_lock_ms=hold_lock_ms, seed=seed
+    )
+    print(json.dumps(report, indent=2))
+    if report["lost"] or report["duplicates"]:
+        die(f"{report['lost']} of {report['sent']} events lost, {report['duplicates']} stored twice")
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
@@ -595,6 +803,182 @@ Examples:
         description="Sends SIGTERM to the dashboard process and removes the PID file."
     )
 
+    # Ingest daemon commands
+    ingestd_parser = subparsers.add_parser(
+        "ingestd",
+        help="Start the hook ingest daemon in the background",
+        description="Runs a long-lived process that hooks forward events to over a Unix socket, "
+                    "so each tool call costs a socket write instead of a SQLite insert. "
+                    "Hooks fall back to inserting directly when it is not running."
+    )
+    ingestd_parser.add_argument(
+        "--foreground",
+        action="store_true",
+        help="Run in the foreground instead of detaching (for launchd/systemd)"
+    )
+
+    subparsers.add_parser(
+        "ingestd-stop",
+        help="Stop the background ingest daemon",
+        description="Sends SIGTERM to the ingest daemon and removes the PID file."
+    )
+
+    ingest_parser = subparsers.add_parser(
+        "ingest",
+        help="Manage spooled hook events",
+        description="Commands for the append-only spool used when config.yaml sets ingest.mode: spool."
+    )
+    ingest_subparsers = ingest_parser.add_subparsers(dest="ingest_command", required=True)
+    flush_parser = ingest_subparsers.add_parser(
+        "flush",
+        help="Load spooled events into telemetry.db",
+        description="Bulk loads every file under ~/.cubicle/data/spool/ in one transaction per file "
+                    "and removes what was committed."
+    )
+    flush_parser.add_argument(
+        "--watch",
+        type=float,
+        metavar="SECONDS",
+        help="Keep running and flush every SECONDS"
+    )
+
+    db_parser = subparsers.add_parser(
+        "db",
+        help="Inspect and maintain telemetry.db",
+        description="Maintenance commands for ~/.cubicle/data/telemetry.db."
+    )
+    db_subparsers = db_parser.add_subparsers(dest="db_command", required=True)
+    db_subparsers.add_parser(
+        "health",
+        help="Show journaling state and how many events were retried or dropped",
+        description="Reports the journal mode, schema version and size of the database, plus the "
+                    "writes that needed retries or were dropped under lock contention."
+    )
+    retain_parser = db_subparsers.add_parser(
+        "retain",
+        help="Expire old events as configured under retention: in config.yaml",
+        description="Strips the payloads of events older than retention.strip_after_days, deletes "
+                    "events older than retention.drop_after_days and returns the freed space to the "
+                    "filesystem in small incremental vacuum steps. Session totals and the Overview "
+                    "charts keep their history."
+    )
+    retain_parser.add_argument(
+        "--convert-vacuum",
+        action="store_true",
+        help="Switch a database created before incremental vacuum with one full VACUUM. It rewrites "
+             "the whole file and blocks hooks meanwhile, so run it while no agents are running"
+    )
+
+    search_parser = subparsers.add_parser(
+        "search",
+        help="Full-text search over recorded prompts, tool calls and replies",
+        description="Searches the full-text index of prompts, tool inputs and outputs and assistant "
+                    "messages. Every word must match; the last one also matches as a prefix."
+    )
+    search_parser.add_argument("terms", nargs="+", help="Words to search for")
+    search_parser.add_argument(
+        "--limit",
+        type=int,
+        default=20,
+        help="Maximum number of matches to show (default: 20)"
+    )
+
+    export_parser = subparsers.add_parser(
+        "export",
+        help="Export telemetry to partitioned Parquet or Arrow files for notebooks",
+        description="Streams telemetry (main database and monthly shards) into DEST/telemetry, "
+                    "partitioned by date and agent family, in bounded chunks, and rewrites the "
+                    "sessions, event_rollup and event_types tables next to it. Later runs only add "
+                    "the events recorded since the last export. Needs pyarrow."
+    )
+    export_parser.add_argument("dest", help="Directory to export to")
+    export_parser.add_argument(
+        "--format", choices=["parquet", "arrow"], default="parquet", help="File format (default: parquet)"
+    )
+    export_parser.add_argument(
+        "--payloads", action="store_true", help="Include each event's full payload JSON as a payload column"
+    )
+    export_parser.add_argument(
+        "--full", action="store_true", help="Discard an earlier export in DEST and start from the first event"
+    )
+    export_parser.add_argument(
+        "--chunk-rows", type=int, default=50_000, help="Events read per chunk (default: 50000)"
+    )
+
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark hooks, ingest and dashboard queries on synthetic telemetry",
+        description="Loads a seeded stream of synthetic Claude, Codex and agy events into a scratch "
+                    "database, then reports insert throughput, database size, hook latency "
+                    "percentiles and the time of every dashboard query as JSON. Your own "
+                    "~/.cubicle is not touched."
+    )
+    bench_parser.add_argument(
+        "--events", type=int, default=20_000, help="Synthetic events to load (default: 20000)"
+    )
+    bench_parser.add_argument("--seed", type=int, default=0, help="Generator seed (default: 0)")
+    bench_parser.add_argument(
+        "--hook-calls", type=int, default=50, help="Hook processes to time (default: 50)"
+    )
+    bench_parser.add_argument(
+        "--repeats", type=int, default=5, help="Runs of each dashboard query (default: 5)"
+    )
+    bench_parser.add_argument("--output", help="Write the JSON report to this file")
+    bench_parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="Compare with an earlier report and exit non-zero if a metric regressed"
+    )
+    bench_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown before a metric counts as regressed, as a fraction (default: 0.2)"
+    )
+
+    stress_parser = subparsers.add_parser(
+        "stress",
+        help="Fire hooks from many concurrent agents and count the events that were lost",
+        description="Runs the real hook scripts from several simulated agents at once against a "
+                    "scratch database, each event tagged with a sequence number, and reports "
+                    "delivered, lost and duplicated events, hook and write latency under contention "
+                    "(including time blocked on the write lock) and the writes retried past the busy "
+                    "timeout. Exits non-zero if any event was lost."
+    )
+    stress_parser.add_argument("--agents", type=int, default=6, help="Concurrent agents (default: 6)")
+    stress_parser.add_argument(
+        "--rate", type=float, default=60, help="Target hook events per second, all agents together (default: 60)"
+    )
+    stress_parser.add_argument("--duration", type=float, default=10, help="Seconds to run (default: 10)")
+    stress_parser.add_argument(
+        "--mode", choices=["direct", "spool"], default="direct", help="Ingest mode to test (default: direct)"
+    )
+    stress_parser.add_argument("--daemon", action="store_true", help="Run ingestd for the hooks to forward to")
+    stress_parser.add_argument(
+        "--hold-lock-ms",
+        type=int,
+        default=0,
+        help="Also hold the write lock this long every second, like a long migration or retain"
+    )
+    stress_parser.add_argument("--seed", type=int, default=0, help="Generator seed (default: 0)")
+
+    stats_parser = subparsers.add_parser(
+        "stats",
+        help="Report recorded performance statistics",
+        description="Summaries of the timings Cubicle records about itself."
+    )
+    stats_subparsers = stats_parser.add_subparsers(dest="stats_command", required=True)
+    hook_stats_parser = stats_subparsers.add_parser(
+        "hooks",
+        help="Hook latency percentiles per phase, agent, event and ingest path",
+        description="Summarizes the per-phase timings hooks record when CUBICLE_HOOK_TIMINGS=1 is set "
+                    "in the agents' environment: interpreter startup, imports, config loading, model "
+                    "lookup, connecting and writing, with p50/p95/p99 for each."
+    )
+    hook_stats_parser.add_argument(
+        "--hours", type=float, default=24, help="Only include hook runs from the last HOURS (default: 24)"
+    )
+
     # Help command
     subparsers.add_parser("help", help="Show this help message")
 
@@ -622,6 +1006,30 @@ Examples:
         start_dashboard(port=args.port)
     elif args.command == "dashboard-stop":
         stop_dashboard()
+    elif args.command == "ingestd":
+        start_ingestd(foreground=args.foreground)
+    elif args.command == "ingestd-stop":
+        stop_ingestd()
+    elif args.command == "ingest":
+        flush_spool(watch=args.watch)
+    elif args.command == "db":
+        if args.db_command == "retain":
+            retain_events(convert_vacuum=args.convert_vacuum)
+        else:
+            show_db_health()
+    elif args.command == "search":
+        search_events(args.terms, args.limit)
+    elif args.command == "export":
+        export_telemetry(args.dest, args.format, args.payloads, args.full, args.chunk_rows)
+    elif args.command == "stats":
+        show_hook_stats(args.hours)
+    elif args.command == "stress":
+        run_stress(args.agents, args.rate, args.duration, args.mode, args.daemon, args.hold_lock_ms, args.seed)
+    elif args.command == "bench":
+        run_bench(
+            args.events, args.seed, args.hook_calls, args.repeats,
+            output=args.output, baseline=args.compare, tolerance=args.tolerance,
+        )
     elif args.command == "help":
         parser.print_help()
     else:
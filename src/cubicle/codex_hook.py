@@ -3,39 +3,67 @@ import sys
 import json
 from pathlib import Path
 
-import yaml
-
 sys.path.insert(0, str(Path(__file__).parent))
-from db import insert_telemetry
+import timings  # first, so the imports phase covers the modules below
+
+# isort: split
+import spool
+from db import agent_family, insert_telemetry
+from ingestd import forward
+from payload import RawPayload
+
+AGENT = "codex"
+
 
+def _load_config():
+    with timings.phase("yaml"):
+        import yaml
 
-def _load_event_mapping():
     config_path = Path.home() / ".cubicle" / "config.yaml"
-    with open(config_path) as f:
-        cfg = yaml.safe_load(f)
-    return cfg["agents"]["codex"]["event_mapping"]
+    with timings.phase("config"), open(config_path) as f:
+        return yaml.safe_load(f)
+
+
+def build_record(payload, cli_event, event_mapping, conn=None):
+    """Normalizes a Codex hook payload into insert_telemetry() arguments."""
+    native_event = payload.get("hook_event_name") or payload.get("event")
+    normalized_event = event_mapping.get(
+        native_event, native_event.lower() if native_event else "unknown"
+    )
+    return {
+        "session_id": payload.get("session_id"),
+        "event_type": normalized_event,
+        "model": payload.get("model"),
+        "raw_payload": payload,
+        "agent": agent_family(AGENT),
+    }
 
 
 def main():
+    timings.begin()
     try:
-        input_data = sys.stdin.read()
-        if not input_data:
+        # Raw bytes are forwarded and stored as-is; only the routing fields get decoded
+        with timings.phase("read"):
+            body = sys.stdin.buffer.read()
+        if not body:
             return
 
-        payload = json.loads(input_data)
-
-        native_event = payload.get("hook_event_name") or payload.get("event")
-        event_mapping = _load_event_mapping()
-        normalized_event = event_mapping.get(
-            native_event, native_event.lower() if native_event else "unknown"
-        )
-
-        insert_telemetry(
-            session_id=payload.get("session_id"),
-            event_type=normalized_event,
-            model=payload.get("model"),
-            raw_payload=payload,
-        )
+        timings.note(agent=agent_family(AGENT), event=None, body=body, bytes=len(body), path="forward")
+        with timings.phase("forward"):
+            delivered, ingest_key = forward(AGENT, None, body)
+        if not delivered:
+            cfg = _load_config()
+            if spool.enabled(cfg):
+                timings.note(path="spool")
+                with timings.phase("spool"):
+                    spool.append(AGENT, None, body, ingest_key)
+            else:
+                timings.note(path="direct")
+                with timings.phase("parse"):
+                    payload = RawPayload(body)
+                event_mapping = cfg["agents"][AGENT]["event_mapping"]
+                record = build_record(payload, None, event_mapping)
+                insert_telemetry(**record, ingest_key=ingest_key, storage=cfg.get("storage"))
 
         print(json.dumps({}))
 
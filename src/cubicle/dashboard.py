@@ -1,3 +1,4 @@
+import sqlite3
 import sys
 from pathlib import Path
 
@@ -7,16 +8,10 @@ import plotly.graph_objects as go
 import streamlit as st
 
 sys.path.insert(0, str(Path(__file__).parent))
-from dashboard_queries import (
-    get_daily_sessions,
-    get_model_distribution,
-    get_repo_distribution,
-    get_session_events,
-    get_sessions,
-    get_summary_stats,
-    get_tool_usage,
-    get_usage_heatmap,
-)
+import dashboard_queries
+import spool
+from dashboard_queries import data_version
+from ingestd import load_config
 
 st.set_page_config(
     page_title="Cubicle Agent Dashboard",
@@ -25,8 +20,65 @@ st.set_page_config(
 )
 
 
-page = st.sidebar.radio("Navigate", ["Overview", "Sessions"], label_visibility="collapsed")
+# ---------------------------------------------------------------------------
+# QUERY CACHE
+# ---------------------------------------------------------------------------
+
+@st.cache_resource
+def _configure_reads():
+    """Sets up dashboard_queries' connection pool once per dashboard process."""
+    try:
+        cfg = load_config() or {}
+    except FileNotFoundError:
+        cfg = {}
+    dashboard_queries.configure(cfg.get("dashboard"))
+
+
+_configure_reads()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _cached_query(name, version, *args):
+    return getattr(dashboard_queries, name)(*args)
+
+
+def query(name, *args):
+    """Runs dashboard_queries.<name>(*args), reusing the result until new events arrive."""
+    return _cached_query(name, data_version(), *args)
+
+
+def session_query(name, session_id, *args):
+    """Like query(), but only invalidated by new events in this session."""
+    return _cached_query(name, data_version(session_id), session_id, *args)
+
+
+def load_timeline(session_id, event_types=None):
+    """Returns the timeline pages loaded so far and whether more remain."""
+    pages = []
+    after = None
+    page_size = dashboard_queries.TIMELINE_PAGE_SIZE
+    for _ in range(st.session_state.get(_pages_key(session_id, event_types), 1)):
+        page = session_query("get_session_timeline", session_id, after, page_size, event_types)
+        pages.append(page)
+        if len(page) < page_size:
+            return pd.concat(pages, ignore_index=True), False
+        after = (page["timestamp"].iloc[-1], int(page["id"].iloc[-1]))
+    return pd.concat(pages, ignore_index=True), True
+
+
+def _pages_key(session_id, event_types):
+    return f"timeline_pages:{session_id}:{event_types}"
+
+
+def load_more(session_id, event_types):
+    key = _pages_key(session_id, event_types)
+    st.session_state[key] = st.session_state.get(key, 1) + 1
+
+
+page = st.sidebar.radio("Navigate", ["Overview", "Sessions", "Diagnostics"], label_visibility="collapsed")
 st.sidebar.markdown("---")
+if st.sidebar.button("Flush spool", help="Load events spooled by hooks in ingest.mode: spool"):
+    st.sidebar.caption(f"Loaded {spool.flush()} spooled events")
 st.sidebar.caption("Cubicle Telemetry Dashboard")
 
 
@@ -35,7 +87,7 @@ st.sidebar.caption("Cubicle Telemetry Dashboard")
 # ---------------------------------------------------------------------------
 
 def render_overview():
-    stats = get_summary_stats()
+    stats = query("get_summary_stats")
 
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Total Sessions", f"{stats['total_sessions']:,}")
@@ -47,7 +99,7 @@ def render_overview():
 
     # Daily activity
     st.subheader("Daily Activity (last 30 days)")
-    daily = get_daily_sessions(days=30)
+    daily = query("get_daily_sessions", 30)
     if not daily.empty:
         fig = px.bar(
             daily,
@@ -69,7 +121,7 @@ def render_overview():
     # Model/agent mix
     with col_left:
         st.subheader("Model Mix (by sessions)")
-        model_dist = get_model_distribution()
+        model_dist = query("get_model_distribution")
         if not model_dist.empty:
             fig = px.pie(
                 model_dist,
@@ -89,7 +141,7 @@ def render_overview():
     # Top repos
     with col_right:
         st.subheader("Top Repos by Tool Calls")
-        repos = get_repo_distribution()
+        repos = query("get_repo_distribution")
         if not repos.empty:
             fig = px.bar(
                 repos.sort_values("tool_calls"),
@@ -109,7 +161,7 @@ def render_overview():
     # Tool usage
     with col_tools:
         st.subheader("Top Tools Used")
-        tools = get_tool_usage()
+        tools = query("get_tool_usage")
         if not tools.empty:
             fig = px.bar(
                 tools.head(15).sort_values("count"),
@@ -125,7 +177,7 @@ def render_overview():
     # Usage heatmap
     with col_heat:
         st.subheader("Usage Heatmap (day × hour)")
-        heatmap_df = get_usage_heatmap()
+        heatmap_df = query("get_usage_heatmap")
         if not heatmap_df.empty:
             day_names = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
             heatmap_df["day_name"] = heatmap_df["dow"].map(lambda d: day_names[d])
@@ -155,28 +207,47 @@ def render_overview():
 def render_sessions():
     st.title("Sessions")
 
-    sessions = get_sessions()
-    if sessions.empty:
-        st.info("No sessions found.")
+    search_text = st.text_input(
+        "Search", placeholder="Search prompts, tool calls and replies", label_visibility="collapsed"
+    )
+    if search_text.strip():
+        render_search(search_text)
         return
 
     # Filter controls
-    col_f1, col_f2, col_f3 = st.columns(3)
+    col_f1, col_f2, col_f3, col_f4 = st.columns(4)
     with col_f1:
-        models = ["All"] + sorted(sessions["model"].dropna().unique().tolist())
+        models = ["All"] + query("get_session_models")
         selected_model = st.selectbox("Model", models)
     with col_f2:
-        repos = ["All"] + sorted(sessions["repo"].unique().tolist())
+        repos = ["All"] + query("get_session_repos")
         selected_repo = st.selectbox("Repo", repos)
     with col_f3:
         min_tools = st.number_input("Min tool calls", min_value=0, value=0)
-
-    filtered = sessions.copy()
-    if selected_model != "All":
-        filtered = filtered[filtered["model"] == selected_model]
-    if selected_repo != "All":
-        filtered = filtered[filtered["repo"] == selected_repo]
-    filtered = filtered[filtered["tool_count"] >= min_tools]
+    with col_f4:
+        sort = st.selectbox("Sort by", list(dashboard_queries.SESSION_SORT_KEYS))
+
+    filters = (
+        None if selected_model == "All" else selected_model,
+        None if selected_repo == "All" else selected_repo,
+        int(min_tools),
+        sort,
+    )
+    # Back to the first page whenever the filters change
+    if st.session_state.get("session_filters") != filters:
+        st.session_state["session_filters"] = filters
+        st.session_state["session_page"] = 1
+
+    page_size = dashboard_queries.SESSIONS_PAGE_SIZE
+    page_number = st.session_state.get("session_page", 1)
+    filtered, total = query("query_sessions", *filters, True, page_number - 1, page_size)
+    if total == 0:
+        st.info("No sessions found.")
+        return
+    page_count = (total + page_size - 1) // page_size
+    if page_number > page_count:
+        st.session_state["session_page"] = page_number = page_count
+        filtered, total = query("query_sessions", *filters, True, page_number - 1, page_size)
 
     # Table columns
     display_cols = ["session_short", "model", "repo", "start_time", "duration_min", "tool_count", "prompt_count", "permission_count"]
@@ -191,7 +262,11 @@ def render_sessions():
         "permission_count": "Permissions",
     })
 
-    st.caption(f"{len(filtered)} sessions")
+    col_count, col_page = st.columns([3, 1])
+    col_count.caption(f"{total:,} sessions — page {page_number} of {page_count}")
+    col_page.number_input(
+        "Page", min_value=1, max_value=page_count, key="session_page", label_visibility="collapsed"
+    )
     selection = st.dataframe(
         display,
         hide_index=True,
@@ -203,63 +278,210 @@ def render_sessions():
     # Session drill-down
     selected_rows = selection.selection.rows if selection and selection.selection else []
     if selected_rows:
-        idx = selected_rows[0]
-        session_row = filtered.iloc[idx]
-        session_id = session_row["session_id"]
+        render_session_detail(filtered.iloc[selected_rows[0]]["session_id"])
 
-        st.markdown("---")
-        st.subheader(f"Session: {session_id}")
 
-        m1, m2, m3, m4 = st.columns(4)
-        m1.metric("Model", session_row["model"] or "Unknown")
-        m2.metric("Repo", session_row["repo"])
-        m3.metric("Duration", f"{session_row['duration_min']} min")
-        m4.metric("Tool Calls", int(session_row["tool_count"]))
+def open_session(session_id):
+    st.session_state["opened_session"] = session_id
 
-        st.markdown("**Event Timeline**")
-        events = get_session_events(session_id)
 
-        if events.empty:
-            st.info("No events found for this session.")
-            return
+def render_search(text):
+    """Ranked full-text hits, each opening its session below."""
+    hits = query("search_events", text)
+    if hits.empty:
+        st.info("No matching events.")
+        return
+
+    st.caption(f"{len(hits)} best matches")
+    for hit in hits.itertuples():
+        tool = hit.tool_name if isinstance(hit.tool_name, str) else ""
+        col_hit, col_open = st.columns([6, 1])
+        snippet = " ".join(hit.snippet.split())
+        col_hit.markdown(f"`{hit.session_id[:8]}` {hit.timestamp} · **{hit.event_type}** {tool}  \n{snippet}")
+        col_open.button("Open session", key=f"search_hit:{hit.id}", on_click=open_session, args=(hit.session_id,))
+
+    opened = st.session_state.get("opened_session")
+    if opened in set(hits["session_id"]):
+        render_session_detail(opened)
+
+
+def render_session_detail(session_id):
+    session_row = session_query("get_session", session_id)
+    if session_row is None:
+        return
+
+    st.markdown("---")
+    st.subheader(f"Session: {session_id}")
+
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("Model", session_row["model"] or "Unknown")
+    m2.metric("Repo", session_row["repo"])
+    m3.metric("Duration", f"{session_row['duration_min']} min")
+    m4.metric("Tool Calls", int(session_row["tool_count"]))
+
+    tab_timeline, tab_chat = st.tabs(["Event Timeline", "Conversation"])
+    with tab_timeline:
+        render_timeline(session_id)
+    with tab_chat:
+        render_conversation(session_id)
+
+
+# Timeline filters: "jump" to one kind of event by listing only those
+TIMELINE_VIEWS = {
+    "All events": None,
+    "Prompts": ("user_prompt_submit",),
+    "Tool calls": ("pre_tool_use",),
+    "Errors & permissions": (
+        "post_tool_use_failure", "permission_request", "permission_denied", "notification",
+    ),
+}
+CONVERSATION_EVENTS = ("user_prompt_submit", "turn_complete", "stop")
+
+
+def render_timeline(session_id):
+    """One virtualized table for the whole timeline; details load for the selected row only."""
+    view = st.radio("Show", list(TIMELINE_VIEWS), horizontal=True, key=f"timeline_view:{session_id}")
+    event_types = TIMELINE_VIEWS[view]
+    events, has_more = load_timeline(session_id, event_types)
+    if events.empty:
+        st.info("No events found for this session.")
+        return
+
+    summary = events[["prompt_text", "assistant_message", "tool_input", "tool_response", "notification_msg"]]
+    table = pd.DataFrame({
+        "Time": events["timestamp"],
+        "Event": events["event_type"],
+        "Tool": events["tool_name"],
+        "Summary": summary.bfill(axis=1).iloc[:, 0].str.slice(0, 200).mask(
+            events["unparseable"].astype(bool), "(unparseable payload)"
+        ),
+    })
+    picked = st.dataframe(
+        table,
+        hide_index=True,
+        use_container_width=True,
+        height=420,
+        on_select="rerun",
+        selection_mode="single-row",
+        key=f"timeline:{session_id}:{view}",
+    )
+    st.caption(f"{len(events):,} events loaded")
+    if has_more:
+        st.button("Load more events", on_click=load_more, args=(session_id, event_types))
+
+    rows = picked.selection.rows if picked and picked.selection else []
+    if rows:
+        ev = events.iloc[rows[0]]
+        tool = ev["tool_name"] if pd.notna(ev["tool_name"]) else ""
+        st.markdown(f"**{ev['event_type']}** {tool}  `{ev['timestamp']}`")
+        st.json(dashboard_queries.get_event_payload(int(ev["id"])))
+
+
+def render_conversation(session_id):
+    """Chat-style view of the prompt/assistant turns only."""
+    turns, has_more = load_timeline(session_id, CONVERSATION_EVENTS)
+    if turns.empty:
+        st.info("No prompts recorded for this session.")
+        return
 
-        for _, ev in events.iterrows():
-            norm = ev["norm_event"]
+    for _, ev in turns.iterrows():
+        if pd.notna(ev["prompt_text"]):
+            with st.chat_message("user"):
+                st.write(ev["prompt_text"])
+                st.caption(ev["timestamp"])
+        elif pd.notna(ev["assistant_message"]):
+            with st.chat_message("assistant"):
+                st.write(ev["assistant_message"])
+                st.caption(ev["timestamp"])
 
-            if norm == "userpromptsubmit" and ev["prompt_text"]:
-                with st.chat_message("user"):
-                    st.write(ev["prompt_text"])
-                    st.caption(ev["timestamp"])
+    if has_more:
+        st.button("Load more turns", on_click=load_more, args=(session_id, CONVERSATION_EVENTS))
 
-            elif norm in ("turncomplete", "stop") and ev["assistant_message"]:
-                with st.chat_message("assistant"):
-                    st.write(ev["assistant_message"])
-                    st.caption(ev["timestamp"])
 
-            elif norm == "pretooluse" and ev["tool_name"]:
-                with st.expander(f"🔧 {ev['tool_name']}  —  {ev['timestamp']}", expanded=False):
-                    if ev["tool_input"]:
-                        st.code(ev["tool_input"], language="json")
+# ---------------------------------------------------------------------------
+# DIAGNOSTICS PAGE
+# ---------------------------------------------------------------------------
+
+# The Overview page's queries and arguments, for profiling them uncached
+OVERVIEW_QUERIES = [
+    ("get_summary_stats", ()),
+    ("get_daily_sessions", (30,)),
+    ("get_model_distribution", ()),
+    ("get_repo_distribution", ()),
+    ("get_tool_usage", ()),
+    ("get_usage_heatmap", ()),
+]
 
-            elif norm == "posttooluse" and ev["tool_response"]:
-                with st.expander(f"↩ {ev['tool_name'] or 'tool'} response  —  {ev['timestamp']}", expanded=False):
-                    st.text(ev["tool_response"])
 
-            elif norm in ("notification", "permissionrequest") and ev["notification_msg"]:
-                st.info(f"**{ev['event_type']}**: {ev['notification_msg']}  `{ev['timestamp']}`")
+def _calls_table(calls):
+    return pd.DataFrame(calls, columns=["query", "args", "ms", "rows", "vm_steps"])
 
-            elif norm == "session_start":
-                st.success(f"Session started  `{ev['timestamp']}`  cwd: `{ev['cwd'] or ''}`")
 
-            elif norm in ("agent_stop", "session_end", "sessionend"):
-                st.warning(f"Session ended  `{ev['timestamp']}`")
+def render_plans(calls):
+    """EXPLAIN QUERY PLAN for each distinct query statement the calls ran."""
+    statements = dict.fromkeys(
+        sql.strip() for call in calls for sql in call["statements"]
+        if sql.lstrip().upper().startswith(("SELECT", "WITH"))
+    )
+    for sql in statements:
+        try:
+            plan = dashboard_queries.explain(sql)
+        except sqlite3.Error as e:
+            st.caption(f"Could not plan a statement: {e}")
+            continue
+        scans = plan["full_scan"].sum()
+        label = " ".join(sql.split())
+        with st.expander(("⚠️ " if scans else "") + (label[:100] + " …" if len(label) > 100 else label)):
+            if scans:
+                st.warning(f"{scans} full table scan(s)")
+            st.code(sql, language="sql")
+            st.dataframe(plan, use_container_width=True, hide_index=True)
+
+
+def render_diagnostics():
+    st.subheader("Queries")
+    last_page, calls = st.session_state.get("last_queries", (None, []))
+    st.caption(
+        f"Timings of the last {last_page or 'Overview or Sessions'} page render. Cached results do not run a query, so only "
+        "queries whose data changed since the last render appear here. "
+        f"vm_steps counts SQLite VM instructions in steps of {dashboard_queries.PROGRESS_STEPS}, "
+        "a stand-in for the rows a query had to read."
+    )
+    if st.button("Profile Overview queries", help="Run every Overview query now, bypassing the cache"):
+        with dashboard_queries.collect() as calls:
+            for name, args in OVERVIEW_QUERIES:
+                getattr(dashboard_queries, name)(*args)
+    if calls:
+        st.dataframe(_calls_table(calls), use_container_width=True, hide_index=True)
+        st.markdown("**Query plans**")
+        render_plans(calls)
+    else:
+        st.info("No queries ran on the last page render.")
+
+    st.markdown("---")
+    st.subheader("Database")
+    stats = dashboard_queries.get_database_stats()
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("Size", f"{stats['page_count'] * stats['page_size'] / 2**20:,.1f} MiB")
+    c2.metric("Free pages", f"{stats['freelist_count']:,}")
+    c3.metric("Journal", stats["journal_mode"])
+    c4.metric("Shards", len(stats["shards"]))
+    st.caption(stats["path"])
+    st.dataframe(stats["objects"], use_container_width=True, hide_index=True)
+    if stats["shards"]:
+        st.dataframe(pd.DataFrame(stats["shards"]), use_container_width=True, hide_index=True)
 
 
 # ---------------------------------------------------------------------------
 # ROUTER
 # ---------------------------------------------------------------------------
 
-if page == "Overview":
-    render_overview()
+if page == "Diagnostics":
+    render_diagnostics()
 else:
-    render_sessions()
+    with dashboard_queries.collect() as page_calls:
+        if page == "Overview":
+            render_overview()
+        else:
+            render_sessions()
+    st.session_state["last_queries"] = (page, page_calls)
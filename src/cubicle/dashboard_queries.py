@@ -1,107 +1,393 @@
-import json
+import functools
 import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
 
 import pandas as pd
 
-DB_PATH = Path.home() / ".cubicle" / "data" / "telemetry.db"
-
-# Normalized event type sets (handles both pre_tool_use and pretooluse variants)
-_TOOL_USE_EVENTS = "('pre_tool_use','pretooluse')"
-_POST_TOOL_EVENTS = "('post_tool_use','posttooluse')"
-_PROMPT_EVENTS = "('user_prompt_submit','userpromptsubmit')"
-_SESSION_START_EVENTS = "('session_start','sessionstart')"
-_SESSION_END_EVENTS = "('session_end','sessionend','agent_stop')"
-_PERMISSION_EVENTS = "('permission_request','permissionrequest')"
+sys.path.insert(0, str(Path(__file__).parent))
+import db
+
+# Canonical event codes (telemetry.event_code is indexed; see db.EVENT_TYPES)
+_TOOL_USE = db.event_code("pre_tool_use")
+_PERMISSION = db.event_code("permission_request")
+_NOTIFICATION = db.event_code("notification")
+
+SESSIONS_PAGE_SIZE = 50
+# Sessions page sort options -> ORDER BY expression
+SESSION_SORT_KEYS = {
+    "Started": "first_ts",
+    "Duration": "julianday(last_ts) - julianday(first_ts)",
+    "Tools": "tool_count",
+    "Prompts": "prompt_count",
+    "Events": "event_count",
+}
+TIMELINE_PAGE_SIZE = 200
+# Tool input/output shown in the timeline is cut to this many characters
+PREVIEW_CHARS = 400
+# Idle read-only connections kept for the next query
+POOL_SIZE = 4
+# The progress handler counts SQLite VM instructions in steps of this many
+PROGRESS_STEPS = 1000
+# Profiled calls kept for recent_queries()
+QUERY_LOG_SIZE = 200
+
+# Every profiled query by name (what the Diagnostics page and `cubicle bench` time)
+QUERIES = {}
+_query_log = deque(maxlen=QUERY_LOG_SIZE)
+_profile = threading.local()
+
+
+def result_rows(result):
+    """Size of a query's result: rows of a DataFrame, items of a list or dict, else 1."""
+    return len(result) if hasattr(result, "__len__") else 1
+
+
+def _profiled(query):
+    """Records each call's time, result size, SQLite VM instructions and statements.
+
+    Calls are kept in recent_queries() and, inside collect(), in the
+    collecting list. A profiled query called by another one is counted
+    as part of its caller.
+    """
+    @functools.wraps(query)
+    def wrapper(*args, **kwargs):
+        if getattr(_profile, "call", None) is not None:
+            return query(*args, **kwargs)
+        shown = [repr(arg) for arg in args] + [f"{name}={value!r}" for name, value in kwargs.items()]
+        call = {"query": query.__name__, "args": ", ".join(shown), "vm_steps": 0, "statements": []}
+        _profile.call = call
+        started = time.perf_counter()
+        try:
+            result = query(*args, **kwargs)
+        finally:
+            _profile.call = None
+            call["ms"] = round((time.perf_counter() - started) * 1000, 2)
+        call["rows"] = result_rows(result)
+        _query_log.append(call)
+        collecting = getattr(_profile, "collecting", None)
+        if collecting is not None:
+            collecting.append(call)
+        return result
+
+    QUERIES[query.__name__] = wrapper
+    return wrapper
+
+
+@contextmanager
+def collect():
+    """Yields a list that receives every profiled call this thread makes inside the block."""
+    calls = []
+    _profile.collecting = calls
+    try:
+        yield calls
+    finally:
+        _profile.collecting = None
+
+
+def recent_queries():
+    """The last QUERY_LOG_SIZE profiled calls from any thread, oldest first."""
+    return list(_query_log)
+
+
+def _count_steps(call):
+    call["vm_steps"] += PROGRESS_STEPS
+    return 0
+
+
+@contextmanager
+def _profiling(conn):
+    call = getattr(_profile, "call", None)
+    if call is None:
+        yield
+        return
+    conn.set_progress_handler(functools.partial(_count_steps, call), PROGRESS_STEPS)
+    conn.set_trace_callback(call["statements"].append)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, 0)
+        conn.set_trace_callback(None)
+
+
+class _ReadPool:
+    """Read-only connections to telemetry.db, or to a snapshot of it, shared by every query.
+
+    Connections outlive a Streamlit rerun, so their page caches stay warm
+    between queries. They are replaced when the file they read changes:
+    DB_PATH points elsewhere, or a snapshot refresh swaps in a new copy.
+    With snapshot_seconds set, queries read a copy refreshed at most that
+    often (see db.snapshot()), so no dashboard scan holds a lock in telemetry.db.
+    """
+
+    def __init__(self, cache_mib=db.READ_CACHE_MIB, mmap_mib=db.READ_MMAP_MIB, snapshot_seconds=None):
+        self.cache_mib = cache_mib
+        self.mmap_mib = mmap_mib
+        self.snapshot_seconds = snapshot_seconds
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._idle = []
+        self._source = None
+        self._refreshed = (None, None)
+
+    def _snapshot_due(self):
+        source, refreshed = self._refreshed
+        return source != db.DB_PATH or time.monotonic() - refreshed >= self.snapshot_seconds
+
+    def _path(self):
+        if self.snapshot_seconds is None:
+            if not db.DB_PATH.exists():
+                db.connect().close()
+            return db.DB_PATH
+        path = db.DB_PATH.parent / db.SNAPSHOT_DIR_NAME / db.DB_PATH.name
+        # One query refreshes the copy; the others keep reading the current one
+        if self._snapshot_due() and self._refresh_lock.acquire(blocking=not path.exists()):
+            try:
+                if self._snapshot_due():
+                    db.snapshot(path.parent)
+                    self._refreshed = (db.DB_PATH, time.monotonic())
+            finally:
+                self._refresh_lock.release()
+        return path
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+    @contextmanager
+    def connection(self):
+        path = self._path()
+        source = (path, path.stat().st_ino)
+        with self._lock:
+            if source != self._source:
+                for conn in self._idle:
+                    conn.close()
+                self._idle = []
+                self._source = source
+                if self.snapshot_seconds is None:
+                    # Read-only connections cannot migrate an older schema (e.g. create sessions)
+                    db.connect().close()
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = db.connect_readonly(path, self.cache_mib, self.mmap_mib)
+            conn.row_factory = sqlite3.Row
+        try:
+            with _profiling(conn):
+                yield conn
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            if source == self._source and len(self._idle) < POOL_SIZE:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+
+_pool = _ReadPool()
+
+
+def configure(options=None):
+    """Applies config.yaml's dashboard section (page cache, mmap size, snapshot reads)."""
+    global _pool
+    options = options or {}
+    previous, _pool = _pool, _ReadPool(
+        options.get("cache_mib", db.READ_CACHE_MIB),
+        options.get("mmap_mib", db.READ_MMAP_MIB),
+        options.get("snapshot_seconds"),
+    )
+    previous.close()
 
 
 def _connect():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Borrows a pooled read-only connection for the duration of a with block."""
+    return _pool.connection()
+
+
+def _read_telemetry(sql):
+    """Runs sql over main's telemetry and then each monthly shard's, and stacks the results.
+
+    sql names the table {telemetry}. Shards are attached one at a time, so
+    callers combine per-shard rows (sums, distinct pairs) in pandas.
+    """
+    with _connect() as conn:
+        frames = [
+            pd.read_sql_query(sql.format(telemetry=f"{schema}.telemetry"), conn)
+            for schema in db.each_telemetry_schema(conn)
+        ]
+    return pd.concat(frames, ignore_index=True)
 
 
+@_profiled
+def data_version(session_id=None) -> tuple:
+    """A token that changes whenever events are added (to one session, if given).
 
+    Both lookups are index seeks, so the dashboard can check it on every rerun
+    and reuse cached query results while it is unchanged.
+    """
+    with _connect() as conn:
+        if session_id is None:
+            # Shard ids are larger than any before them, so only the newest counts
+            newest = db.shard_months()[-1:]
+            with db.telemetry_schemas(conn, *newest) as schemas:
+                row = conn.execute(f"SELECT MAX(id) FROM {schemas[-1]}.telemetry").fetchone()
+        else:
+            row = conn.execute(
+                "SELECT event_count, last_ts FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+    return tuple(row) if row else ()
+
+
+@_profiled
 def get_summary_stats() -> dict:
+    # sessions is kept current by every insert, so this reads one row per
+    # session instead of re-aggregating telemetry
     with _connect() as conn:
-        sessions_row = conn.execute(
-            "SELECT COUNT(DISTINCT session_id) as n FROM telemetry"
-        ).fetchone()
-        tool_calls_row = conn.execute(
-            "SELECT COUNT(*) as n FROM telemetry WHERE LOWER(REPLACE(event_type,'_','')) = 'pretooluse'"
-        ).fetchone()
-        prompts_row = conn.execute(
-            "SELECT COUNT(*) as n FROM telemetry WHERE LOWER(REPLACE(event_type,'_','')) = 'userpromptsubmit'"
-        ).fetchone()
-        duration_row = conn.execute("""
-            SELECT AVG((julianday(last_ts) - julianday(first_ts)) * 24 * 60) as avg_min
-            FROM (
-                SELECT session_id,
-                       MIN(timestamp) as first_ts,
-                       MAX(timestamp) as last_ts
-                FROM telemetry
-                GROUP BY session_id
-                HAVING COUNT(*) > 1
-            )
+        totals_row = conn.execute("""
+            SELECT
+                COUNT(*) as sessions,
+                COALESCE(SUM(tool_count), 0) as tool_calls,
+                COALESCE(SUM(prompt_count), 0) as prompts,
+                AVG(CASE WHEN event_count > 1
+                         THEN (julianday(last_ts) - julianday(first_ts)) * 24 * 60 END) as avg_min
+            FROM sessions
         """).fetchone()
         top_model_row = conn.execute("""
-            SELECT model, COUNT(DISTINCT session_id) as n
-            FROM telemetry
-            WHERE model IS NOT NULL AND model != ''
+            SELECT model, COUNT(*) as n
+            FROM sessions
+            WHERE model IS NOT NULL
             GROUP BY model
             ORDER BY n DESC
             LIMIT 1
         """).fetchone()
 
     return {
-        "total_sessions": sessions_row["n"],
-        "total_tool_calls": tool_calls_row["n"],
-        "total_prompts": prompts_row["n"],
-        "avg_duration_min": round(duration_row["avg_min"] or 0, 1),
+        "total_sessions": totals_row["sessions"],
+        "total_tool_calls": totals_row["tool_calls"],
+        "total_prompts": totals_row["prompts"],
+        "avg_duration_min": round(totals_row["avg_min"] or 0, 1),
         "top_model": top_model_row["model"] if top_model_row else "N/A",
     }
 
 
-def get_sessions() -> pd.DataFrame:
+@_profiled
+def query_sessions(
+    model=None,
+    repo=None,
+    min_tools: int = 0,
+    sort: str = "Started",
+    descending: bool = True,
+    page: int = 0,
+    page_size: int = SESSIONS_PAGE_SIZE,
+    session_id=None,
+):
+    """Returns (one page of matching sessions, total number of matches).
+
+    model and repo filter on exact values (None for any; repo "unknown"
+    matches sessions without a working directory). sort is a SESSION_SORT_KEYS key.
+    """
+    where = ["tool_count >= :min_tools"]
+    params = {"min_tools": min_tools, "limit": page_size, "offset": page * page_size}
+    if session_id is not None:
+        where.append("session_id = :session_id")
+        params["session_id"] = session_id
+    if model is not None:
+        where.append("model = :model")
+        params["model"] = model
+    if repo == "unknown":
+        where.append("repo IS NULL")
+    elif repo is not None:
+        where.append("repo = :repo")
+        params["repo"] = repo
+    where_sql = " AND ".join(where)
+    order = f"{SESSION_SORT_KEYS[sort]} {'DESC' if descending else 'ASC'}, session_id"
+
     with _connect() as conn:
-        df = pd.read_sql_query("""
+        total = conn.execute(f"SELECT COUNT(*) FROM sessions WHERE {where_sql}", params).fetchone()[0]
+        df = pd.read_sql_query(f"""
             SELECT
-                t.session_id,
-                t.model,
-                MIN(t.timestamp) as start_time,
-                MAX(t.timestamp) as end_time,
-                ROUND((julianday(MAX(t.timestamp)) - julianday(MIN(t.timestamp))) * 24 * 60, 1) as duration_min,
-                COUNT(*) as event_count,
-                SUM(CASE WHEN LOWER(REPLACE(t.event_type,'_','')) = 'userpromptsubmit' THEN 1 ELSE 0 END) as prompt_count,
-                SUM(CASE WHEN LOWER(REPLACE(t.event_type,'_','')) = 'pretooluse' THEN 1 ELSE 0 END) as tool_count,
-                SUM(CASE WHEN LOWER(REPLACE(t.event_type,'_','')) = 'permissionrequest' THEN 1 ELSE 0 END) as permission_count,
-                MAX(CASE WHEN t.raw_payload LIKE '%cwd%' THEN json_extract(t.raw_payload, '$.cwd') END) as cwd
-            FROM telemetry t
-            GROUP BY t.session_id
-            ORDER BY start_time DESC
-        """, conn)
+                session_id,
+                agent,
+                model,
+                first_ts as start_time,
+                last_ts as end_time,
+                ROUND((julianday(last_ts) - julianday(first_ts)) * 24 * 60, 1) as duration_min,
+                event_count,
+                prompt_count,
+                tool_count,
+                permission_count,
+                cwd,
+                COALESCE(repo, 'unknown') as repo
+            FROM sessions
+            WHERE {where_sql}
+            ORDER BY {order}
+            LIMIT :limit OFFSET :offset
+        """, conn, params=params)
 
-    df["repo"] = df["cwd"].apply(lambda x: Path(x).name if isinstance(x, str) and x else "unknown")
     df["start_time"] = pd.to_datetime(df["start_time"])
     df["end_time"] = pd.to_datetime(df["end_time"])
     df["session_short"] = df["session_id"].str[:8]
-    return df
+    return df, total
+
 
+@_profiled
+def get_session(session_id: str):
+    """Returns one session's query_sessions() row, or None."""
+    df, _ = query_sessions(session_id=session_id)
+    return None if df.empty else df.iloc[0]
 
+
+@_profiled
+def search_events(text: str, limit: int = 50) -> pd.DataFrame:
+    """Ranked full-text search over prompts, tool input/output and assistant replies.
+
+    Matched words in the snippet column are bolded with Markdown.
+    """
+    with _connect() as conn:
+        rows = db.search(conn, text, limit, mark=("**", "**"))
+    return pd.DataFrame(
+        [tuple(row) for row in rows],
+        columns=["id", "session_id", "timestamp", "event_type", "tool_name", "snippet"],
+    )
+
+
+@_profiled
+def get_session_models() -> list:
+    """Distinct session models, for the Sessions page filter."""
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT DISTINCT model FROM sessions WHERE model IS NOT NULL ORDER BY model"
+        ).fetchall()
+    return [row["model"] for row in rows]
+
+
+@_profiled
+def get_session_repos() -> list:
+    """Distinct session repos ("unknown" for none), for the Sessions page filter."""
+    with _connect() as conn:
+        rows = conn.execute("SELECT DISTINCT repo FROM sessions ORDER BY repo").fetchall()
+    return sorted(row["repo"] or "unknown" for row in rows)
+
+
+@_profiled
 def get_daily_sessions(days: int = 30) -> pd.DataFrame:
     with _connect() as conn:
         df = pd.read_sql_query(f"""
             SELECT
-                DATE(first_ts) as date,
-                model,
-                COUNT(*) as sessions
-            FROM (
-                SELECT session_id, model, MIN(timestamp) as first_ts
-                FROM telemetry
-                GROUP BY session_id
-            )
-            WHERE first_ts >= DATE('now', '-{days} days')
-            GROUP BY DATE(first_ts), model
+                DATE(hour) as date,
+                NULLIF(model, '') as model,
+                SUM(sessions_started) as sessions
+            FROM event_rollup
+            WHERE hour >= DATE('now', '-{days} days')
+              AND sessions_started > 0
+            GROUP BY DATE(hour), model
             ORDER BY date
         """, conn)
 
@@ -109,151 +395,247 @@ def get_daily_sessions(days: int = 30) -> pd.DataFrame:
     return df
 
 
+@_profiled
 def get_model_distribution() -> pd.DataFrame:
     with _connect() as conn:
-        df = pd.read_sql_query("""
+        df = pd.read_sql_query(f"""
             SELECT
                 model,
-                COUNT(DISTINCT session_id) as sessions,
-                SUM(CASE WHEN LOWER(REPLACE(event_type,'_','')) = 'pretooluse' THEN 1 ELSE 0 END) as tool_calls
-            FROM telemetry
-            WHERE model IS NOT NULL AND model != ''
+                SUM(sessions_started) as sessions,
+                SUM(CASE WHEN event_code = {_TOOL_USE} THEN events ELSE 0 END) as tool_calls
+            FROM event_rollup
+            WHERE model != ''
             GROUP BY model
             ORDER BY sessions DESC
         """, conn)
     return df
 
 
+@_profiled
 def get_repo_distribution() -> pd.DataFrame:
     with _connect() as conn:
         df = pd.read_sql_query("""
-            SELECT
-                json_extract(raw_payload, '$.cwd') as cwd,
-                COUNT(DISTINCT session_id) as sessions,
-                SUM(CASE WHEN LOWER(REPLACE(event_type,'_','')) = 'pretooluse' THEN 1 ELSE 0 END) as tool_calls
-            FROM telemetry
-            WHERE raw_payload LIKE '%cwd%'
-            GROUP BY cwd
-            ORDER BY tool_calls DESC
-            LIMIT 20
+            SELECT repo, COUNT(NULLIF(session_id, '')) as sessions, SUM(tool_calls) as tool_calls
+            FROM repo_rollup
+            GROUP BY repo
+            ORDER BY tool_calls DESC, repo
+            LIMIT 15
         """, conn)
-    df["repo"] = df["cwd"].apply(lambda x: Path(x).name if isinstance(x, str) and x else "unknown")
-    df = df.groupby("repo", as_index=False).agg({"sessions": "sum", "tool_calls": "sum"})
-    df = df.sort_values("tool_calls", ascending=False).head(15)
     return df
 
 
+@_profiled
 def get_tool_usage() -> pd.DataFrame:
     with _connect() as conn:
         df = pd.read_sql_query("""
-            SELECT
-                json_extract(raw_payload, '$.tool_name') as tool_name,
-                COUNT(*) as count,
-                COUNT(DISTINCT session_id) as sessions
-            FROM telemetry
-            WHERE LOWER(REPLACE(event_type,'_','')) = 'pretooluse'
-              AND json_extract(raw_payload, '$.tool_name') IS NOT NULL
+            SELECT tool_name, SUM(calls) as count, COUNT(NULLIF(session_id, '')) as sessions
+            FROM tool_rollup
             GROUP BY tool_name
-            ORDER BY count DESC
+            ORDER BY count DESC, tool_name
             LIMIT 20
         """, conn)
     return df
 
 
-def get_session_events(session_id: str) -> pd.DataFrame:
+@_profiled
+def get_session_timeline(
+    session_id: str, after=None, limit: int = TIMELINE_PAGE_SIZE, event_types=None
+) -> pd.DataFrame:
+    """Returns one page of a session's events, oldest first.
+
+    Only the fields each event type displays are extracted, in SQL, and tool
+    input/output is cut to PREVIEW_CHARS there, so large payloads never reach
+    Python. Pass the (timestamp, id) of the previous page's last row as after
+    to get the next page, and a tuple of event types to load only those; use
+    get_event_payload() for an event's full payload. A row whose payload is
+    not valid JSON has unparseable set and no extracted fields, rather than
+    failing the whole page.
+    """
+    if after is None:
+        after = ("", 0)
+    params = {
+        "session_id": session_id,
+        "after_ts": after[0],
+        "after_id": after[1],
+        "limit": limit,
+        "preview": PREVIEW_CHARS,
+    }
+    type_filter = ""
+    if event_types:
+        params.update({f"type{i}": name for i, name in enumerate(event_types)})
+        type_filter = f"AND event_type IN ({', '.join(f':type{i}' for i in range(len(event_types)))})"
+    with _connect() as conn:
+        span = conn.execute(
+            "SELECT first_ts, last_ts FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        with db.telemetry_schemas(conn, *(span or ())) as schemas:
+            sources = " UNION ALL ".join(f"""
+                SELECT * FROM (
+                    SELECT id, timestamp, event_type, tool_name, cwd,
+                           CASE WHEN json_valid(payload_json(raw_payload, payload_codec))
+                                THEN {db.payload_json_sql(schema)} END as raw_payload
+                    FROM {schema}.telemetry
+                    WHERE session_id = :session_id
+                      AND (timestamp, id) > (:after_ts, :after_id)
+                      {type_filter}
+                    ORDER BY timestamp, id
+                    LIMIT :limit
+                )
+            """ for schema in schemas)
+            # The page is materialized so each payload is decoded once, not per field
+            df = pd.read_sql_query(f"""
+                WITH page AS MATERIALIZED (
+                    SELECT * FROM ({sources}) ORDER BY timestamp, id LIMIT :limit
+                )
+                SELECT
+                    id,
+                    timestamp,
+                    event_type,
+                    tool_name,
+                    prompt_text,
+                    CASE WHEN length(tool_input) > :preview
+                         THEN substr(tool_input, 1, :preview) || '…' ELSE tool_input END as tool_input,
+                    CASE WHEN length(tool_response) > :preview
+                         THEN substr(tool_response, 1, :preview) || '…' ELSE tool_response END as tool_response,
+                    notification_msg,
+                    assistant_message,
+                    cwd,
+                    unparseable
+                FROM (
+                    SELECT
+                        id,
+                        timestamp,
+                        event_type,
+                        tool_name,
+                        cwd,
+                        CASE WHEN event_type = 'user_prompt_submit' THEN COALESCE(
+                            NULLIF(json_extract(raw_payload, '$.prompt'), ''),
+                            NULLIF(json_extract(raw_payload, '$.message'), '')
+                        ) END as prompt_text,
+                        CASE WHEN event_type = 'pre_tool_use' THEN NULLIF(
+                            NULLIF(json_extract(raw_payload, '$.tool_input'), ''), '{{}}'
+                        ) END as tool_input,
+                        CASE WHEN event_type = 'post_tool_use' THEN
+                            CASE json_type(raw_payload, '$.tool_response')
+                                WHEN 'object' THEN COALESCE(
+                                    NULLIF(json_extract(raw_payload, '$.tool_response.stdout'), ''),
+                                    NULLIF(json_extract(raw_payload, '$.tool_response.output'), ''),
+                                    json_extract(raw_payload, '$.tool_response')
+                                )
+                                WHEN 'text' THEN json_extract(raw_payload, '$.tool_response')
+                            END
+                        END as tool_response,
+                        CASE WHEN event_type IN ('notification', 'permission_request') THEN COALESCE(
+                            NULLIF(json_extract(raw_payload, '$.message'), ''),
+                            NULLIF(json_extract(raw_payload, '$.reason'), '')
+                        ) END as notification_msg,
+                        CASE WHEN event_type IN ('turn_complete', 'stop')
+                             THEN json_extract(raw_payload, '$.last_assistant_message') END as assistant_message,
+                        raw_payload IS NULL as unparseable
+                    FROM page
+                )
+                ORDER BY timestamp, id
+            """, conn, params=params)
+    return df
+
+
+@_profiled
+def get_event_payload(event_id: int) -> dict:
+    """Returns one event's full raw payload."""
     with _connect() as conn:
-        rows = conn.execute("""
-            SELECT timestamp, event_type, raw_payload
-            FROM telemetry
-            WHERE session_id = ?
-            ORDER BY timestamp ASC, id ASC
-        """, (session_id,)).fetchall()
-
-    records = []
-    for row in rows:
+        schema = db.event_schema(conn, event_id)
+        row = conn.execute(
+            f"SELECT raw_payload, payload_codec, blob_refs FROM {schema}.telemetry WHERE id = ?", (event_id,)
+        ).fetchone()
+        if row is None:
+            return {}
         try:
-            payload = json.loads(row["raw_payload"])
-        except Exception:
-            payload = {}
-
-        norm = row["event_type"].lower().replace("_", "")
-        tool_name = payload.get("tool_name")
-
-        prompt_text = None
-        if norm == "userpromptsubmit":
-            prompt_text = payload.get("prompt") or payload.get("message")
-
-        tool_response = None
-        if norm == "posttooluse":
-            resp = payload.get("tool_response")
-            if isinstance(resp, dict):
-                tool_response = resp.get("stdout") or resp.get("output") or json.dumps(resp)
-            elif isinstance(resp, str):
-                tool_response = resp
-            if tool_response and len(tool_response) > 400:
-                tool_response = tool_response[:400] + "…"
-
-        tool_input = None
-        if norm == "pretooluse":
-            ti = payload.get("tool_input")
-            if ti:
-                tool_input = json.dumps(ti) if not isinstance(ti, str) else ti
-                if len(tool_input) > 400:
-                    tool_input = tool_input[:400] + "…"
-
-        notification_msg = None
-        if norm in ("notification", "permissionrequest"):
-            notification_msg = payload.get("message") or payload.get("reason")
-
-        assistant_message = None
-        if norm in ("turncomplete", "stop"):
-            assistant_message = payload.get("last_assistant_message")
-
-        records.append({
-            "timestamp": row["timestamp"],
-            "event_type": row["event_type"],
-            "norm_event": norm,
-            "tool_name": tool_name,
-            "prompt_text": prompt_text,
-            "tool_input": tool_input,
-            "tool_response": tool_response,
-            "notification_msg": notification_msg,
-            "assistant_message": assistant_message,
-            "cwd": payload.get("cwd"),
-        })
-
-    return pd.DataFrame(records)
+            return db.load_payload(*row, conn=conn, schema=schema)
+        except ValueError:
+            return {}
 
 
+@_profiled
 def get_usage_heatmap() -> pd.DataFrame:
     """Returns session counts by day-of-week and hour-of-day."""
     with _connect() as conn:
         df = pd.read_sql_query("""
             SELECT
-                CAST(strftime('%w', first_ts) AS INTEGER) as dow,
-                CAST(strftime('%H', first_ts) AS INTEGER) as hour,
-                COUNT(*) as sessions
-            FROM (
-                SELECT session_id, MIN(timestamp) as first_ts
-                FROM telemetry
-                GROUP BY session_id
-            )
-            GROUP BY dow, hour
+                CAST(strftime('%w', hour) AS INTEGER) as dow,
+                CAST(strftime('%H', hour) AS INTEGER) as hour,
+                SUM(sessions_started) as sessions
+            FROM event_rollup
+            WHERE sessions_started > 0
+            GROUP BY 1, 2
         """, conn)
     return df
 
 
+@_profiled
 def get_error_stats() -> pd.DataFrame:
+    counts = _read_telemetry(f"""
+        SELECT
+            model,
+            SUM(CASE WHEN event_code = {_PERMISSION} THEN 1 ELSE 0 END) as permission_requests,
+            SUM(CASE WHEN event_code = {_NOTIFICATION}
+                     AND payload_json(raw_payload, payload_codec) LIKE '%permission_prompt%' THEN 1 ELSE 0 END) as permission_prompts
+        FROM {{telemetry}}
+        WHERE model IS NOT NULL AND model != ''
+        GROUP BY model
+    """)
+    df = counts.groupby("model", as_index=False).sum()
+    return df.sort_values("permission_requests", ascending=False, kind="stable").reset_index(drop=True)
+
+
+def _is_full_scan(detail, tables):
+    # "SCAN t" reads every row of t; "SCAN t USING [COVERING] INDEX" walks an index,
+    # and SCANs of subqueries, CTEs and virtual tables (full-text search) are not tables.
+    # Tables named with their schema appear as "SCAN main.t" or "SCAN shard_2026_01.t".
+    words = detail.split()
+    return len(words) == 2 and words[0] == "SCAN" and words[1].rsplit(".", 1)[-1] in tables
+
+
+def explain(sql: str) -> pd.DataFrame:
+    """EXPLAIN QUERY PLAN for sql, one row per plan step, with full table scans flagged.
+
+    Statements naming a monthly shard are planned with the newest shards
+    attached. Raises sqlite3.Error if sql cannot be planned.
+    """
+    with _connect() as conn, db.telemetry_schemas(conn) as schemas:
+        tables = {
+            name
+            for schema in schemas
+            for (name,) in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'")
+        }
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    return pd.DataFrame(
+        [(row["detail"], _is_full_scan(row["detail"], tables)) for row in rows],
+        columns=["step", "full_scan"],
+    )
+
+
+@_profiled
+def get_database_stats() -> dict:
+    """Size and free space of telemetry.db and its shards, plus every table and index with its size."""
     with _connect() as conn:
-        df = pd.read_sql_query("""
-            SELECT
-                model,
-                SUM(CASE WHEN LOWER(REPLACE(event_type,'_','')) = 'permissionrequest' THEN 1 ELSE 0 END) as permission_requests,
-                SUM(CASE WHEN LOWER(REPLACE(event_type,'_','')) = 'notification'
-                         AND raw_payload LIKE '%permission_prompt%' THEN 1 ELSE 0 END) as permission_prompts
-            FROM telemetry
-            WHERE model IS NOT NULL AND model != ''
-            GROUP BY model
-            ORDER BY permission_requests DESC
+        pragmas = {
+            name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in ("page_size", "page_count", "freelist_count", "journal_mode", "auto_vacuum")
+        }
+        objects = pd.read_sql_query("""
+            SELECT name, type, tbl_name AS "table"
+            FROM sqlite_master
+            WHERE type IN ('table', 'index') AND name NOT LIKE 'sqlite_autoindex%'
+            ORDER BY tbl_name, type DESC, name
         """, conn)
-    return df
+        try:
+            sizes = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+        except sqlite3.OperationalError:
+            sizes = {}  # SQLite built without the dbstat table
+        path = db.database_path(conn)
+    objects["bytes"] = objects["name"].map(sizes)
+    shards = [
+        {"month": month, "bytes": db.shard_path(month, path).stat().st_size}
+        for month in db.shard_months(base=path)
+    ]
+    return {**pragmas, "path": str(path), "objects": objects, "shards": shards}
@@ -1,72 +1,1306 @@
-import sqlite3
+import hashlib
 import json
-import shutil
-from datetime import datetime
+import os
+import random
+import re
+import sqlite3
+import time
+import zlib
+from collections.abc import Mapping
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+from functools import partial
 from pathlib import Path
 
+import timings
+from payload import RawPayload
+
 DB_PATH = Path.home() / ".cubicle" / "data" / "telemetry.db"
+HEALTH_LOG_NAME = "ingest_health.log"
+# Set by `cubicle <agent>` for the agent's process tree
+FAMILY_ENV = "CUBICLE_LLM_FAMILY"
 
+# WAL lets the dashboard read while hooks write; NORMAL sync is durable across
+# application crashes in WAL mode and skips an fsync per commit.
+BUSY_TIMEOUT_MS = 2000
+WRITE_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.05
+# retain() expires this many events per transaction and frees this many
+# pages per incremental vacuum step
+RETAIN_BATCH = 2000
+VACUUM_STEP_PAGES = 1000
+AUTO_VACUUM_INCREMENTAL = 2
+# SQLite's default limit on attached databases is 10
+MAX_ATTACHED_SHARDS = 8
+# Read-only connections (the dashboard's) get a larger page cache and map the
+# file into memory, so repeated scans are served without read() calls
+READ_CACHE_MIB = 64
+READ_MMAP_MIB = 256
+SNAPSHOT_DIR_NAME = "snapshot"
 
-def migrate_schema():
-    """Remove llm_family column if present. Backs up DB first."""
-    if not DB_PATH.exists():
-        return
-    with sqlite3.connect(DB_PATH) as conn:
-        cols = [r[1] for r in conn.execute("PRAGMA table_info(telemetry)").fetchall()]
-    if "llm_family" not in cols:
-        return
+# Canonical event names, mirroring `events` in default_config.yaml. A name's
+# code is its position + 1 and is stored in telemetry.event_code, so only
+# append to this list. Names outside it get codes assigned in event_types.
+EVENT_TYPES = (
+    "session_start",
+    "session_end",
+    "pre_model",
+    "post_model",
+    "setup",
+    "pre_tool_use",
+    "post_tool_use",
+    "post_tool_use_failure",
+    "permission_request",
+    "permission_denied",
+    "user_prompt_submit",
+    "agent_start",
+    "agent_stop",
+    "turn_complete",
+    "task_created",
+    "task_completed",
+    "pre_compress",
+    "notification",
+    "instructions_loaded",
+    "config_change",
+    "cwd_changed",
+    "file_changed",
+    "worktree_create",
+    "worktree_remove",
+    "pre_compact",
+    "post_compact",
+    "elicitation",
+    "elicitation_result",
+    "tool_selection",
+)
+_EVENT_CODES = {name: code for code, name in enumerate(EVENT_TYPES, start=1)}
+# Older hooks stored unmapped events lowercased, e.g. "pretooluse"
+_EVENT_VARIANTS = {name.replace("_", ""): name for name in EVENT_TYPES}
 
-    backup_path = DB_PATH.parent / f"telemetry_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-    shutil.copy2(DB_PATH, backup_path)
 
-    with sqlite3.connect(DB_PATH) as conn:
+def canonical_event(event_type):
+    """Folds spelling variants (PreToolUse, pretooluse) into the canonical event name."""
+    if not event_type:
+        return "unknown"
+    lowered = event_type.lower()
+    return _EVENT_VARIANTS.get(lowered.replace("_", ""), lowered)
+
+
+def event_code(name):
+    """The fixed event_code of a canonical name in EVENT_TYPES."""
+    return _EVENT_CODES[name]
+
+
+def _create_telemetry(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS telemetry (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            session_id TEXT,
+            event_type TEXT,
+            model TEXT,
+            raw_payload JSON
+        )
+    """)
+
+
+def _columns(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _has_llm_family(conn):
+    return "llm_family" in _columns(conn, "telemetry")
+
+
+def _drop_llm_family(conn):
+    """Remove llm_family column if present."""
+    if _has_llm_family(conn):
         conn.execute("ALTER TABLE telemetry DROP COLUMN llm_family")
-        conn.commit()
+
+
+def _create_ingest_keys(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_keys (
+            key TEXT PRIMARY KEY
+        ) WITHOUT ROWID
+    """)
+
+
+def _create_spool_loads(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS spool_loads (
+            file TEXT PRIMARY KEY,
+            loaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+
+
+def _create_sessions(conn):
+    """One row per session, kept current by insert_telemetry() and insert_many()."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            agent TEXT,
+            model TEXT,
+            cwd TEXT,
+            first_ts DATETIME,
+            last_ts DATETIME,
+            event_count INTEGER NOT NULL DEFAULT 0,
+            prompt_count INTEGER NOT NULL DEFAULT 0,
+            tool_count INTEGER NOT NULL DEFAULT 0,
+            permission_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Backfill from existing events. The first non-empty model wins, as it
+    # does for incremental updates; the agent was not recorded before.
+    conn.execute("""
+        INSERT OR IGNORE INTO sessions (
+            session_id, model, cwd, first_ts, last_ts,
+            event_count, prompt_count, tool_count, permission_count
+        )
+        SELECT g.session_id, m.model, g.cwd, g.first_ts, g.last_ts,
+               g.event_count, g.prompt_count, g.tool_count, g.permission_count
+        FROM (
+            SELECT
+                session_id,
+                MIN(CASE WHEN model IS NOT NULL AND model != '' THEN id END) as model_id,
+                MAX(CASE WHEN raw_payload LIKE '%cwd%' THEN json_extract(raw_payload, '$.cwd') END) as cwd,
+                MIN(timestamp) as first_ts,
+                MAX(timestamp) as last_ts,
+                COUNT(*) as event_count,
+                SUM(LOWER(REPLACE(event_type, '_', '')) = 'userpromptsubmit') as prompt_count,
+                SUM(LOWER(REPLACE(event_type, '_', '')) = 'pretooluse') as tool_count,
+                SUM(LOWER(REPLACE(event_type, '_', '')) = 'permissionrequest') as permission_count
+            FROM telemetry
+            WHERE session_id IS NOT NULL
+            GROUP BY session_id
+        ) g
+        LEFT JOIN telemetry m ON m.id = g.model_id
+    """)
+
+
+def _add_event_codes(conn):
+    """Adds telemetry.event_code and canonicalizes the event_type of existing rows."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_types (
+            code INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    """)
+    conn.executemany(
+        "INSERT OR IGNORE INTO event_types (code, name) VALUES (?, ?)",
+        [(code, name) for name, code in _EVENT_CODES.items()],
+    )
+    if "event_code" not in _columns(conn, "telemetry"):
+        conn.execute("ALTER TABLE telemetry ADD COLUMN event_code INTEGER REFERENCES event_types (code)")
+
+    conn.create_function("canonical_event", 1, canonical_event, deterministic=True)
+    conn.execute("""
+        UPDATE telemetry SET event_type = canonical_event(event_type)
+        WHERE event_type IS NOT canonical_event(event_type)
+    """)
+    conn.execute("INSERT OR IGNORE INTO event_types (name) SELECT DISTINCT event_type FROM telemetry")
+    conn.execute("UPDATE telemetry SET event_code = (SELECT code FROM event_types WHERE name = event_type)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_event_code ON telemetry (event_code)")
+
+
+def _add_extracted_columns(conn):
+    """Stores tool_name, cwd, repo and agent as columns so queries skip the JSON payload."""
+    for column in ("tool_name", "cwd", "repo", "agent"):
+        if column not in _columns(conn, "telemetry"):
+            conn.execute(f"ALTER TABLE telemetry ADD COLUMN {column} TEXT")
+    if "repo" not in _columns(conn, "sessions"):
+        conn.execute("ALTER TABLE sessions ADD COLUMN repo TEXT")
+
+    conn.create_function("repo_name", 1, repo_name, deterministic=True)
+    conn.execute("""
+        UPDATE telemetry SET
+            tool_name = CASE WHEN json_type(raw_payload, '$.tool_name') = 'text'
+                             THEN json_extract(raw_payload, '$.tool_name') END,
+            cwd = CASE WHEN json_type(raw_payload, '$.cwd') = 'text'
+                       THEN json_extract(raw_payload, '$.cwd') END,
+            agent = (SELECT agent FROM sessions s WHERE s.session_id = telemetry.session_id)
+        WHERE json_valid(raw_payload)
+    """)
+    conn.execute("UPDATE telemetry SET repo = repo_name(cwd) WHERE cwd IS NOT NULL")
+    conn.execute("UPDATE sessions SET repo = repo_name(cwd) WHERE cwd IS NOT NULL")
+
+    conn.execute("DROP INDEX IF EXISTS idx_telemetry_event_code")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_event_ts ON telemetry (event_code, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_session_ts ON telemetry (session_id, timestamp)")
+
+
+def _index_sessions_by_start(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_first_ts ON sessions (first_ts)")
+
+
+def _create_event_rollup(conn):
+    """Hourly event counts for the Overview charts, kept current by every insert.
+
+    Dimensions use '' for missing values so the primary key can fold them.
+    sessions_started counts each session once, in the bucket of its first
+    event, so it can be summed over any range.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_rollup (
+            hour TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            model TEXT NOT NULL,
+            repo TEXT NOT NULL,
+            event_code INTEGER NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            sessions_started INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, agent, model, repo, event_code)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        WITH firsts AS (
+            SELECT MIN(id) as id FROM telemetry WHERE session_id IS NOT NULL GROUP BY session_id
+        )
+        INSERT OR IGNORE INTO event_rollup (hour, agent, model, repo, event_code, events, sessions_started)
+        SELECT
+            strftime('%Y-%m-%d %H:00:00', t.timestamp),
+            COALESCE(t.agent, ''),
+            COALESCE(t.model, ''),
+            COALESCE(t.repo, ''),
+            COALESCE(t.event_code, 0),
+            COUNT(*),
+            COUNT(f.id)
+        FROM telemetry t
+        LEFT JOIN firsts f ON f.id = t.id
+        GROUP BY 1, 2, 3, 4, 5
+    """)
+
+
+def _index_session_filters(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_model ON sessions (model)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_repo ON sessions (repo)")
+
+
+def _create_event_search(conn):
+    """Full-text index over _search_text() of each event, keyed by telemetry id."""
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS event_search USING fts5 (text)")
+    rows = conn.cursor().execute(
+        "SELECT id, raw_payload FROM telemetry WHERE id > (SELECT COALESCE(MAX(rowid), 0) FROM event_search)"
+    )
+    conn.executemany(SEARCH_INSERT_SQL.format(schema="main"), _search_rows(rows))
+
+
+def _search_rows(rows):
+    for event_id, raw_payload in rows:
+        try:
+            text = _search_text(json.loads(raw_payload))
+        except (TypeError, ValueError):
+            continue
+        if text:
+            yield event_id, text
+
+
+def _add_payload_codec(conn):
+    """NULL payload_codec means raw_payload is plain JSON text; see PAYLOAD_CODECS."""
+    if "payload_codec" not in _columns(conn, "telemetry"):
+        conn.execute("ALTER TABLE telemetry ADD COLUMN payload_codec TEXT")
+
+
+def _create_payload_blobs(conn):
+    """Content-addressed store for large payload fields, shared by every row that repeats them.
+
+    Rows list the blobs they use in blob_refs ({field: hash}). Deleting a row
+    releases its references, and a blob goes with its last reference.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payload_blobs (
+            hash TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            codec TEXT,
+            refcount INTEGER NOT NULL
+        )
+    """)
+    if "blob_refs" not in _columns(conn, "telemetry"):
+        conn.execute("ALTER TABLE telemetry ADD COLUMN blob_refs TEXT")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS telemetry_release_blobs
+        AFTER DELETE ON telemetry WHEN old.blob_refs IS NOT NULL
+        BEGIN
+            UPDATE payload_blobs SET refcount = refcount - 1
+            WHERE hash IN (SELECT value FROM json_each(old.blob_refs));
+            DELETE FROM payload_blobs
+            WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(old.blob_refs));
+        END
+    """)
+
+
+def _release_blobs_on_strip(conn):
+    """Releases a row's blobs when retain() strips its payload, as deleting it does."""
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS telemetry_release_stripped_blobs
+        AFTER UPDATE OF blob_refs ON telemetry
+        WHEN old.blob_refs IS NOT NULL AND new.blob_refs IS NULL
+        BEGIN
+            UPDATE payload_blobs SET refcount = refcount - 1
+            WHERE hash IN (SELECT value FROM json_each(old.blob_refs));
+            DELETE FROM payload_blobs
+            WHERE refcount <= 0 AND hash IN (SELECT value FROM json_each(old.blob_refs));
+        END
+    """)
+
+
+USAGE_ROLLUP_SQL = {
+    "tool_rollup": """
+        SELECT tool_name, COALESCE(session_id, ''), COUNT(*)
+        FROM telemetry
+        WHERE event_code = {tool_use} AND tool_name IS NOT NULL
+        GROUP BY 1, 2
+    """,
+    "repo_rollup": """
+        SELECT COALESCE(repo, 'unknown'), COALESCE(session_id, ''),
+               SUM(CASE WHEN event_code = {tool_use} THEN 1 ELSE 0 END)
+        FROM telemetry
+        WHERE cwd IS NOT NULL
+        GROUP BY 1, 2
+    """,
+}
+
+
+def _create_usage_rollups(conn):
+    """Per-session tool and repo counts for the Overview charts, kept current by every insert.
+
+    Distinct sessions per tool or repo cannot be summed from event_rollup's
+    hourly buckets, so these keep one row per (tool or repo, session). They
+    stay in main and outlive retain(), like event_rollup. session_id is ''
+    for events without one. Shards are read through their own connections,
+    since nothing can be attached inside the migration's transaction.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tool_rollup (
+            tool_name TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tool_name, session_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS repo_rollup (
+            repo TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            tool_calls INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (repo, session_id)
+        ) WITHOUT ROWID
+    """)
+    shards = [shard_path(month, database_path(conn)) for month in shard_months(base=database_path(conn))]
+    for table, sql in USAGE_ROLLUP_SQL.items():
+        key, count = ("tool_name", "calls") if table == "tool_rollup" else ("repo", "tool_calls")
+        upsert = f"""
+            INSERT INTO {table} ({key}, session_id, {count}) VALUES (?, ?, ?)
+            ON CONFLICT ({key}, session_id) DO UPDATE SET {count} = {count} + excluded.{count}
+        """
+        sql = sql.format(tool_use=event_code("pre_tool_use"))
+        conn.executemany(upsert, conn.execute(sql).fetchall())
+        for path in shards:
+            with closing(sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)) as shard:
+                conn.executemany(upsert, shard.execute(sql).fetchall())
+
+
+def _backup(conn):
+    backup_path = DB_PATH.parent / f"telemetry_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    with closing(sqlite3.connect(backup_path)) as backup:
+        conn.backup(backup)
+
+
+# Ordered (step, needs_backup) pairs. PRAGMA user_version records how many
+# steps have been applied, so only append new ones; never reorder or edit
+# steps that have shipped. needs_backup, if set, is checked before the step's
+# transaction and a copy of the database is taken when it returns True.
+MIGRATIONS = [
+    (_create_telemetry, None),
+    (_drop_llm_family, _has_llm_family),
+    (_create_ingest_keys, None),
+    (_create_spool_loads, None),
+    (_create_sessions, None),
+    (_add_event_codes, None),
+    (_add_extracted_columns, None),
+    (_index_sessions_by_start, None),
+    (_create_event_rollup, None),
+    (_index_session_filters, None),
+    (_create_event_search, None),
+    (_add_payload_codec, None),
+    (_create_payload_blobs, None),
+    (_release_blobs_on_strip, None),
+    (_create_usage_rollups, None),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+# Steps of MIGRATIONS that change SHARD_TABLES. A shard is created with
+# main's definitions of the day and records its own user_version, so these
+# steps also run on every shard file; they may only touch SHARD_TABLES.
+SHARD_STEPS = set()
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _apply_migrations(conn, shard=False):
+    while (version := schema_version(conn)) < SCHEMA_VERSION:
+        step, needs_backup = MIGRATIONS[version]
+        if shard:
+            step, needs_backup = (step if step in SHARD_STEPS else None), None
+        if needs_backup is not None and needs_backup(conn):
+            _backup(conn)
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) == version:
+                if step is not None:
+                    step(conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def _migrate_shard(path):
+    with closing(sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)) as shard:
+        shard.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        _apply_migrations(shard, shard=True)
+
+
+def migrate(conn):
+    """Applies pending MIGRATIONS, each in its own transaction, then SHARD_STEPS to each shard.
+
+    Backups are taken before the write lock is acquired (the backup API cannot
+    read a database its own connection holds locked). The version is then
+    re-read under the lock so concurrent hooks racing to migrate apply each
+    step exactly once.
+    """
+    _apply_migrations(conn)
+    base = database_path(conn)
+    for month in shard_months(base=base):
+        _migrate_shard(shard_path(month, base))
+
+
+def connect():
+    """Opens telemetry.db in WAL mode, migrating it first if its schema is out of date.
+
+    On an up-to-date database this costs a few PRAGMA statements.
+    """
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    version = schema_version(conn)
+    if version == 0:
+        # Only takes effect on a new file, before journal_mode or a table writes to it
+        conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+        except sqlite3.OperationalError:
+            pass  # switching needs a moment without other connections; next connect retries
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.create_function("payload_json", 2, payload_text, deterministic=True)
+    if version < SCHEMA_VERSION:
+        migrate(conn)
+    return conn
+
+
+def connect_readonly(path=None, cache_mib=READ_CACHE_MIB, mmap_mib=READ_MMAP_MIB):
+    """Opens telemetry.db, or a snapshot of it at path, for reading only.
+
+    The schema is not migrated; the caller makes sure it is current. The
+    connection may be handed between threads as long as only one uses it at
+    a time, which is how the dashboard pools them.
+    """
+    path = Path(path or DB_PATH).resolve()
+    conn = sqlite3.connect(
+        f"{path.as_uri()}?mode=ro", uri=True, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+    )
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    # Attached shards are opened read-write; this keeps them read-only too
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA cache_size = {-cache_mib * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {mmap_mib * 1024 * 1024}")
+    conn.create_function("payload_json", 2, payload_text, deterministic=True)
+    return conn
+
+
+def _copy_database(source, dest):
+    """Copies source into dest with the backup API, replacing dest atomically when done.
+
+    One backup step reads the whole database in a single read transaction,
+    which in WAL mode never blocks writers (a stepwise copy would restart on
+    every concurrent commit). The copy uses a rollback journal, so it can be
+    opened read-only without -wal and -shm files.
+    """
+    partial_path = dest.with_name(dest.name + ".partial")
+    partial_path.unlink(missing_ok=True)
+    with closing(sqlite3.connect(partial_path)) as copy:
+        source.backup(copy)
+        copy.execute("PRAGMA journal_mode = DELETE")
+    os.replace(partial_path, dest)
+
+
+def _modified(path):
+    # Opening a database can leave an empty -wal file behind; only commits write to it
+    modified = path.stat().st_mtime_ns
+    wal = Path(f"{path}-wal")
+    if wal.exists() and wal.stat().st_size:
+        modified = max(modified, wal.stat().st_mtime_ns)
+    return modified
+
+
+def snapshot(dest_dir=None):
+    """Copies telemetry.db and its monthly shards into dest_dir and returns the copy of telemetry.db.
+
+    dest_dir defaults to data/snapshot/. A shard's copy is stamped with the
+    shard's modification time, so shards unchanged since (finished months)
+    are not copied again. Readers that have the previous copy open keep
+    reading it until they reconnect.
+    """
+    dest_dir = Path(dest_dir or DB_PATH.parent / SNAPSHOT_DIR_NAME)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    dest = dest_dir / DB_PATH.name
+    with closing(connect()) as conn:
+        _copy_database(conn, dest)
+
+    months = shard_months()
+    for month in months:
+        source, copy = shard_path(month), shard_path(month, dest)
+        modified = _modified(source)
+        if copy.exists() and copy.stat().st_mtime_ns >= modified:
+            continue
+        with closing(connect_readonly(source)) as conn:
+            _copy_database(conn, copy)
+        os.utime(copy, ns=(modified, modified))
+    for month in set(shard_months(base=dest)) - set(months):
+        shard_path(month, dest).unlink()
+    return dest
+
+
+def _is_busy(error):
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def record_health(kind, **details):
+    """Appends one contention event ("retried" or "dropped") to the health log.
+
+    A single O_APPEND write, so it works even when the database is locked.
+    """
+    line = json.dumps({"ts": datetime.now().isoformat(timespec="seconds"), "kind": kind, **details})
+    try:
+        fd = os.open(DB_PATH.parent / HEALTH_LOG_NAME, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode() + b"\n")
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def with_write_retry(write, describe=""):
+    """Runs write() with bounded, jittered retries on SQLITE_BUSY.
+
+    busy_timeout already waits for the lock; this covers the cases it cannot
+    (a WAL snapshot going stale, a writer holding the lock past the timeout).
+    Retries and final failures are recorded with record_health(), along with
+    the milliseconds spent in failed attempts and backoff (waited_ms).
+    """
+    started = time.monotonic()
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        attempt_started = time.monotonic()
+        try:
+            result = write()
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+            if attempt == WRITE_ATTEMPTS:
+                waited_ms = round((time.monotonic() - started) * 1000)
+                record_health("dropped", attempts=attempt, event=describe, error=str(e), waited_ms=waited_ms)
+                raise
+            time.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1) * (0.5 + random.random()))
+        else:
+            if attempt > 1:
+                waited_ms = round((attempt_started - started) * 1000)
+                record_health("retried", attempts=attempt, event=describe, waited_ms=waited_ms)
+            return result
+
+
+def health():
+    """Summarizes the health log and the database's journaling state."""
+    counts = {"retried": 0, "dropped": 0}
+    last = {}
+    log_path = DB_PATH.parent / HEALTH_LOG_NAME
+    if log_path.exists():
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                counts[entry["kind"]] = counts.get(entry["kind"], 0) + 1
+                last[entry["kind"]] = entry
+
+    report = {"counts": counts, "last": last, "log": str(log_path)}
+    if DB_PATH.exists():
+        with closing(connect()) as conn:
+            report["journal_mode"] = conn.execute("PRAGMA journal_mode").fetchone()[0]
+            report["schema_version"] = schema_version(conn)
+            report["db_bytes"] = DB_PATH.stat().st_size
+        wal_path = DB_PATH.with_name(DB_PATH.name + "-wal")
+        report["wal_bytes"] = wal_path.stat().st_size if wal_path.exists() else 0
+    return report
 
 
 def init_db():
     """Initializes the SQLite database and runs any pending migrations."""
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    connect().close()
+
+
+def agent_family(agent):
+    """The agent family to record for a hook event: FAMILY_ENV if set, else agent."""
+    return os.environ.get(FAMILY_ENV) or agent
+
+
+# With storage.shard_by_month set, raw events (telemetry, with its search
+# index and blobs) go to one file per month next to DB_PATH, while sessions,
+# the rollup and the other small tables stay in DB_PATH. A shard takes the
+# events ingested in its month and is never written again afterwards, so old
+# shards can be archived or copied away on their own. Shard ids start at
+# YYYYMM * SHARD_ID_SPAN, so they sort after older events and name their shard.
+SHARD_TABLES = ("telemetry", "event_search", "payload_blobs")
+SHARD_ID_SPAN = 10 ** 10
+
 
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS telemetry (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                session_id TEXT,
-                event_type TEXT,
-                model TEXT,
-                raw_payload JSON
+def shard_path(month, base=None):
+    """The shard file for month ("YYYY-MM"), next to base (telemetry.db by default)."""
+    base = Path(base or DB_PATH)
+    return base.with_name(f"{base.stem}-{month}{base.suffix}")
+
+
+def _shard_schema(month):
+    return "shard_" + month.replace("-", "_")
+
+
+def _next_month(month):
+    year, number = map(int, month.split("-"))
+    return f"{year + number // 12}-{number % 12 + 1:02d}"
+
+
+def shard_months(start=None, end=None, base=None):
+    """Months with a shard file that may hold events timestamped from start to end, oldest first.
+
+    start and end are timestamps or dates. Events can be ingested after
+    their month ends (spooled ones), so the month after end is included.
+    """
+    base = Path(base or DB_PATH)
+    prefix = f"{base.stem}-"
+    months = sorted(
+        path.stem[len(prefix):] for path in base.parent.glob(f"{prefix}????-??{base.suffix}")
+    )
+    last = _next_month(end[:7]) if end else None
+    return [m for m in months if (not start or m >= start[:7]) and (not last or m <= last)]
+
+
+def _attached(conn):
+    return {row[1] for row in conn.execute("PRAGMA database_list")}
+
+
+def database_path(conn):
+    """The file conn opened as main: telemetry.db, or a snapshot of it."""
+    return next(Path(row[2]) for row in conn.execute("PRAGMA database_list") if row[1] == "main")
+
+
+def _create_shard(conn, path, month):
+    # The shard copies main's current definitions of the tables it takes over
+    ddl = [row[0] for row in conn.execute(f"""
+        SELECT sql FROM main.sqlite_master
+        WHERE tbl_name IN ({', '.join('?' * len(SHARD_TABLES))}) AND sql IS NOT NULL
+        ORDER BY type != 'table', rowid
+    """, SHARD_TABLES)]
+    with closing(sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)) as shard:
+        shard.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+        shard.execute("PRAGMA journal_mode = WAL")
+        shard.execute("BEGIN IMMEDIATE")
+        if not shard.execute("SELECT 1 FROM sqlite_master WHERE name = 'telemetry'").fetchone():
+            for sql in ddl:
+                shard.execute(sql)
+            shard.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('telemetry', ?)",
+                (int(month.replace("-", "")) * SHARD_ID_SPAN,),
             )
-        """)
-        conn.commit()
+            shard.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        shard.commit()
+
+
+def attach_shard(conn, month, create=False):
+    """Attaches month's shard to conn and returns its schema name.
+
+    Returns None if the shard does not exist, unless create is set. A shard
+    on an older schema version is migrated first (see SHARD_STEPS).
+    ATTACH cannot run inside a transaction.
+    """
+    schema = _shard_schema(month)
+    if schema in _attached(conn):
+        return schema
+    path = shard_path(month, database_path(conn))
+    if not path.exists():
+        if not create:
+            return None
+        _create_shard(conn, path, month)
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+    if conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0] < SCHEMA_VERSION:
+        # Missed by a migrate() that stopped before reaching it
+        conn.execute(f"DETACH DATABASE {schema}")
+        _migrate_shard(path)
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (str(path),))
+    return schema
+
+
+def event_schema(conn, event_id):
+    """Attaches the shard holding event_id, if any, and returns the schema to read it from."""
+    if event_id < SHARD_ID_SPAN:
+        return "main"
+    month = str(event_id // SHARD_ID_SPAN)
+    return attach_shard(conn, f"{month[:4]}-{month[4:]}") or "main"
+
+
+def route(conn, storage=None):
+    """The schema new events are written to: main, or this month's shard if storage.shard_by_month is set.
+
+    Switching to a new month's shard detaches the previous one, so a
+    long-lived connection keeps one shard attached. Inside a transaction,
+    where nothing can be attached, the shard already attached is kept.
+    """
+    if not (storage or {}).get("shard_by_month"):
+        return "main"
+    month = datetime.now(timezone.utc).strftime("%Y-%m")
+    attached = _attached(conn)
+    if _shard_schema(month) in attached:
+        return _shard_schema(month)
+    shards = sorted(schema for schema in attached if schema.startswith("shard_"))
+    if conn.in_transaction:
+        return shards[-1] if shards else "main"
+    for schema in shards:
+        conn.execute(f"DETACH DATABASE {schema}")
+    return attach_shard(conn, month, create=True)
+
+
+@contextmanager
+def _shards_attached(conn, months):
+    before = _attached(conn)
+    schemas = [attach_shard(conn, month) for month in months]
+    try:
+        yield schemas
+    finally:
+        for schema in schemas:
+            if schema not in before:
+                conn.execute(f"DETACH DATABASE {schema}")
+
+
+@contextmanager
+def telemetry_schemas(conn, start=None, end=None):
+    """Attaches the shards that may hold events from start to end for the duration of the block.
+
+    Yields the schema names to read telemetry from: "main" first, then the
+    shards oldest first. At most MAX_ATTACHED_SHARDS (the newest) are
+    attached at once; each_telemetry_schema() visits any number of them.
+    """
+    months = shard_months(start, end, database_path(conn))
+    with _shards_attached(conn, months[-MAX_ATTACHED_SHARDS:]) as schemas:
+        yield ["main", *schemas]
 
-    migrate_schema()
 
+def each_telemetry_schema(conn, start=None, end=None):
+    """Yields "main" and then each shard from start to end, attaching one shard at a time."""
+    yield "main"
+    for month in shard_months(start, end, database_path(conn)):
+        with _shards_attached(conn, [month]) as schemas:
+            yield schemas[0]
 
-def get_model_for_session(session_id):
-    """Look up the model from the session_start record for this session_id."""
+
+def get_model_for_session(session_id, conn=None):
+    """Look up the first model recorded for this session_id in sessions.
+
+    A primary-key lookup, so its cost does not grow with the telemetry table.
+    Pass an open connection to reuse it (the ingest daemon keeps one warm).
+    """
     if not session_id:
         return None
-    if not DB_PATH.exists():
+    if conn is None:
+        if not DB_PATH.exists():
+            return None
+        with timings.phase("model"), closing(connect()) as own_conn:
+            return get_model_for_session(session_id, own_conn)
+    row = conn.execute(
+        "SELECT model FROM sessions WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+# Statements on the tables that move to monthly shards take the {schema} they write to
+INSERT_SQL = """
+    INSERT INTO {schema}.telemetry (
+        timestamp, session_id, event_type, event_code, model, raw_payload, payload_codec,
+        blob_refs, tool_name, cwd, repo, agent
+    )
+    VALUES (
+        COALESCE(:timestamp, CURRENT_TIMESTAMP), :session_id, :event_type,
+        (SELECT code FROM event_types WHERE name = :event_type), :model, :raw_payload, :payload_codec,
+        :blob_refs, :tool_name, :cwd, :repo, :agent
+    )
+"""
+REGISTER_EVENT_SQL = "INSERT OR IGNORE INTO event_types (name) VALUES (?)"
+SEARCH_INSERT_SQL = "INSERT INTO {schema}.event_search (rowid, text) VALUES (?, ?)"
+# Each indexed payload field is cut to this many characters
+SEARCH_FIELD_CHARS = 2000
+# Hook payload values larger than this are indexed from their encoded text
+# instead of being decoded, so a huge tool response is never parsed whole.
+SEARCH_DECODE_BYTES = 64 * 1024
+
+# Codecs for stored payloads as (compress, decompress), keyed by the tag kept
+# in telemetry.payload_codec
+PAYLOAD_CODECS = {"zlib": (zlib.compress, zlib.decompress)}
+# Defaults for the `storage` section of config.yaml
+DEFAULT_CODEC = "zlib"
+COMPRESS_MIN_BYTES = 4096
+DEDUP_MIN_BYTES = 1024
+# Payload fields that are stored once per distinct value, in payload_blobs
+BLOB_FIELDS = ("tool_input", "tool_response")
+BLOB_REF_SQL = "UPDATE {schema}.payload_blobs SET refcount = refcount + 1 WHERE hash = ?"
+BLOB_INSERT_SQL = "INSERT INTO {schema}.payload_blobs (hash, data, codec, refcount) VALUES (?, ?, ?, 1)"
+
+
+def payload_json_sql(schema="main"):
+    """SQL expression for the full payload JSON of a row of schema's telemetry, blob references resolved."""
+    sql = "payload_json(raw_payload, payload_codec)"
+    for key in BLOB_FIELDS:
+        ref = f"json_extract(blob_refs, '$.{key}')"
+        blob = f"(SELECT payload_json(data, codec) FROM {schema}.payload_blobs WHERE hash = {ref})"
+        sql = f"CASE WHEN {ref} IS NULL THEN {sql} ELSE json_set({sql}, '$.{key}', json({blob})) END"
+    return sql
+
+SESSION_UPSERT_SQL = """
+    INSERT INTO sessions (
+        session_id, agent, model, cwd, repo, first_ts, last_ts,
+        event_count, prompt_count, tool_count, permission_count
+    )
+    VALUES (
+        :session_id, :agent, NULLIF(:model, ''), :cwd, :repo,
+        COALESCE(:timestamp, CURRENT_TIMESTAMP), COALESCE(:timestamp, CURRENT_TIMESTAMP),
+        1, :prompts, :tools, :permissions
+    )
+    ON CONFLICT (session_id) DO UPDATE SET
+        agent = COALESCE(agent, excluded.agent),
+        model = COALESCE(model, excluded.model),
+        cwd = COALESCE(excluded.cwd, cwd),
+        repo = COALESCE(excluded.repo, repo),
+        first_ts = MIN(first_ts, excluded.first_ts),
+        last_ts = MAX(last_ts, excluded.last_ts),
+        event_count = event_count + 1,
+        prompt_count = prompt_count + excluded.prompt_count,
+        tool_count = tool_count + excluded.tool_count,
+        permission_count = permission_count + excluded.permission_count
+"""
+
+# Runs before SESSION_UPSERT_SQL: a session starts with the first event that
+# finds no sessions row (within a batch, the first one carrying its id).
+ROLLUP_UPSERT_SQL = """
+    INSERT INTO event_rollup (hour, agent, model, repo, event_code, events, sessions_started)
+    VALUES (
+        strftime('%Y-%m-%d %H:00:00', COALESCE(:timestamp, CURRENT_TIMESTAMP)),
+        COALESCE(:agent, ''), COALESCE(:model, ''), COALESCE(:repo, ''),
+        (SELECT code FROM event_types WHERE name = :event_type),
+        1,
+        :session_id IS NOT NULL AND :first_in_batch
+            AND NOT EXISTS (SELECT 1 FROM sessions WHERE session_id = :session_id)
+    )
+    ON CONFLICT (hour, agent, model, repo, event_code) DO UPDATE SET
+        events = events + 1,
+        sessions_started = sessions_started + excluded.sessions_started
+"""
+
+
+# Also run for each inserted event; the WHERE clause skips events they do not count
+TOOL_ROLLUP_UPSERT_SQL = """
+    INSERT INTO tool_rollup (tool_name, session_id, calls)
+    SELECT :tool_name, COALESCE(:session_id, ''), 1
+    WHERE :tools AND :tool_name IS NOT NULL
+    ON CONFLICT (tool_name, session_id) DO UPDATE SET calls = calls + 1
+"""
+REPO_ROLLUP_UPSERT_SQL = """
+    INSERT INTO repo_rollup (repo, session_id, tool_calls)
+    SELECT COALESCE(:repo, 'unknown'), COALESCE(:session_id, ''), :tools
+    WHERE :cwd IS NOT NULL
+    ON CONFLICT (repo, session_id) DO UPDATE SET tool_calls = tool_calls + excluded.tool_calls
+"""
+
+
+def claim_ingest_key(conn, key):
+    """Records key as ingested; False if an earlier insert already claimed it.
+
+    Hooks that sent an event to ingestd without getting an acknowledgement
+    pass the event's key to their fallback insert, so an event the daemon
+    committed late is not stored twice. Must run in the insert's transaction.
+    """
+    return conn.execute("INSERT OR IGNORE INTO ingest_keys (key) VALUES (?)", (key,)).rowcount == 1
+
+
+def prune_ingest_keys(conn, max_age_seconds):
+    """Forgets keys older than max_age_seconds (keys sort by creation time)."""
+    conn.execute("DELETE FROM ingest_keys WHERE key < ?", (f"{int(time.time() - max_age_seconds):010x}",))
+
+
+def repo_name(cwd):
+    """The repository a working directory belongs to, as shown on the dashboard."""
+    return (Path(cwd).name or None) if cwd else None
+
+
+def _text(payload, key):
+    value = payload.get(key) if isinstance(payload, Mapping) else None
+    return value if isinstance(value, str) else None
+
+
+_JSON_ESCAPE = re.compile(r'\\[nrt"\\/bf]')
+
+
+def _search_text(payload):
+    """The text indexed for search: prompts, tool input/output and assistant replies."""
+    if not isinstance(payload, Mapping):
         return None
-    with sqlite3.connect(DB_PATH) as conn:
+    parts = [payload.get(key) for key in ("prompt", "message", "last_assistant_message", "tool_name")]
+    for key in ("tool_input", "tool_response"):
+        if isinstance(payload, RawPayload) and payload.size(key) > SEARCH_DECODE_BYTES:
+            parts.append(_JSON_ESCAPE.sub(" ", payload.head(key, SEARCH_FIELD_CHARS)))
+            continue
+        value = payload.get(key)
+        parts.extend(value.values() if isinstance(value, dict) else [value])
+    text = "\n".join(part[:SEARCH_FIELD_CHARS] for part in parts if isinstance(part, str) and part)
+    return text or None
+
+
+def _truncate_payload(payload, limit):
+    """Shortens a payload's largest top-level values until its JSON fits in limit bytes.
+
+    A shortened value is replaced by the start of its text, and the original
+    encoded sizes are recorded under "cubicle_truncated".
+    """
+    encoded = {key: json.dumps(value) for key, value in payload.items()}
+    truncated = payload["cubicle_truncated"] = {}
+    for key in sorted(encoded, key=lambda key: len(encoded[key]), reverse=True):
+        if len(json.dumps(payload)) <= limit:
+            break
+        truncated[key] = len(encoded[key])
+        excess = len(json.dumps(payload)) - limit
+        text = payload[key] if isinstance(payload[key], str) else encoded[key]
+        budget = len(json.dumps(payload[key])) - excess
+        keep = budget
+        while keep > 0 and len(json.dumps(text[:keep])) > budget:
+            keep -= len(json.dumps(text[:keep])) - budget
+        payload[key] = text[:max(keep, 0)]
+    return json.dumps(payload)
+
+
+def _compress(text, storage):
+    """(stored, codec) for JSON text: compressed if it is big enough and that helps."""
+    data = text.encode()
+    codec = storage.get("codec", DEFAULT_CODEC)
+    if codec and len(data) >= storage.get("compress_min_bytes", COMPRESS_MIN_BYTES):
+        compressed = PAYLOAD_CODECS[codec][0](data)
+        if len(compressed) < len(data):
+            return compressed, codec
+    return text, None
+
+
+def _encoded_field(payload, key):
+    return payload.encoded(key) if isinstance(payload, RawPayload) else json.dumps(payload[key])
+
+
+def encode_payload(payload, event_type, storage=None):
+    """The (raw_payload, payload_codec, blobs) stored for a payload under the storage config.
+
+    storage is the `storage` section of config.yaml: payloads over
+    max_payload_bytes[event_type] are truncated, BLOB_FIELDS of at least
+    dedup_min_bytes are moved out to blobs (field -> JSON text, stored once
+    in payload_blobs), and what remains is compressed with codec if it has at
+    least compress_min_bytes and that makes it smaller.
+    """
+    storage = storage or {}
+    text = payload.text() if isinstance(payload, RawPayload) else json.dumps(payload)
+    if not isinstance(payload, Mapping):
+        return _compress(text, storage) + ({},)
+
+    limit = (storage.get("max_payload_bytes") or {}).get(event_type)
+    if limit and len(text) > limit:
+        text = _truncate_payload(dict(payload), limit)
+        payload = json.loads(text)
+
+    blobs = {}
+    dedup_min = storage.get("dedup_min_bytes", DEDUP_MIN_BYTES)
+    if dedup_min:
+        for key in BLOB_FIELDS:
+            if key in payload:
+                encoded = _encoded_field(payload, key)
+                if len(encoded) >= dedup_min:
+                    blobs[key] = encoded
+    if blobs:
+        text = json.dumps({key: payload[key] for key in payload if key not in blobs})
+    return _compress(text, storage) + (blobs,)
+
+
+def payload_text(raw_payload, payload_codec):
+    """The JSON text of a stored payload. Registered on connections as SQL payload_json()."""
+    if payload_codec is None or raw_payload is None:
+        return raw_payload
+    return PAYLOAD_CODECS[payload_codec][1](raw_payload).decode()
+
+
+def load_payload(raw_payload, payload_codec, blob_refs=None, conn=None, schema="main"):
+    """A stored payload decoded to Python objects.
+
+    Fields moved out to payload_blobs are read back through conn, from the
+    schema the row was read from.
+    """
+    payload = json.loads(payload_text(raw_payload, payload_codec))
+    for key, digest in json.loads(blob_refs or "{}").items():
         row = conn.execute(
-            "SELECT model FROM telemetry WHERE session_id = ? AND event_type = 'session_start' AND model IS NOT NULL LIMIT 1",
-            (session_id,)
+            f"SELECT data, codec FROM {schema}.payload_blobs WHERE hash = ?", (digest,)
         ).fetchone()
-    return row[0] if row else None
+        payload[key] = load_payload(*row)
+    return payload
 
 
-def insert_telemetry(session_id, event_type, model, raw_payload):
-    """Inserts a telemetry record into the database."""
-    init_db()
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "INSERT INTO telemetry (session_id, event_type, model, raw_payload) VALUES (?, ?, ?, ?)",
-            (session_id, event_type, model, json.dumps(raw_payload))
-        )
+def _insert_params(session_id, event_type, model, raw_payload, timestamp=None, agent=None, storage=None):
+    """Named parameters for INSERT_SQL and SESSION_UPSERT_SQL."""
+    event_type = canonical_event(event_type)
+    cwd = _text(raw_payload, "cwd")
+    stored, codec, blobs = encode_payload(raw_payload, event_type, storage)
+    return {
+        "timestamp": timestamp,
+        "session_id": session_id,
+        "event_type": event_type,
+        "model": model,
+        "raw_payload": stored,
+        "payload_codec": codec,
+        "blobs": blobs,
+        "blob_refs": None,
+        "storage": storage or {},
+        "tool_name": _text(raw_payload, "tool_name"),
+        "cwd": cwd,
+        "repo": repo_name(cwd),
+        "agent": agent,
+        "prompts": int(event_type == "user_prompt_submit"),
+        "tools": int(event_type == "pre_tool_use"),
+        "permissions": int(event_type == "permission_request"),
+        "first_in_batch": True,
+        "search_text": _search_text(raw_payload),
+    }
+
+
+def _store_blobs(conn, params, schema):
+    """Adds a reference to each of the row's blobs, storing the ones not seen before."""
+    refs = {key: hashlib.sha256(text.encode()).hexdigest() for key, text in params["blobs"].items()}
+    # The same content under two fields counts as one reference
+    texts = {digest: params["blobs"][key] for key, digest in refs.items()}
+    for digest, text in texts.items():
+        if not conn.execute(BLOB_REF_SQL.format(schema=schema), (digest,)).rowcount:
+            conn.execute(BLOB_INSERT_SQL.format(schema=schema), (digest, *_compress(text, params["storage"])))
+    params["blob_refs"] = json.dumps(refs)
+
+
+def _insert_row(conn, params, schema="main"):
+    if params["blobs"]:
+        _store_blobs(conn, params, schema)
+    event_id = conn.execute(INSERT_SQL.format(schema=schema), params).lastrowid
+    if params["search_text"]:
+        conn.execute(SEARCH_INSERT_SQL.format(schema=schema), (event_id, params["search_text"]))
+
+
+def insert_telemetry(
+    session_id, event_type, model, raw_payload, timestamp=None, agent=None, ingest_key=None,
+    conn=None, storage=None
+):
+    """Inserts a telemetry record into the database and updates its session and rollup rows.
+
+    Without a connection a fresh one is opened (and the schema migrated if
+    needed) for this one insert. timestamp defaults to the insert time and is
+    only passed for events recorded earlier (spool). agent is the agent family
+    stored on the session. With an ingest_key the insert is skipped if that
+    key was already claimed (see claim_ingest_key). storage is the `storage`
+    section of config.yaml (see encode_payload).
+    """
+    if conn is None:
+        with timings.phase("connect"):
+            own_conn = connect()
+        with closing(own_conn):
+            insert_telemetry(
+                session_id, event_type, model, raw_payload, timestamp, agent, ingest_key, own_conn,
+                storage
+            )
+        return
+
+    with timings.phase("encode"):
+        params = _insert_params(session_id, event_type, model, raw_payload, timestamp, agent, storage)
+    schema = route(conn, storage)
+
+    def write():
+        try:
+            if ingest_key is None or claim_ingest_key(conn, ingest_key):
+                if params["event_type"] not in _EVENT_CODES:
+                    conn.execute(REGISTER_EVENT_SQL, (params["event_type"],))
+                _insert_row(conn, params, schema)
+                conn.execute(ROLLUP_UPSERT_SQL, params)
+                conn.execute(TOOL_ROLLUP_UPSERT_SQL, params)
+                conn.execute(REPO_ROLLUP_UPSERT_SQL, params)
+                if session_id is not None:
+                    conn.execute(SESSION_UPSERT_SQL, params)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    with timings.phase("write"):
+        with_write_retry(write, describe=f"{event_type} {session_id}")
+
+
+def insert_many(records, conn, storage=None):
+    """Bulk-inserts insert_telemetry() keyword dicts, batching the session and rollup updates.
+
+    Does not commit, so callers can fold many batches into one transaction.
+    """
+    params = [_insert_params(**record, storage=storage) for record in records]
+    schema = route(conn, storage)
+    seen = set()
+    for p in params:
+        p["first_in_batch"] = p["session_id"] not in seen
+        seen.add(p["session_id"])
+    unregistered = {p["event_type"] for p in params} - _EVENT_CODES.keys()
+    conn.executemany(REGISTER_EVENT_SQL, [(name,) for name in sorted(unregistered)])
+    for p in params:
+        _insert_row(conn, p, schema)  # row by row: each event's search entry needs its id
+    conn.executemany(ROLLUP_UPSERT_SQL, params)
+    conn.executemany(TOOL_ROLLUP_UPSERT_SQL, params)
+    conn.executemany(REPO_ROLLUP_UPSERT_SQL, params)
+    conn.executemany(SESSION_UPSERT_SQL, [p for p in params if p["session_id"] is not None])
+
+
+def _fts_query(text):
+    # Every word must match; the last one may be a prefix (search as you type)
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search(conn, text, limit=20, mark=("[", "]")):
+    """Ranked full-text matches for text, best first, across main and every shard.
+
+    Returns (id, session_id, timestamp, event_type, tool_name, snippet) rows;
+    matched words in snippet are wrapped in mark.
+    """
+    query = _fts_query(text)
+    if not query:
+        return []
+    hits = []
+    for schema in each_telemetry_schema(conn):
+        hits.extend(conn.execute(f"""
+            SELECT bm25(event_search), t.id, t.session_id, t.timestamp, t.event_type, t.tool_name,
+                   snippet(event_search, 0, ?, ?, '…', 16)
+            FROM {schema}.event_search
+            JOIN {schema}.telemetry t ON t.id = event_search.rowid
+            WHERE event_search MATCH ?
+            ORDER BY bm25(event_search)
+            LIMIT ?
+        """, (mark[0], mark[1], query, limit)).fetchall())
+    return [tuple(hit)[1:] for hit in sorted(hits, key=lambda hit: hit[0])[:limit]]
+
+
+def _prune_batch(conn, schema, sql, ids):
+    marks = ", ".join("?" * len(ids))
+    try:
+        conn.execute(f"DELETE FROM {schema}.event_search WHERE rowid IN ({marks})", ids)
+        conn.execute(sql.format(schema=schema, ids=marks), ids)
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def _prune(conn, schema, days, sql, batch_size, where=""):
+    """Runs sql (formatted with the schema and the ?-marks of an id list) over events older than days.
+
+    Each batch of ids is its own transaction. Batches walk the primary key
+    rather than the timestamp order, since spooled events can carry
+    timestamps older than their ids suggest.
+    """
+    if days is None:
+        return 0
+    cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{days} days",)).fetchone()[0]
+    select = f"SELECT id FROM {schema}.telemetry WHERE id > ? AND timestamp < ? {where} ORDER BY id LIMIT ?"
+    done = 0
+    after_id = 0
+    while ids := [row[0] for row in conn.execute(select, (after_id, cutoff, batch_size))]:
+        with_write_retry(partial(_prune_batch, conn, schema, sql, ids), describe="retain")
+        done += len(ids)
+        after_id = ids[-1]
+    return done
+
+
+def _vacuum(conn, schema, step_pages, convert=False):
+    """Returns schema's free pages to the filesystem in steps; returns how many pages it shrank by.
+
+    Databases created before auto_vacuum was enabled cannot vacuum in steps.
+    They are skipped (None) unless convert is set, which switches them with
+    one full VACUUM: that rewrites the whole file and blocks every writer
+    while it runs.
+    """
+    pages = conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+    if conn.execute(f"PRAGMA {schema}.auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        if not convert:
+            return None
+        conn.execute(f"PRAGMA {schema}.auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+        conn.execute(f"VACUUM {schema}")
+    while free := conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0]:
+        conn.execute(f"PRAGMA {schema}.incremental_vacuum({step_pages})").fetchall()
+        if conn.execute(f"PRAGMA {schema}.freelist_count").fetchone()[0] >= free:
+            break
+    return pages - conn.execute(f"PRAGMA {schema}.page_count").fetchone()[0]
+
+
+def retain(
+    conn, strip_after_days=None, drop_after_days=None, batch_size=RETAIN_BATCH,
+    vacuum_step_pages=VACUUM_STEP_PAGES, convert_vacuum=False
+):
+    """Expires old raw events and returns the space they used to the filesystem.
+
+    Events older than strip_after_days keep their row and extracted columns
+    but lose their payload and search entry; events older than
+    drop_after_days are deleted. The sessions table and the rollups
+    (event_rollup, tool_rollup, repo_rollup) are maintained at insert time
+    and are left alone, so session totals and the Overview charts keep
+    their history. The Sessions page timeline, search and the error stats
+    read raw events and lose what is dropped. Work is done in short
+    transactions and incremental vacuum steps so hooks can keep writing
+    meanwhile. Monthly shards are visited one at a time after main.
+
+    Databases without incremental auto_vacuum are listed in "unvacuumed"
+    and keep their free pages, unless convert_vacuum is set (see _vacuum).
+
+    Returns {"stripped", "dropped", "freed_pages", "unvacuumed"}.
+    """
+    report = {"stripped": 0, "dropped": 0, "freed_pages": 0, "unvacuumed": []}
+    for schema in each_telemetry_schema(conn):
+        report["dropped"] += _prune(
+            conn, schema, drop_after_days, "DELETE FROM {schema}.telemetry WHERE id IN ({ids})", batch_size
+        )
+        report["stripped"] += _prune(conn, schema, strip_after_days, """
+            UPDATE {schema}.telemetry SET raw_payload = '{{}}', payload_codec = NULL, blob_refs = NULL
+            WHERE id IN ({ids})
+        """, batch_size, where="AND raw_payload != '{}'")
+        freed = _vacuum(conn, schema, vacuum_step_pages, convert_vacuum)
+        if freed is None:
+            report["unvacuumed"].append(schema)
+        else:
+            report["freed_pages"] += freed
+    return report
 
 
 if __name__ == "__main__":
@@ -0,0 +1,270 @@
+"""Streaming export of telemetry to partitioned Parquet or Arrow IPC files.
+
+`cubicle export DEST` reads telemetry.db and its monthly shards in keyset
+chunks of at most chunk_rows events (or CHUNK_BYTES of payload text), so
+memory stays flat however large the database is. Events are written as a
+Hive-partitioned dataset:
+
+    DEST/telemetry/date=2026-01-01/agent=claude/part-<first id>.parquet
+
+with the extracted columns (event type, tool, cwd, repo, model) and, with
+payloads=True, the full decoded payload JSON. The derived tables (sessions,
+event_rollup, event_types) are small and are rewritten whole on every run.
+
+DEST/_cubicle_export.json remembers the last exported id of main and of
+each shard, so the next run only appends the events that arrived since.
+Read the result with `pandas.read_parquet(DEST / "telemetry")` or
+`pyarrow.dataset.dataset(DEST / "telemetry", format=..., partitioning="hive")`.
+
+pyarrow is only needed here; install it with `pip install cubicle[export]`
+if streamlit did not already bring it in.
+"""
+import json
+import os
+import shutil
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+
+import db
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+CHUNK_ROWS = 50_000
+# A chunk also ends once its payload text reaches this size
+CHUNK_BYTES = 64 * 1024 * 1024
+# Partition files kept open at once; the least recently used is closed
+# (a partition seen again later gets a new part file)
+MAX_OPEN_WRITERS = 32
+STATE_FILE = "_cubicle_export.json"
+TELEMETRY_DIR = "telemetry"
+DERIVED_TABLES = ("sessions", "event_rollup", "event_types")
+# Telemetry columns exported, besides the date and agent partition keys
+TELEMETRY_COLUMNS = (
+    "id", "timestamp", "session_id", "event_type", "event_code", "model", "tool_name", "cwd", "repo",
+)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+PARTIAL_SUFFIX = ".partial"
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("cubicle export needs pyarrow: pip install 'cubicle[export]'") from None
+    return pa, pc, pq
+
+
+def _source(event_id):
+    """"main", or the month ("YYYY-MM") of the shard event_id was stored in; see db.SHARD_ID_SPAN."""
+    if event_id < db.SHARD_ID_SPAN:
+        return "main"
+    month = str(event_id // db.SHARD_ID_SPAN)
+    return f"{month[:4]}-{month[4:]}"
+
+
+def _arrow_type(pa, declared):
+    """The Arrow type for a column of SQLite's declared type, by SQLite's affinity rules."""
+    declared = (declared or "").upper()
+    if "INT" in declared:
+        return pa.int64()
+    if declared == "DATETIME":
+        return pa.timestamp("s")
+    if any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+        return pa.float64()
+    return pa.string()
+
+
+def _schema(pa, conn, table, columns=None, schema="main"):
+    declared = {row[1]: row[2] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+    return pa.schema([(name, _arrow_type(pa, declared[name])) for name in columns or declared])
+
+
+def _batch(pa, pc, schema, rows):
+    """A record batch of schema from rows (tuples in schema order); unparseable timestamps become null."""
+    arrays = []
+    for position, field in enumerate(schema):
+        values = [row[position] for row in rows]
+        if pa.types.is_timestamp(field.type):
+            text = pa.array(values, pa.string())
+            arrays.append(pc.strptime(text, format=TIMESTAMP_FORMAT, unit="s", error_is_null=True))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _Writer:
+    """One output file, written under a PARTIAL_SUFFIX name until close() puts it in place."""
+
+    def __init__(self, path, schema, fmt):
+        pa, _, pq = _pyarrow()
+        self.path = Path(path)
+        self.partial = self.path.with_name(self.path.name + PARTIAL_SUFFIX)
+        self.partial.parent.mkdir(parents=True, exist_ok=True)
+        if fmt == "parquet":
+            self._writer = pq.ParquetWriter(self.partial, schema, compression="zstd")
+        else:
+            self._writer = pa.ipc.new_file(str(self.partial), schema)
+
+    def write(self, batch):
+        if batch.num_rows:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+        os.replace(self.partial, self.path)
+
+
+class _Partitions:
+    """Open part files by (date, agent), at most MAX_OPEN_WRITERS at a time."""
+
+    def __init__(self, root, schema, fmt):
+        self.root = root
+        self.schema = schema
+        self.fmt = fmt
+        self.files = 0
+        self._open = OrderedDict()
+
+    def write(self, key, batch, first_id):
+        writer = self._open.pop(key, None)
+        if writer is None:
+            if len(self._open) >= MAX_OPEN_WRITERS:
+                self._open.popitem(last=False)[1].close()
+            date, agent = key
+            path = self.root / f"date={date}" / f"agent={agent}" / f"part-{first_id}{FORMATS[self.fmt]}"
+            writer = _Writer(path, self.schema, self.fmt)
+            self.files += 1
+        self._open[key] = writer
+        writer.write(batch)
+
+    def close(self):
+        while self._open:
+            self._open.popitem(last=False)[1].close()
+
+
+def _chunks(conn, schema, after, upto, payloads, chunk_rows):
+    """Yields lists of telemetry rows with after < id <= upto, in id order, one short read at a time."""
+    columns = ", ".join(TELEMETRY_COLUMNS)
+    payload = f", {db.payload_json_sql(schema)}" if payloads else ""
+    sql = f"""
+        SELECT COALESCE(substr(timestamp, 1, 10), 'unknown'), COALESCE(agent, 'unknown'), {columns}{payload}
+        FROM {schema}.telemetry
+        WHERE id > ? AND id <= ?
+        ORDER BY id
+        LIMIT ?
+    """
+    while True:
+        rows, size = [], 0
+        with closing(conn.execute(sql, (after, upto, chunk_rows))) as cursor:
+            for row in cursor:
+                rows.append(row)
+                size += len(row[-1] or "") if payloads else 0
+                if size >= CHUNK_BYTES:
+                    break
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][2]
+
+
+def _export_telemetry(pa, pc, conn, partitions, schema, after, payloads, chunk_rows):
+    """Appends the events of one database file after id `after`; returns (events, last id)."""
+    upto = conn.execute(f"SELECT MAX(id) FROM {schema}.telemetry").fetchone()[0]
+    exported = 0
+    if upto is None or upto <= after:
+        return exported, after
+    for rows in _chunks(conn, schema, after, upto, payloads, chunk_rows):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[:2], []).append(row[2:])
+        for key, group in groups.items():
+            partitions.write(key, _batch(pa, pc, partitions.schema, group), group[0][0])
+        exported += len(rows)
+    return exported, upto
+
+
+def _export_table(pa, pc, conn, table, dest, fmt, chunk_rows):
+    schema = _schema(pa, conn, table)
+    writer = _Writer(dest / f"{table}{FORMATS[fmt]}", schema, fmt)
+    rows = 0
+    try:
+        with closing(conn.execute(f"SELECT {', '.join(schema.names)} FROM main.{table}")) as cursor:
+            while True:
+                chunk = cursor.fetchmany(chunk_rows)
+                if not chunk:
+                    break
+                writer.write(_batch(pa, pc, schema, chunk))
+                rows += len(chunk)
+    except BaseException:
+        writer.partial.unlink(missing_ok=True)
+        raise
+    writer.close()
+    return rows
+
+
+def _load_state(dest, fmt, payloads, full):
+    path = dest / STATE_FILE
+    state = json.loads(path.read_text()) if path.exists() and not full else None
+    if state and (state["format"], state["payloads"]) != (fmt, payloads):
+        raise ValueError(
+            f"{dest} holds a {state['format']} export {'with' if state['payloads'] else 'without'} "
+            "payloads; export to another directory or start over with full=True (`cubicle export --full`)"
+        )
+    if state is None:
+        shutil.rmtree(dest / TELEMETRY_DIR, ignore_errors=True)
+        state = {"format": fmt, "payloads": payloads, "last_ids": {}}
+    return state
+
+
+def _discard_unrecorded(root, last_ids):
+    """Removes part files an interrupted run wrote past the recorded last ids."""
+    for path in root.glob("date=*/agent=*/part-*"):
+        if path.name.endswith(PARTIAL_SUFFIX):
+            path.unlink()
+            continue
+        first_id = int(path.name[len("part-"):].split(".")[0])
+        if first_id > last_ids.get(_source(first_id), 0):
+            path.unlink()
+
+
+def export(dest, fmt="parquet", payloads=False, full=False, chunk_rows=CHUNK_ROWS):
+    """Exports the events added since the last export to dest, and rewrites the derived tables.
+
+    fmt is "parquet" or "arrow" (Arrow IPC). payloads adds each event's full
+    payload JSON (codecs and blobs resolved) as a payload column. full
+    discards an earlier export in dest and starts from the first event.
+    Returns {"events": ..., "files": ..., "tables": {table: rows}, "last_ids": ...}.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    pa, pc, _ = _pyarrow()
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    state = _load_state(dest, fmt, payloads, full)
+    last_ids = state["last_ids"]
+    root = dest / TELEMETRY_DIR
+    _discard_unrecorded(root, last_ids)
+
+    db.init_db()  # brings an old database up to the exported schema
+    with closing(db.connect_readonly()) as conn:
+        schema = _schema(pa, conn, "telemetry", TELEMETRY_COLUMNS)
+        if payloads:
+            schema = schema.append(pa.field("payload", pa.string()))
+        partitions = _Partitions(root, schema, fmt)
+        events = 0
+        try:
+            months = db.shard_months(base=db.database_path(conn))
+            for source, telemetry_schema in zip(["main", *months], db.each_telemetry_schema(conn)):
+                exported, last_ids[source] = _export_telemetry(
+                    pa, pc, conn, partitions, telemetry_schema, last_ids.get(source, 0), payloads, chunk_rows
+                )
+                events += exported
+        finally:
+            partitions.close()
+        tables = {table: _export_table(pa, pc, conn, table, dest, fmt, chunk_rows) for table in DERIVED_TABLES}
+
+    partial = dest / (STATE_FILE + PARTIAL_SUFFIX)
+    partial.write_text(json.dumps(state, indent=2) + "\n")
+    os.replace(partial, dest / STATE_FILE)
+    return {"events": events, "files": partitions.files, "tables": tables, "last_ids": dict(last_ids)}
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Long-lived ingest daemon for Cubicle hook events.
+
+Hook scripts are short-lived processes, so every event pays for interpreter
+startup, parsing config.yaml and opening SQLite. When `cubicle ingestd` is
+running, the hooks instead forward their raw stdin over a Unix domain socket
+and the daemon inserts it using event mappings and a connection it keeps warm.
+If the daemon is not running, or does not confirm the insert, the hook falls
+back to inserting directly.
+"""
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+SOCKET_PATH = Path.home() / ".cubicle" / "data" / "ingestd.sock"
+CONFIG_PATH = Path.home() / ".cubicle" / "config.yaml"
+CLIENT_TIMEOUT = 1.0
+ACK = b"ok"
+# Ingest keys only need to outlive a client's wait for the acknowledgement
+INGEST_KEY_MAX_AGE = 600
+PRUNE_EVERY = 1000
+
+
+def new_ingest_key():
+    """Random key prefixed with the creation time, so old keys can be pruned by range."""
+    return f"{int(time.time()):010x}{os.urandom(8).hex()}"
+
+
+def forward(agent, cli_event, body):
+    """Sends one raw hook payload to a running daemon.
+
+    Returns (delivered, ingest_key). delivered is True once the daemon has
+    committed the event. Otherwise the caller inserts directly, passing
+    ingest_key along: it is set whenever the payload may have reached the
+    daemon, so a late commit on the daemon side cannot produce a duplicate.
+    """
+    if not SOCKET_PATH.exists():
+        return False, None
+    from db import agent_family
+
+    ingest_key = new_ingest_key()
+    header = {"agent": agent, "family": agent_family(agent), "event": cli_event, "key": ingest_key}
+    header = json.dumps(header).encode() + b"\n"
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            try:
+                sock.connect(str(SOCKET_PATH))
+            except OSError:
+                return False, None
+            sock.sendall(header + body)
+            sock.shutdown(socket.SHUT_WR)
+            return sock.recv(len(ACK)) == ACK, ingest_key
+    except OSError:
+        return False, ingest_key
+
+
+def is_running():
+    """True if a daemon is accepting connections on SOCKET_PATH."""
+    if not SOCKET_PATH.exists():
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(str(SOCKET_PATH))
+        return True
+    except OSError:
+        return False
+
+
+def load_hook_modules():
+    """Maps agent name to the hook module whose build_record() normalizes its payloads."""
+    import agy_hook
+    import claude_hook
+    import codex_hook
+
+    return {module.AGENT: module for module in (claude_hook, codex_hook, agy_hook)}
+
+
+def load_config():
+    import yaml
+
+    with open(CONFIG_PATH) as f:
+        return yaml.safe_load(f)
+
+
+def load_event_mappings(agents, cfg=None):
+    """Reads each agent's native -> cubicle event mapping from config.yaml."""
+    cfg = cfg or load_config()
+    return {agent: cfg["agents"][agent]["event_mapping"] for agent in agents}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # liveness probe from is_running()
+        header = json.loads(line)
+        body = self.rfile.read()
+        # Acknowledge only after the commit: a hook that gets no ACK falls back
+        # to its own insert, deduplicated by the ingest key.
+        self.server.ingest(header, body)
+        self.wfile.write(ACK)
+
+
+class IngestServer(socketserver.UnixStreamServer):
+    """Accepts forwarded hook payloads and inserts them over one connection."""
+
+    def __init__(self, socket_path, conn):
+        self.conn = conn
+        self.hooks = load_hook_modules()
+        cfg = load_config()
+        self.event_mappings = load_event_mappings(self.hooks, cfg)
+        self.storage = cfg.get("storage")
+        self.ingested = 0
+        super().__init__(str(socket_path), _Handler)
+
+    def ingest(self, header, body):
+        from db import insert_telemetry, prune_ingest_keys
+        from payload import RawPayload
+
+        hook = self.hooks[header["agent"]]
+        payload = RawPayload(body)
+        record = hook.build_record(
+            payload, header.get("event"), self.event_mappings[hook.AGENT], self.conn
+        )
+        # build_record() read the daemon's environment; the hook sent its own
+        record["agent"] = header.get("family") or hook.AGENT
+        insert_telemetry(**record, ingest_key=header.get("key"), conn=self.conn, storage=self.storage)
+
+        self.ingested += 1
+        if self.ingested % PRUNE_EVERY == 0:
+            with self.conn:
+                prune_ingest_keys(self.conn, INGEST_KEY_MAX_AGE)
+
+    def handle_error(self, request, client_address):
+        print(f"ingestd: failed to ingest event: {sys.exc_info()[1]!r}", file=sys.stderr, flush=True)
+
+
+def serve(socket_path=SOCKET_PATH):
+    """Runs the daemon in the foreground until SIGTERM/SIGINT."""
+    from db import connect
+
+    socket_path = Path(socket_path)
+    if is_running():
+        print(f"ingestd already listening on {socket_path}", file=sys.stderr)
+        return
+    if socket_path.exists():
+        socket_path.unlink()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    conn = connect()
+    server = IngestServer(socket_path, conn)
+    os.chmod(socket_path, 0o600)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f"ingestd listening on {socket_path}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        conn.close()
+        if socket_path.exists():
+            socket_path.unlink()
+
+
+if __name__ == "__main__":
+    serve()
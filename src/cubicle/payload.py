@@ -0,0 +1,158 @@
+"""Lazy access to a hook's raw JSON payload.
+
+Hook payloads can be megabytes (a PostToolUse carrying a whole file read),
+while a hook only needs a handful of top-level fields to route and index
+the event. RawPayload scans the top level of the original stdin bytes once,
+recording where each value starts and ends but skipping over nested values
+and strings with bytes.find(), and decodes a field only when it is read.
+The bytes themselves are stored verbatim, so nothing is re-serialized.
+Skipping only matches brackets and quotes, so the whole text is also checked
+with SQLite's json_valid(), which parses in C without building Python
+objects; a payload the dashboard's json_extract() could not read is never
+stored.
+"""
+import json
+import re
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_STRUCTURE = re.compile(rb'["{}\[\]]')
+_SCALAR = re.compile(rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?|true|false|null")
+_QUOTE = ord('"')
+_checker = threading.local()
+_BACKSLASH = ord("\\")
+
+
+def _skip_ws(raw, pos):
+    return _WHITESPACE.match(raw, pos).end()
+
+
+def _json_valid(raw):
+    conn = getattr(_checker, "conn", None)
+    if conn is None:
+        conn = _checker.conn = sqlite3.connect(":memory:")
+    # As text: SQLite reads a BLOB argument as its binary JSONB format
+    return conn.execute("SELECT json_valid(?)", (raw.decode("utf-8"),)).fetchone()[0] == 1
+
+
+def _string_end(raw, pos):
+    """Index just past the string that opens at pos."""
+    end = pos
+    while True:
+        end = raw.find(b'"', end + 1)
+        if end < 0:
+            raise ValueError(f"unterminated string at byte {pos}")
+        backslashes = 0
+        while raw[end - 1 - backslashes] == _BACKSLASH:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end + 1
+
+
+def _value_end(raw, pos):
+    """Index just past the JSON value that starts at pos, without decoding it."""
+    if pos >= len(raw):
+        raise ValueError("missing value")
+    first = raw[pos]
+    if first == _QUOTE:
+        return _string_end(raw, pos)
+    if first not in b"{[":
+        match = _SCALAR.match(raw, pos)
+        if match is None:
+            raise ValueError(f"invalid value at byte {pos}")
+        return match.end()
+
+    depth = 0
+    while True:
+        match = _STRUCTURE.search(raw, pos)
+        if match is None:
+            raise ValueError("unbalanced brackets")
+        pos = match.start()
+        char = raw[pos]
+        if char == _QUOTE:
+            pos = _string_end(raw, pos)
+            continue
+        depth += 1 if char in b"{[" else -1
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def scan(raw):
+    """Maps each top-level key of the JSON object in raw to its value's (start, end) span.
+
+    Raises ValueError if raw is not a single, well-formed JSON object.
+    """
+    spans = {}
+    pos = _skip_ws(raw, 0)
+    if raw[pos:pos + 1] != b"{":
+        raise ValueError("payload is not a JSON object")
+    pos = _skip_ws(raw, pos + 1)
+    if raw[pos:pos + 1] == b"}":
+        pos = _skip_ws(raw, pos + 1)
+    else:
+        while True:
+            if raw[pos:pos + 1] != b'"':
+                raise ValueError(f"expected a key at byte {pos}")
+            key_end = _string_end(raw, pos)
+            key = json.loads(raw[pos:key_end])
+            pos = _skip_ws(raw, key_end)
+            if raw[pos:pos + 1] != b":":
+                raise ValueError(f"expected ':' at byte {pos}")
+            start = _skip_ws(raw, pos + 1)
+            end = _value_end(raw, start)
+            spans[key] = (start, end)
+            pos = _skip_ws(raw, end)
+            separator = raw[pos:pos + 1]
+            pos = _skip_ws(raw, pos + 1)
+            if separator == b"}":
+                break
+            if separator != b",":
+                raise ValueError(f"expected ',' or '}}' at byte {pos}")
+    if pos != len(raw):
+        raise ValueError(f"trailing data at byte {pos}")
+    if not _json_valid(raw):
+        raise ValueError("malformed JSON inside a nested value")
+    return spans
+
+
+class RawPayload(Mapping):
+    """A hook payload kept as its original bytes; fields are decoded on first access."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.spans = scan(raw)
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        if key not in self._decoded:
+            start, end = self.spans[key]
+            self._decoded[key] = json.loads(self.raw[start:end])
+        return self._decoded[key]
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def size(self, key):
+        """Encoded size of a field's value in bytes (0 if absent)."""
+        start, end = self.spans.get(key, (0, 0))
+        return end - start
+
+    def encoded(self, key):
+        """A field's value as its original JSON text."""
+        start, end = self.spans[key]
+        return self.raw[start:end].decode("utf-8")
+
+    def head(self, key, limit):
+        """The first limit bytes of a field's encoded value, as text, without decoding it."""
+        start, end = self.spans.get(key, (0, 0))
+        return self.raw[start:min(end, start + limit)].decode("utf-8", "ignore")
+
+    def text(self):
+        """The payload as stored: the original JSON, decoded as UTF-8."""
+        return self.raw.decode("utf-8")
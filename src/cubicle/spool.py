@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Append-only spool for hook events, bulk loaded into telemetry.db.
+
+In spool mode (`ingest.mode: spool` in config.yaml) a hook never touches
+SQLite: it appends one framed record to a per-day file under
+~/.cubicle/data/spool/ with a single O_APPEND write. `cubicle ingest flush`
+later normalizes the spooled records and loads them with executemany in one
+transaction per file, so a busy or locked database cannot stall a tool call.
+
+Each frame is a JSON header line followed by the raw hook stdin:
+
+    {"agent": "claude", "family": "claude", "event": null, "ts": "2026-01-01 12:00:00", "len": 123}\\n
+    <len bytes of payload>\\n
+"""
+import fcntl
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from db import agent_family, claim_ingest_key, connect, insert_many, route
+from ingestd import load_config, load_event_mappings, load_hook_modules
+from payload import RawPayload
+
+SPOOL_DIR = Path.home() / ".cubicle" / "data" / "spool"
+SPOOL_SUFFIX = ".spool"
+CLAIMED_SUFFIX = ".flushing"
+REJECTED_SUFFIX = ".rejected"
+FLUSH_LOCK = ".flush.lock"
+BATCH_SIZE = 1000
+
+
+def enabled(cfg):
+    """True if config.yaml routes hook events through the spool."""
+    return (cfg.get("ingest") or {}).get("mode") == "spool"
+
+
+def _timestamp():
+    # Same format as SQLite's CURRENT_TIMESTAMP so spooled rows sort with direct inserts
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def append(agent, cli_event, body, ingest_key=None):
+    """Appends one raw hook payload to today's spool file.
+
+    ingest_key is only set when the event may also have reached ingestd.
+    """
+    header = {
+        "agent": agent,
+        "family": agent_family(agent),
+        "event": cli_event,
+        "ts": _timestamp(),
+        "len": len(body),
+    }
+    if ingest_key:
+        header["key"] = ingest_key
+    header = json.dumps(header)
+    frame = header.encode() + b"\n" + body + b"\n"
+
+    SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    path = SPOOL_DIR / f"{datetime.now(timezone.utc):%Y-%m-%d}{SPOOL_SUFFIX}"
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # A flush renames the file and then takes LOCK_EX on it; holding LOCK_SH
+            # and re-checking the inode guarantees we never write to a claimed file.
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                written = os.write(fd, frame)
+                if written != len(frame):
+                    raise OSError(f"short write to {path}: {written} of {len(frame)} bytes")
+                return
+        finally:
+            os.close(fd)
+
+
+def _read_frame(f, line):
+    """Parses the frame whose header is line, or returns None if it is not one."""
+    try:
+        header = json.loads(line)
+        body = f.read(header["len"])
+        if len(body) == header["len"] and f.read(1) == b"\n":
+            return header, body
+    except (ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def read_frames(f, rejected):
+    """Yields (header, body) for each complete frame.
+
+    Bytes that do not form a frame (a torn write, corruption) are appended to
+    rejected and reading resumes at the next line that starts a valid frame,
+    so one bad record never costs the frames after it.
+    """
+    bad_start = None
+    while True:
+        start = f.tell()
+        line = f.readline()
+        if not line:
+            break
+        frame = _read_frame(f, line)
+        if frame is None:
+            if bad_start is None:
+                bad_start = start
+            f.seek(start + len(line))
+            continue
+        if bad_start is not None:
+            end = f.tell()
+            f.seek(bad_start)
+            rejected.append(f.read(start - bad_start))
+            f.seek(end)
+            bad_start = None
+        yield frame
+
+    if bad_start is not None:
+        f.seek(bad_start)
+        rejected.append(f.read())
+
+
+def _claim():
+    """Renames spool files out of the appenders' way and returns them oldest first.
+
+    Claimed names are unique, so spool_loads can record which ones were
+    committed. Files left claimed by a crashed flush are picked up again.
+    """
+    for path in SPOOL_DIR.glob(f"*{SPOOL_SUFFIX}"):
+        path.rename(path.with_name(f"{path.name}.{time.time_ns()}{CLAIMED_SUFFIX}"))
+    return sorted(SPOOL_DIR.glob(f"*{SPOOL_SUFFIX}.*{CLAIMED_SUFFIX}"))
+
+
+def _records(frames, hooks, event_mappings, conn, rejected):
+    # Hooks resolve missing models from the sessions table, which does not see
+    # the batch that is still being collected, so remember models here too.
+    session_models = {}
+    for header, body in frames:
+        try:
+            hook = hooks[header["agent"]]
+            record = hook.build_record(
+                RawPayload(body), header.get("event"), event_mappings[hook.AGENT], conn
+            )
+        except (ValueError, KeyError, AttributeError):
+            rejected.append(json.dumps(header).encode() + b"\n" + body + b"\n")
+            continue
+        if header.get("key") and not claim_ingest_key(conn, header["key"]):
+            continue  # ingestd committed it after the hook gave up waiting
+        record["timestamp"] = header["ts"]
+        record["agent"] = header.get("family") or hook.AGENT
+        if record["model"]:
+            session_models.setdefault(record["session_id"], record["model"])
+        else:
+            record["model"] = session_models.get(record["session_id"])
+        yield record
+
+
+def _save_rejected(path, rejected):
+    rejected_path = path.with_name(path.name.replace(CLAIMED_SUFFIX, REJECTED_SUFFIX))
+    with open(rejected_path, "ab") as out:
+        out.write(rejected)
+    print(f"Kept {len(rejected)} unloadable spool bytes in {rejected_path}", file=sys.stderr)
+
+
+def _load_file(path, conn, hooks, event_mappings, storage, batch_size):
+    """Loads one claimed file in a single transaction that also records it in spool_loads.
+
+    A file that is already recorded was committed by a flush that died before
+    deleting it, so it is only removed.
+    """
+    if conn.execute("SELECT 1 FROM spool_loads WHERE file = ?", (path.name,)).fetchone():
+        path.unlink()
+        return 0
+
+    loaded = 0
+    rejected = []
+    route(conn, storage)  # attaches this month's shard, which cannot happen mid-transaction
+    with open(path, "rb") as f:
+        # Wait for appenders that opened the file before it was renamed
+        fcntl.flock(f, fcntl.LOCK_EX)
+        batch = []
+        with conn:
+            frames = read_frames(f, rejected)
+            for record in _records(frames, hooks, event_mappings, conn, rejected):
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    insert_many(batch, conn, storage)
+                    loaded += len(batch)
+                    batch = []
+            insert_many(batch, conn, storage)
+            loaded += len(batch)
+            conn.execute("INSERT INTO spool_loads (file) VALUES (?)", (path.name,))
+            if rejected:
+                _save_rejected(path, b"".join(rejected))
+
+    path.unlink()
+    return loaded
+
+
+def flush(batch_size=BATCH_SIZE):
+    """Loads all spooled events into telemetry and removes what was committed.
+
+    Returns the number of events loaded, or 0 if another flush is running.
+    """
+    if not SPOOL_DIR.exists():
+        return 0
+
+    with open(SPOOL_DIR / FLUSH_LOCK, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+
+        claimed = _claim()
+        if not claimed:
+            return 0
+
+        hooks = load_hook_modules()
+        cfg = load_config()
+        event_mappings = load_event_mappings(hooks, cfg)
+        conn = connect()
+        try:
+            loaded = sum(
+                _load_file(path, conn, hooks, event_mappings, cfg.get("storage"), batch_size)
+                for path in claimed
+            )
+            # Every claimed file is gone now, so its marker can go too
+            with conn:
+                conn.executemany(
+                    "DELETE FROM spool_loads WHERE file = ?", [(path.name,) for path in claimed]
+                )
+            return loaded
+        finally:
+            conn.close()
+
+
+def watch(interval):
+    """Flushes every `interval` seconds until interrupted."""
+    while True:
+        loaded = flush()
+        if loaded:
+            print(f"Loaded {loaded} spooled events", flush=True)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    print(f"Loaded {flush()} spooled events")
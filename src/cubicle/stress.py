@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Concurrent hook stress test: how many events survive several agents at once.
+
+Every hook swallows its own errors so that a telemetry failure never breaks
+a tool call, which also hides events lost to lock contention. run() starts
+one thread per simulated agent against a scratch ~/.cubicle. Each thread
+runs the real hook script for each of its events in a fresh process, paced
+so the agents together fire `rate` events per second. Every payload carries
+a unique sequence number (SEQ_FIELD), so afterwards the database shows
+exactly which events were delivered, lost or stored twice. Hooks run with
+CUBICLE_HOOK_TIMINGS=1, so the report includes their write phase, which
+takes in any time spent waiting on the lock inside busy_timeout.
+
+Run it with `cubicle stress`, or under pytest as the soak test in
+tests/test_stress.py (CUBICLE_SOAK=1).
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).parent))
+import bench
+import db
+import timings
+
+PACKAGE_ROOT = Path(__file__).parent
+SEQ_FIELD = "cubicle_stress_seq"
+DAEMON_START_TIMEOUT = 10
+LOST_SAMPLE = 20
+
+
+def _scratch_home(home, mode, storage):
+    with open(bench.DEFAULT_CONFIG) as f:
+        cfg = yaml.safe_load(f)
+    cfg["ingest"] = {"mode": mode}
+    cfg["storage"] = {**cfg.get("storage", {}), **(storage or {})}
+    data_dir = Path(home) / ".cubicle" / "data"
+    data_dir.mkdir(parents=True)
+    with open(data_dir.parent / "config.yaml", "w") as f:
+        yaml.safe_dump(cfg, f)
+    return data_dir / db.DB_PATH.name
+
+
+def _hook_env(home):
+    env = {key: value for key, value in os.environ.items() if key != db.FAMILY_ENV}
+    env["HOME"] = str(home)
+    env[timings.ENV] = "1"
+    return env
+
+
+def _start_daemon(home):
+    daemon = subprocess.Popen(
+        [sys.executable, str(PACKAGE_ROOT / "ingestd.py")],
+        env=_hook_env(home), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    socket_path = Path(home) / ".cubicle" / "data" / "ingestd.sock"
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while not socket_path.exists():
+        if daemon.poll() is not None or time.monotonic() > deadline:
+            daemon.kill()
+            raise RuntimeError("ingestd did not start")
+        time.sleep(0.05)
+    return daemon
+
+
+def _events(agents, per_agent, seed):
+    """One list of (argv, body) per agent, numbered 0..agents*per_agent-1 across all of them."""
+    streams = []
+    for agent_number in range(agents):
+        stream = []
+        for agent, cli_event, body, _ in bench.generate(per_agent, seed + agent_number, days=1):
+            payload = json.loads(body)
+            payload[SEQ_FIELD] = agent_number * per_agent + len(stream)
+            script = str(PACKAGE_ROOT / bench.HOOK_SCRIPTS[agent])
+            argv = [sys.executable, script] + ([cli_event] if cli_event else [])
+            stream.append((argv, json.dumps(payload).encode()))
+        streams.append(stream)
+    return streams
+
+
+def _agent(stream, interval, started, env, latencies):
+    """Fires a stream's hooks one after another, as an agent waits on each of its hooks."""
+    for number, (argv, body) in enumerate(stream):
+        delay = started + number * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        sent = time.monotonic()
+        subprocess.run(argv, input=body, env=env, capture_output=True, check=False)
+        latencies.append(time.monotonic() - sent)
+
+
+def _hold_lock(stop, hold_ms, every=1.0):
+    """Holds the write lock for hold_ms once a second, like a long migration or retain batch."""
+    with closing(db.connect()) as conn:
+        while not stop.wait(every):
+            conn.execute("BEGIN IMMEDIATE")
+            time.sleep(hold_ms / 1000)
+            conn.commit()
+
+
+def delivered_sequences(conn):
+    """Sequence numbers of the stored stress events in main and every shard, with repeats if any were stored twice."""
+    return [
+        row[0]
+        for schema in db.each_telemetry_schema(conn)
+        for row in conn.execute(
+            f"SELECT json_extract({db.payload_json_sql(schema)}, '$.{SEQ_FIELD}') FROM {schema}.telemetry"
+        )
+        if row[0] is not None
+    ]
+
+
+def _write_retries(health_log):
+    """Writes that hit SQLITE_BUSY past busy_timeout, and the time spent in their failed attempts and backoff."""
+    retries = {"retried": 0, "dropped": 0, "retry_waited_ms": 0}
+    if health_log.exists():
+        for line in health_log.read_text().splitlines():
+            entry = json.loads(line)
+            retries[entry["kind"]] = retries.get(entry["kind"], 0) + 1
+            retries["retry_waited_ms"] += entry.get("waited_ms", 0)
+    return retries
+
+
+def _write_latency(timings_log):
+    """Percentiles of the hooks' whole write phase, busy_timeout waits included (None if no hook wrote)."""
+    if not timings_log.exists():
+        return None
+    with open(timings_log) as f:
+        records = [json.loads(line) for line in f]
+    return timings.summarize(records)["phases"].get("write")
+
+
+def run(agents=6, rate=60, duration=10, mode="direct", daemon=False, hold_lock_ms=0, storage=None, seed=0):
+    """Fires agents * (rate / agents * duration) hook events concurrently and returns the report.
+
+    mode is the ingest mode ("direct" or "spool", which is flushed at the
+    end); daemon starts ingestd for the hooks to forward to; hold_lock_ms
+    adds a writer that holds the lock that long every second.
+    """
+    per_agent = max(1, round(rate * duration / agents))
+    streams = _events(agents, per_agent, seed)
+    original_path = db.DB_PATH
+    with tempfile.TemporaryDirectory(prefix="cubicle-stress-") as home:
+        daemon_process = None
+        stop = threading.Event()
+        try:
+            db.DB_PATH = _scratch_home(home, mode, storage)
+            db.init_db()
+            if daemon:
+                daemon_process = _start_daemon(home)
+            holder = threading.Thread(target=_hold_lock, args=(stop, hold_lock_ms), daemon=True)
+            if hold_lock_ms:
+                holder.start()
+
+            latencies = []
+            started = time.monotonic()
+            threads = [
+                threading.Thread(target=_agent, args=(stream, agents / rate, started, _hook_env(home), latencies))
+                for stream in streams
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.monotonic() - started
+            stop.set()
+            if holder.is_alive():
+                holder.join()
+
+            if daemon_process is not None:
+                daemon_process.send_signal(signal.SIGTERM)
+                daemon_process.wait()
+            if mode == "spool":
+                subprocess.run(
+                    [sys.executable, str(PACKAGE_ROOT / "spool.py")], env=_hook_env(home), capture_output=True, check=True
+                )
+            with closing(db.connect()) as conn:
+                delivered = delivered_sequences(conn)
+            retries = _write_retries(db.DB_PATH.parent / db.HEALTH_LOG_NAME)
+            write_latency = _write_latency(Path(home) / ".cubicle" / "data" / timings.LOG_PATH.name)
+        finally:
+            stop.set()
+            if daemon_process is not None and daemon_process.poll() is None:
+                daemon_process.kill()
+            db.DB_PATH = original_path
+
+    sent = agents * per_agent
+    lost = sorted(set(range(sent)) - set(delivered))
+    return {
+        "agents": agents,
+        "mode": mode,
+        "daemon": daemon,
+        "hold_lock_ms": hold_lock_ms,
+        "target_rate": rate,
+        "achieved_rate": round(sent / seconds, 1),
+        "sent": sent,
+        "delivered": len(set(delivered)),
+        "lost": len(lost),
+        "lost_sample": lost[:LOST_SAMPLE],
+        "duplicates": len(delivered) - len(set(delivered)),
+        "latency": bench.percentiles(latencies),
+        "write_ms": write_latency,
+        "write_retries": retries,
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
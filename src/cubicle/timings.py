@@ -0,0 +1,166 @@
+"""Opt-in per-phase timings for hook processes.
+
+With CUBICLE_HOOK_TIMINGS=1 in a hook's environment (`cubicle set-env
+CUBICLE_HOOK_TIMINGS 1` for agents launched through cubicle), the hook
+records how long each phase of its run took: interpreter startup, imports,
+reading stdin, forwarding to ingestd, importing yaml, loading config.yaml,
+the model lookup, connecting, encoding and writing the row. When the process
+exits it appends one JSON line to data/hook_timings.log with a single
+O_APPEND write, like the health log. The log is a ring of two files of at
+most MAX_LOG_BYTES each. `cubicle stats hooks` summarizes it.
+
+Without the variable, phase() and note() do nothing and no file is touched.
+Only processes that call begin() (the hooks) write a record. Hooks import
+this module before the other hook runtime modules, since the imports phase
+is measured from here.
+"""
+import atexit
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+ENV = "CUBICLE_HOOK_TIMINGS"
+LOG_PATH = Path.home() / ".cubicle" / "data" / "hook_timings.log"
+MAX_LOG_BYTES = 4 * 1024 * 1024
+# Phases in the order a hook runs them
+PHASES = (
+    "startup", "imports", "read", "forward", "yaml", "config", "spool", "parse", "model",
+    "connect", "encode", "write", "total",
+)
+
+ENABLED = os.environ.get(ENV, "") not in ("", "0")
+_imported = time.monotonic()
+_phases = {}
+_notes = {}
+
+
+def _process_age():
+    """Seconds since this process started (Linux only; None elsewhere).
+
+    /proc counts in clock ticks, so this is only good to about 10 ms.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name in parentheses may contain spaces; fields after it are fixed
+            started = int(f.read().rsplit(")", 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+_startup = _process_age() if ENABLED else None
+
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the block to phase name."""
+    if not ENABLED:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _phases[name] = _phases.get(name, 0) + time.monotonic() - started
+
+
+def begin():
+    """Ends the imports phase and writes this process's record when it exits.
+
+    Hooks call it first thing in main().
+    """
+    if ENABLED:
+        _phases["imports"] = time.monotonic() - _imported
+        atexit.register(_write)
+
+
+def note(**fields):
+    """Attaches fields (agent, event, bytes, path) to this process's record."""
+    if ENABLED:
+        _notes.update(fields)
+
+
+def _event(notes):
+    body = notes.pop("body", None)
+    if notes.get("event") or not body:
+        return notes.get("event")
+    from payload import RawPayload
+
+    try:
+        payload = RawPayload(body)
+        return payload.get("hook_event_name") or payload.get("event")
+    except ValueError:
+        return None
+
+
+def _write():
+    phases = {"startup": _startup} if _startup is not None else {}
+    phases.update(_phases)
+    phases["total"] = time.monotonic() - _imported + (_startup or 0)
+    notes = dict(_notes)
+    event = _event(notes)
+    record = {
+        "ts": round(time.time(), 3),
+        **notes,
+        "event": event,
+        "ms": {name: round(seconds * 1000, 2) for name, seconds in phases.items()},
+    }
+    try:
+        LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size >= MAX_LOG_BYTES:
+                # This process finishes its line in the old file, now the older half of the ring
+                os.replace(LOG_PATH, f"{LOG_PATH}.1")
+            os.write(fd, json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def read_log(since=None):
+    """Yields the logged records, oldest first, optionally only those after since (epoch seconds)."""
+    for path in (Path(f"{LOG_PATH}.1"), LOG_PATH):
+        if not path.exists():
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or record["ts"] >= since:
+                    yield record
+
+
+def _percentiles(values):
+    ordered = sorted(values)
+
+    def rank(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"calls": len(ordered), "p50": rank(0.5), "p95": rank(0.95), "p99": rank(0.99), "max": ordered[-1]}
+
+
+def summarize(records):
+    """Millisecond percentiles per phase, and of the total per agent, per event and per path."""
+    phases, groups = {}, {"agent": {}, "event": {}, "path": {}}
+    for record in records:
+        for name, ms in record["ms"].items():
+            phases.setdefault(name, []).append(ms)
+        for key, values in groups.items():
+            values.setdefault(record.get(key) or "unknown", []).append(record["ms"]["total"])
+    order = {name: position for position, name in enumerate(PHASES)}
+    return {
+        "phases": {
+            name: _percentiles(values)
+            for name, values in sorted(phases.items(), key=lambda item: order.get(item[0], len(order)))
+        },
+        **{
+            key: {name: _percentiles(values) for name, values in sorted(values.items())}
+            for key, values in groups.items()
+        },
+    }
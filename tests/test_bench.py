@@ -0,0 +1,51 @@
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import bench
+import dashboard_queries
+import db
+
+END = datetime(2026, 3, 1)
+
+
+def test_generator_is_seeded_and_shaped_like_hook_input():
+    events = list(bench.generate(3000, seed=7, end=END))
+
+    assert events == list(bench.generate(3000, seed=7, end=END))
+    assert events != list(bench.generate(3000, seed=8, end=END))
+    assert len(events) == 3000
+    assert {agent for agent, *_ in events} == {"claude", "codex", "agy"}
+    assert [event[3] for event in events] == sorted(event[3] for event in events)
+    for agent, cli_event, body, _ in events:
+        payload = json.loads(body)
+        if agent == "agy":
+            assert cli_event and payload["conversationId"]
+        else:
+            assert cli_event is None and payload["hook_event_name"] and payload["session_id"]
+    sizes = sorted(len(body) for *_, body, _ in events)
+    assert sizes[-1] > 40 * sizes[len(sizes) // 2]
+
+
+def test_run_reports_every_metric_against_a_scratch_database(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "telemetry.db")
+    report = bench.run(events=500, hook_calls=2, repeats=1)
+
+    assert db.DB_PATH == tmp_path / "telemetry.db"
+    assert not db.DB_PATH.exists()
+    assert report["ingest"]["events"] == 500
+    assert report["database_bytes"] > 0
+    assert report["hooks"]["calls"] == 2
+    public = {name for name in vars(dashboard_queries) if name.startswith(("get_", "query_", "search_"))}
+    assert public | {"data_version"} == set(report["queries"])
+
+    slower = json.loads(json.dumps(report))
+    slower["queries"]["get_summary_stats"]["median_ms"] = report["queries"]["get_summary_stats"]["median_ms"] * 2 + 1
+    slower["ingest"]["events_per_second"] = report["ingest"]["events_per_second"] * 2
+    regressed = [metric for metric, *_, worse in bench.compare(slower, report) if worse]
+    assert regressed == ["ingest.events_per_second"]
+    regressed = [metric for metric, *_, worse in bench.compare(report, slower) if worse]
+    assert regressed == ["queries.get_summary_stats.median_ms"]
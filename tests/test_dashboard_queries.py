@@ -0,0 +1,208 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import dashboard_queries
+import db
+
+
+@pytest.fixture
+def events(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "telemetry.db")
+    for record in [
+        ("s1", "session_start", "opus", {"cwd": "/src/cubicle"}, "2026-01-01 10:00:00"),
+        ("s1", "user_prompt_submit", None, {}, "2026-01-01 10:01:00"),
+        ("s1", "pre_tool_use", None, {"tool_name": "Bash"}, "2026-01-01 10:10:00"),
+        ("s2", "session_start", "sonnet", {"cwd": "/src/other"}, "2026-01-02 09:00:00"),
+        ("s3", "PreToolUse", "opus", {"tool_name": "Read"}, "2026-01-03 09:00:00"),
+    ]:
+        db.insert_telemetry(*record, agent="claude")
+
+
+def test_summary_stats_read_the_sessions_table(events):
+    assert dashboard_queries.get_summary_stats() == {
+        "total_sessions": 3,
+        "total_tool_calls": 2,
+        "total_prompts": 1,
+        "avg_duration_min": 10.0,
+        "top_model": "opus",
+    }
+
+
+def test_sessions_newest_first_with_repo(events):
+    sessions, total = dashboard_queries.query_sessions()
+
+    assert total == 3
+    assert sessions["session_id"].tolist() == ["s3", "s2", "s1"]
+    s1 = sessions.set_index("session_id").loc["s1"]
+    assert (s1["repo"], s1["duration_min"], s1["event_count"], s1["tool_count"]) == ("cubicle", 10.0, 3, 1)
+    assert sessions.set_index("session_id").loc["s3", "repo"] == "unknown"
+
+
+def test_sessions_are_filtered_and_paged_in_sql(events):
+    assert dashboard_queries.get_session_models() == ["opus", "sonnet"]
+    assert dashboard_queries.get_session_repos() == ["cubicle", "other", "unknown"]
+
+    page, total = dashboard_queries.query_sessions(model="opus", page_size=1)
+    assert (page["session_id"].tolist(), total) == (["s3"], 2)
+    page, total = dashboard_queries.query_sessions(model="opus", page=1, page_size=1)
+    assert (page["session_id"].tolist(), total) == (["s1"], 2)
+
+    page, total = dashboard_queries.query_sessions(repo="unknown")
+    assert (page["session_id"].tolist(), total) == (["s3"], 1)
+    page, total = dashboard_queries.query_sessions(min_tools=1, sort="Duration")
+    assert (page["session_id"].tolist(), total) == (["s1", "s3"], 2)
+
+
+def test_overview_charts_read_the_hourly_rollup(events):
+    daily = dashboard_queries.get_daily_sessions(days=100_000)
+    assert daily.assign(date=daily["date"].dt.strftime("%Y-%m-%d")).values.tolist() == [
+        ["2026-01-01", "opus", 1],
+        ["2026-01-02", "sonnet", 1],
+        ["2026-01-03", "opus", 1],
+    ]
+    assert dashboard_queries.get_model_distribution().values.tolist() == [
+        ["opus", 2, 1],
+        ["sonnet", 1, 0],
+    ]
+    heatmap = dashboard_queries.get_usage_heatmap()
+    assert sorted(heatmap.values.tolist()) == [[4, 10, 1], [5, 9, 1], [6, 9, 1]]
+
+
+def test_data_version_changes_only_with_new_events(events):
+    overall, s1, s2 = (dashboard_queries.data_version(s) for s in (None, "s1", "s2"))
+    assert dashboard_queries.data_version() == overall
+
+    db.insert_telemetry("s2", "pre_tool_use", None, {}, "2026-01-02 09:30:00")
+
+    assert dashboard_queries.data_version() != overall
+    assert dashboard_queries.data_version("s1") == s1
+    assert dashboard_queries.data_version("s2") != s2
+
+
+def test_session_timeline_pages_by_keyset_and_truncates_in_sql(events):
+    big = "x" * 1000
+    db.insert_telemetry("s1", "post_tool_use", None, {"tool_response": {"stdout": big}}, "2026-01-01 10:10:00")
+    db.insert_telemetry("s1", "turn_complete", None, {"last_assistant_message": "done"}, "2026-01-01 10:11:00")
+
+    first = dashboard_queries.get_session_timeline("s1", limit=3)
+    assert first["event_type"].tolist() == ["session_start", "user_prompt_submit", "pre_tool_use"]
+    after = (first["timestamp"].iloc[-1], int(first["id"].iloc[-1]))
+    rest = dashboard_queries.get_session_timeline("s1", after, limit=3)
+
+    assert rest["event_type"].tolist() == ["post_tool_use", "turn_complete"]
+    assert rest["tool_response"].iloc[0] == "x" * dashboard_queries.PREVIEW_CHARS + "…"
+    assert rest["assistant_message"].iloc[1] == "done"
+    payload = dashboard_queries.get_event_payload(int(rest["id"].iloc[0]))
+    assert payload == {"tool_response": {"stdout": big}}
+
+
+def test_compressed_blobs_are_decoded_for_the_timeline(events):
+    output = "compressed output\n" * 1000
+    db.insert_telemetry("s2", "post_tool_use", None, {"tool_response": {"stdout": output}}, "2026-01-02 09:10:00")
+
+    timeline = dashboard_queries.get_session_timeline("s2")
+
+    event_id = int(timeline["id"].iloc[-1])
+    with db.connect() as conn:
+        assert conn.execute("SELECT codec FROM payload_blobs").fetchall() == [("zlib",)]
+    assert timeline["tool_response"].iloc[-1].startswith("compressed output\n")
+    assert dashboard_queries.get_event_payload(event_id) == {"tool_response": {"stdout": output}}
+
+
+def test_session_timeline_can_list_only_some_event_types(events):
+    turns = dashboard_queries.get_session_timeline("s1", event_types=("user_prompt_submit", "pre_tool_use"))
+
+    assert turns["event_type"].tolist() == ["user_prompt_submit", "pre_tool_use"]
+    assert turns["tool_input"].isna().all()
+
+
+def test_queries_read_main_and_monthly_shards(events):
+    sharded = {"shard_by_month": True}
+    version = dashboard_queries.data_version()
+    db.insert_telemetry("s4", "session_start", "opus", {"cwd": "/src/cubicle"}, storage=sharded)
+    db.insert_telemetry("s4", "pre_tool_use", None, {"tool_name": "Bash", "cwd": "/src/cubicle"}, storage=sharded)
+
+    assert dashboard_queries.data_version() != version
+    assert db.shard_months()
+    timeline = dashboard_queries.get_session_timeline("s4")
+    assert timeline["event_type"].tolist() == ["session_start", "pre_tool_use"]
+    assert dashboard_queries.get_event_payload(int(timeline["id"].iloc[1]))["tool_name"] == "Bash"
+    assert dashboard_queries.get_tool_usage().values.tolist() == [["Bash", 2, 2], ["Read", 1, 1]]
+    assert dashboard_queries.get_repo_distribution().values.tolist() == [["cubicle", 2, 1], ["other", 1, 0]]
+
+
+def test_queries_reuse_pooled_read_only_connections(events):
+    with dashboard_queries._connect() as conn, pytest.raises(sqlite3.OperationalError, match="readonly"):
+        conn.execute("DELETE FROM sessions")
+    with dashboard_queries._connect() as again:
+        assert again is conn
+
+
+def test_snapshot_reads_see_new_events_after_a_refresh(events, monkeypatch):
+    pool = dashboard_queries._ReadPool(snapshot_seconds=3600)
+    monkeypatch.setattr(dashboard_queries, "_pool", pool)
+    assert dashboard_queries.get_summary_stats()["total_sessions"] == 3
+
+    db.insert_telemetry("s4", "session_start", "opus", {})
+    assert dashboard_queries.get_summary_stats()["total_sessions"] == 3
+
+    pool.snapshot_seconds = 0
+    assert dashboard_queries.get_summary_stats()["total_sessions"] == 4
+    assert (db.DB_PATH.parent / db.SNAPSHOT_DIR_NAME / db.DB_PATH.name).exists()
+
+
+def test_profiled_queries_record_time_rows_and_statements(events):
+    with dashboard_queries.collect() as calls:
+        dashboard_queries.query_sessions(model="opus")
+        dashboard_queries.get_summary_stats()
+
+    assert [call["query"] for call in calls] == ["query_sessions", "get_summary_stats"]
+    sessions = calls[0]
+    assert sessions["args"] == "model='opus'"
+    assert sessions["rows"] == 2  # the page and the total
+    assert sessions["ms"] >= 0 and sessions["vm_steps"] >= 0
+    assert any("FROM sessions" in sql for sql in sessions["statements"])
+    assert dashboard_queries.recent_queries()[-1]["query"] == "get_summary_stats"
+    assert "explain" not in dashboard_queries.QUERIES
+
+
+def test_explain_flags_full_table_scans(events):
+    db.insert_telemetry("s4", "session_start", None, {}, storage={"shard_by_month": True})
+    with db.connect() as conn:
+        shard = db.attach_shard(conn, db.shard_months()[-1])
+
+    for table in ("telemetry", "main.telemetry", f"{shard}.telemetry"):
+        plan = dashboard_queries.explain(f"SELECT * FROM {table} WHERE raw_payload IS NOT NULL")
+        assert plan["step"].tolist() == [f"SCAN {table}"]
+        assert plan["full_scan"].tolist() == [True]
+
+    plan = dashboard_queries.explain("SELECT * FROM main.sessions WHERE session_id = 's1'")
+    assert not plan["full_scan"].any()
+    plan = dashboard_queries.explain("SELECT COUNT(*) FROM main.telemetry WHERE event_code = 6")
+    assert not plan["full_scan"].any()
+
+
+def test_database_stats_list_tables_and_indexes(events):
+    stats = dashboard_queries.get_database_stats()
+
+    assert stats["page_count"] > 0 and stats["journal_mode"] == "wal"
+    objects = stats["objects"].set_index("name")
+    assert objects.loc["telemetry", "type"] == "table"
+    assert stats["shards"] == []
+
+
+def test_an_unparseable_payload_only_blanks_its_own_timeline_row(events):
+    db.insert_telemetry("s1", "user_prompt_submit", None, {"prompt": "later"}, "2026-01-01 10:20:00")
+    with db.connect() as conn:
+        conn.execute("UPDATE telemetry SET raw_payload = '{\"extra\": [1,,2]}' WHERE event_type = 'pre_tool_use'")
+
+    timeline = dashboard_queries.get_session_timeline("s1")
+
+    assert timeline["unparseable"].tolist() == [0, 0, 1, 0]
+    assert timeline["prompt_text"].iloc[3] == "later"
+    assert timeline["tool_name"].iloc[2] == "Bash"
@@ -0,0 +1,444 @@
+import json
+import sqlite3
+import sys
+from contextlib import closing
+from pathlib import Path
+
+import pytest
+import yaml
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import db
+
+
+@pytest.fixture
+def db_path(monkeypatch, tmp_path):
+    path = tmp_path / "data" / "telemetry.db"
+    monkeypatch.setattr(db, "DB_PATH", path)
+    return path
+
+
+def test_connect_migrates_fresh_database_to_current_version(db_path):
+    conn = db.connect()
+
+    assert db.schema_version(conn) == db.SCHEMA_VERSION
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(telemetry)")]
+    assert {"id", "timestamp", "session_id", "event_type", "model", "raw_payload"} <= set(cols)
+
+
+def test_migrate_drops_llm_family_and_keeps_a_backup(db_path):
+    db_path.parent.mkdir(parents=True)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("""
+            CREATE TABLE telemetry (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                session_id TEXT,
+                event_type TEXT,
+                llm_family TEXT,
+                model TEXT,
+                raw_payload JSON
+            )
+        """)
+        conn.execute(
+            "INSERT INTO telemetry (session_id, event_type, llm_family) VALUES ('s1', 'session_start', 'claude')"
+        )
+    conn.close()
+
+    db.init_db()
+
+    [backup] = db_path.parent.glob("telemetry_backup_*.db")
+    with sqlite3.connect(backup) as conn:
+        assert conn.execute("SELECT llm_family FROM telemetry").fetchone() == ("claude",)
+    conn = db.connect()
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(telemetry)")]
+    assert "llm_family" not in cols
+    assert conn.execute("SELECT session_id FROM telemetry").fetchall() == [("s1",)]
+
+
+def test_connect_skips_migrations_once_current(db_path, monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(db, "migrate", lambda conn: pytest.fail("migrated an up-to-date database"))
+
+    db.insert_telemetry("s1", "session_start", "m", {"hook_event_name": "SessionStart"})
+
+
+def test_insert_with_claimed_ingest_key_is_skipped(db_path):
+    db.insert_telemetry("s1", "pre_tool_use", "m", {}, ingest_key="0000000001aa")
+    db.insert_telemetry("s1", "pre_tool_use", "m", {}, ingest_key="0000000001aa")
+    db.insert_telemetry("s1", "pre_tool_use", "m", {})
+
+    conn = db.connect()
+    assert conn.execute("SELECT COUNT(*) FROM telemetry").fetchone() == (2,)
+
+    with conn:
+        db.prune_ingest_keys(conn, max_age_seconds=60)
+    assert conn.execute("SELECT COUNT(*) FROM ingest_keys").fetchone() == (0,)
+
+
+def test_connect_uses_wal_and_a_busy_timeout(db_path):
+    conn = db.connect()
+
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert conn.execute("PRAGMA busy_timeout").fetchone() == (db.BUSY_TIMEOUT_MS,)
+
+
+def test_busy_writes_are_retried_and_counted(db_path, monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(db, "RETRY_BASE_DELAY", 0)
+    failures = iter([sqlite3.OperationalError("database is locked")])
+
+    def flaky_write():
+        for error in failures:
+            raise error
+        return "ok"
+
+    def always_locked():
+        raise sqlite3.OperationalError("database is locked")
+
+    assert db.with_write_retry(flaky_write, "pre_tool_use s1") == "ok"
+    with pytest.raises(sqlite3.OperationalError):
+        db.with_write_retry(always_locked, "pre_tool_use s2")
+
+    report = db.health()
+    assert report["counts"] == {"retried": 1, "dropped": 1}
+    assert report["last"]["dropped"]["attempts"] == db.WRITE_ATTEMPTS
+    assert report["last"]["retried"]["waited_ms"] >= 0
+    assert report["journal_mode"] == "wal"
+
+
+def test_inserts_maintain_the_sessions_table(db_path, monkeypatch):
+    monkeypatch.delenv(db.FAMILY_ENV, raising=False)
+    db.insert_telemetry("s1", "session_start", "m1", {"cwd": "/src/a"}, "2026-01-01 10:00:00", "claude")
+    db.insert_telemetry("s1", "pre_tool_use", None, {}, "2026-01-01 10:05:00", "claude")
+    db.insert_telemetry("s1", "user_prompt_submit", "m2", {"cwd": "/src/b"}, "2026-01-01 10:02:00")
+
+    assert db.get_model_for_session("s1") == "m1"
+    conn = db.connect()
+    row = conn.execute("""
+        SELECT agent, model, cwd, first_ts, last_ts, event_count, prompt_count, tool_count
+        FROM sessions WHERE session_id = 's1'
+    """).fetchone()
+    assert row == ("claude", "m1", "/src/b", "2026-01-01 10:00:00", "2026-01-01 10:05:00", 3, 1, 1)
+
+
+def test_sessions_migration_backfills_existing_events(db_path):
+    conn = db.connect()
+    conn.executemany(
+        "INSERT INTO telemetry (timestamp, session_id, event_type, model, raw_payload) VALUES (?, ?, ?, ?, ?)",
+        [
+            ("2026-01-01 10:00:00", "s1", "session_start", "", '{"cwd": "/src/a"}'),
+            ("2026-01-01 10:01:00", "s1", "pre_tool_use", "m1", "{}"),
+            ("2026-01-01 10:02:00", "s1", "permission_request", "m2", "{}"),
+        ],
+    )
+    conn.execute("DROP TABLE sessions")
+    conn.execute(f"PRAGMA user_version = {db.MIGRATIONS.index((db._create_sessions, None))}")
+    conn.commit()
+    conn.close()
+
+    conn = db.connect()
+    row = conn.execute("""
+        SELECT model, cwd, first_ts, last_ts, event_count, tool_count, permission_count
+        FROM sessions WHERE session_id = 's1'
+    """).fetchone()
+    assert row == ("m1", "/src/a", "2026-01-01 10:00:00", "2026-01-01 10:02:00", 3, 1, 1)
+
+
+def test_event_types_mirror_the_default_config():
+    with open(SRC_DIR / "default_config.yaml") as f:
+        events = yaml.safe_load(f)["events"]
+
+    assert list(db.EVENT_TYPES) == events
+
+
+def test_event_codes_are_canonical_and_backfilled(db_path):
+    conn = db.connect()
+    conn.executemany(
+        "INSERT INTO telemetry (session_id, event_type) VALUES (?, ?)",
+        [("s1", "pretooluse"), ("s1", "PreToolUse"), ("s1", "pre_tool_use"), ("s1", "beforetool")],
+    )
+    conn.execute("UPDATE telemetry SET event_code = NULL")
+    conn.execute(f"PRAGMA user_version = {db.MIGRATIONS.index((db._add_event_codes, None))}")
+    conn.commit()
+    conn.close()
+
+    db.insert_telemetry("s1", "BeforeTool", None, {})
+    db.insert_telemetry("s1", "PreToolUse", None, {})
+
+    conn = db.connect()
+    rows = conn.execute("""
+        SELECT t.event_type, t.event_code, e.name
+        FROM telemetry t LEFT JOIN event_types e ON e.code = t.event_code
+        ORDER BY t.id
+    """).fetchall()
+    tool = ("pre_tool_use", db.event_code("pre_tool_use"), "pre_tool_use")
+    [other_code] = {code for name, code, _ in rows if name == "beforetool"}
+    assert other_code > len(db.EVENT_TYPES)
+    other = ("beforetool", other_code, "beforetool")
+    assert rows == [tool, tool, tool, other, other, tool]
+
+
+def test_payload_fields_are_stored_as_columns(db_path):
+    db.insert_telemetry(
+        "s1", "pre_tool_use", "m", {"tool_name": "Bash", "cwd": "/src/cubicle"}, agent="codex"
+    )
+    conn = db.connect()
+    conn.execute(
+        "INSERT INTO telemetry (session_id, event_type, raw_payload) VALUES (?, ?, ?)",
+        ("s2", "pre_tool_use", '{"tool_name": "Read", "cwd": "/src/other"}'),
+    )
+    conn.execute(f"PRAGMA user_version = {db.MIGRATIONS.index((db._add_extracted_columns, None))}")
+    conn.commit()
+    conn.close()
+
+    conn = db.connect()
+    rows = conn.execute("SELECT tool_name, cwd, repo, agent FROM telemetry ORDER BY id").fetchall()
+    assert rows == [("Bash", "/src/cubicle", "cubicle", "codex"), ("Read", "/src/other", "other", None)]
+    assert conn.execute("SELECT repo FROM sessions WHERE session_id = 's1'").fetchone() == ("cubicle",)
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT tool_name FROM telemetry WHERE event_code = ? AND timestamp >= ?",
+        (db.event_code("pre_tool_use"), "2026-01-01"),
+    ).fetchall()
+    assert "idx_telemetry_event_ts" in plan[0][-1]
+
+
+def test_rollup_counts_events_and_session_starts(db_path):
+    conn = db.connect()
+    db.insert_many(
+        [
+            {"session_id": "s1", "event_type": "session_start", "model": "m", "raw_payload": {},
+             "timestamp": "2026-01-01 10:05:00"},
+            {"session_id": "s1", "event_type": "pre_tool_use", "model": "m", "raw_payload": {},
+             "timestamp": "2026-01-01 10:30:00"},
+        ],
+        conn,
+    )
+    conn.commit()
+    db.insert_telemetry("s1", "pre_tool_use", "m", {}, "2026-01-01 11:00:00")
+    db.insert_telemetry("s2", "pre_tool_use", "m", {}, "2026-01-01 11:10:00")
+
+    query = "SELECT hour, event_code, events, sessions_started FROM event_rollup ORDER BY hour, event_code"
+    tool = db.event_code("pre_tool_use")
+    expected = [
+        ("2026-01-01 10:00:00", db.event_code("session_start"), 1, 1),
+        ("2026-01-01 10:00:00", tool, 1, 0),
+        ("2026-01-01 11:00:00", tool, 2, 1),
+    ]
+    assert conn.execute(query).fetchall() == expected
+
+    # The migration rebuilds the same rollup from telemetry
+    conn.execute("DROP TABLE event_rollup")
+    conn.execute(f"PRAGMA user_version = {db.MIGRATIONS.index((db._create_event_rollup, None))}")
+    conn.commit()
+    conn.close()
+    assert db.connect().execute(query).fetchall() == expected
+
+
+def test_usage_rollups_count_tools_and_repos_per_session(db_path):
+    bash = {"tool_name": "Bash", "cwd": "/src/cubicle"}
+    db.insert_telemetry("s1", "session_start", "m", {"cwd": "/src/cubicle"})
+    db.insert_telemetry("s1", "pre_tool_use", None, bash)
+    db.insert_telemetry("s1", "post_tool_use", None, bash)
+    conn = db.connect()
+    db.insert_many([{"session_id": None, "event_type": "pre_tool_use", "model": None, "raw_payload": bash}], conn)
+    conn.commit()
+    db.insert_telemetry("s2", "pre_tool_use", None, {"tool_name": "Read"}, storage={"shard_by_month": True})
+
+    tools = "SELECT * FROM tool_rollup ORDER BY 1, 2"
+    repos = "SELECT * FROM repo_rollup ORDER BY 1, 2"
+    expected = (
+        [("Bash", "", 1), ("Bash", "s1", 1), ("Read", "s2", 1)],
+        [("cubicle", "", 1), ("cubicle", "s1", 1)],
+    )
+    assert (conn.execute(tools).fetchall(), conn.execute(repos).fetchall()) == expected
+
+    # The migration rebuilds them from main and the shards
+    conn.execute("DROP TABLE tool_rollup")
+    conn.execute("DROP TABLE repo_rollup")
+    conn.execute(f"PRAGMA user_version = {db.MIGRATIONS.index((db._create_usage_rollups, None))}")
+    conn.commit()
+    conn.close()
+    conn = db.connect()
+    assert (conn.execute(tools).fetchall(), conn.execute(repos).fetchall()) == expected
+
+
+def test_search_finds_prompts_commands_and_replies(db_path):
+    db.insert_telemetry("s1", "user_prompt_submit", None, {"prompt": "please run the migration"})
+    db.insert_telemetry("s1", "pre_tool_use", None, {"tool_name": "Bash", "tool_input": {"command": "alembic upgrade head"}})
+    db.insert_telemetry("s2", "turn_complete", None, {"last_assistant_message": "The migrations ran cleanly"})
+
+    conn = db.connect()
+    hits = db.search(conn, "alembic upgr")
+    assert [(h[1], h[3], h[4]) for h in hits] == [("s1", "pre_tool_use", "Bash")]
+    assert hits[0][5] == "Bash\n[alembic] [upgrade] head"
+    assert {h[1] for h in db.search(conn, "migration")} == {"s1", "s2"}
+    assert db.search(conn, 'odd "quoted') == []
+
+    # The migration indexes events recorded before the search index existed
+    conn.execute("DROP TABLE event_search")
+    conn.execute(f"PRAGMA user_version = {db.MIGRATIONS.index((db._create_event_search, None))}")
+    conn.commit()
+    conn.close()
+    assert len(db.search(db.connect(), "migration")) == 2
+
+
+def test_large_payloads_are_compressed_and_capped(db_path):
+    storage = {"compress_min_bytes": 100, "max_payload_bytes": {"post_tool_use": 500}}
+    small = {"tool_name": "Read"}
+    large = {"tool_name": "Read", "tool_input": {"file_path": "/a.py"}, "tool_response": {"content": "x = 1\n" * 50}}
+    huge = {"tool_name": "Read", "tool_response": {"content": "y" * 5000}}
+    for payload in (small, large, huge):
+        db.insert_telemetry("s1", "post_tool_use", None, payload, storage=storage)
+
+    rows = db.connect().execute("SELECT raw_payload, payload_codec FROM telemetry ORDER BY id").fetchall()
+    assert [codec for _, codec in rows] == [None, "zlib", "zlib"]
+    assert rows[0][0] == '{"tool_name": "Read"}'
+    assert db.load_payload(*rows[1]) == large
+
+    capped = db.load_payload(*rows[2])
+    assert len(db.payload_text(*rows[2])) <= 500
+    assert capped["tool_name"] == "Read"
+    assert capped["tool_response"].startswith('{"content": "yyy')
+    assert capped["cubicle_truncated"] == {"tool_response": len(json.dumps(huge["tool_response"]))}
+
+
+def test_repeated_tool_payloads_share_one_blob(db_path):
+    storage = {"dedup_min_bytes": 100}
+    content = {"content": "def main():\n    pass\n" * 20}
+    read = {"tool_name": "Read", "tool_input": {"file_path": "/a.py"}, "tool_response": content}
+    for session_id in ("s1", "s1", "s2"):
+        db.insert_telemetry(session_id, "post_tool_use", None, read, storage=storage)
+
+    conn = db.connect()
+    assert conn.execute("SELECT refcount FROM payload_blobs").fetchall() == [(3,)]
+    rows = conn.execute("SELECT raw_payload, payload_codec, blob_refs FROM telemetry").fetchall()
+    assert json.loads(rows[0][0]) == {"tool_name": "Read", "tool_input": {"file_path": "/a.py"}}
+    assert [db.load_payload(*row, conn=conn) for row in rows] == [read] * 3
+    resolved = conn.execute(f"SELECT {db.payload_json_sql()} FROM telemetry LIMIT 1").fetchone()[0]
+    assert json.loads(resolved) == read
+
+    # Deleting rows releases their references; the blob goes with the last one
+    conn.execute("DELETE FROM telemetry WHERE session_id = 's1'")
+    assert conn.execute("SELECT refcount FROM payload_blobs").fetchall() == [(1,)]
+    conn.execute("DELETE FROM telemetry")
+    assert conn.execute("SELECT COUNT(*) FROM payload_blobs").fetchone() == (0,)
+
+
+def test_retain_expires_old_events_but_keeps_their_history(db_path):
+    read = {"tool_name": "Read", "cwd": "/src/cubicle", "tool_response": {"content": "word " * 1000}}
+    db.insert_telemetry("old", "session_start", "opus", {}, "2020-01-01 10:00:00")
+    db.insert_telemetry("old", "post_tool_use", None, read, "2020-01-01 10:01:00")
+    db.insert_telemetry("old", "pre_tool_use", None, {"tool_name": "Bash", "cwd": "/src/old"}, "2020-01-01 10:02:00")
+    db.insert_telemetry("mid", "post_tool_use", "opus", read, "2024-01-01 10:00:00")
+    db.insert_telemetry("new", "post_tool_use", "opus", read)
+    conn = db.connect()
+    assert conn.execute("PRAGMA auto_vacuum").fetchone() == (db.AUTO_VACUUM_INCREMENTAL,)
+    rollup = conn.execute("SELECT * FROM event_rollup ORDER BY 1, 2, 3, 4, 5").fetchall()
+    usage = conn.execute("SELECT * FROM tool_rollup UNION ALL SELECT * FROM repo_rollup").fetchall()
+
+    report = db.retain(conn, strip_after_days=500, drop_after_days=1500, batch_size=1)
+
+    assert (report["dropped"], report["stripped"]) == (3, 1)
+    assert report["freed_pages"] > 0
+    rows = conn.execute("SELECT session_id, raw_payload, blob_refs, tool_name, repo FROM telemetry ORDER BY id").fetchall()
+    assert rows[0] == ("mid", "{}", None, "Read", "cubicle")
+    assert rows[1][0] == "new" and rows[1][2] is not None
+    assert conn.execute("SELECT refcount FROM payload_blobs").fetchall() == [(1,)]
+    assert [hit[1] for hit in db.search(conn, "word")] == ["new"]
+    assert conn.execute("SELECT * FROM event_rollup ORDER BY 1, 2, 3, 4, 5").fetchall() == rollup
+    assert conn.execute("SELECT * FROM tool_rollup UNION ALL SELECT * FROM repo_rollup").fetchall() == usage
+    assert conn.execute("SELECT event_count FROM sessions WHERE session_id = 'old'").fetchone() == (3,)
+
+
+def test_retain_only_converts_old_databases_to_incremental_vacuum_on_request(db_path):
+    db_path.parent.mkdir(parents=True)
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("CREATE TABLE scratch (x)")  # created before auto_vacuum could be set
+    for day in range(1, 20):
+        db.insert_telemetry("old", "post_tool_use", None, {"tool_response": "x" * 5000}, f"2020-01-{day:02d} 10:00:00")
+    conn = db.connect()
+    assert conn.execute("PRAGMA auto_vacuum").fetchone() == (0,)
+
+    report = db.retain(conn, drop_after_days=30)
+    assert (report["dropped"], report["freed_pages"], report["unvacuumed"]) == (19, 0, ["main"])
+    assert conn.execute("PRAGMA auto_vacuum").fetchone() == (0,)
+
+    report = db.retain(conn, convert_vacuum=True)
+    assert report["freed_pages"] > 0 and report["unvacuumed"] == []
+    assert conn.execute("PRAGMA auto_vacuum").fetchone() == (db.AUTO_VACUUM_INCREMENTAL,)
+
+
+def test_monthly_shards_take_raw_events_and_federate_reads(db_path):
+    db.insert_telemetry("s1", "user_prompt_submit", "opus", {"prompt": "before sharding"}, "2026-01-01 10:00:00")
+    sharded = {"shard_by_month": True, "dedup_min_bytes": 10}
+    read = {"tool_name": "Read", "tool_response": {"content": "sharded text"}}
+    # Shards take events by the month they are ingested in, whatever their timestamp
+    db.insert_telemetry("s1", "post_tool_use", None, read, "2026-01-01 10:01:00", storage=sharded)
+    conn = db.connect()
+    record = {"session_id": "s2", "event_type": "post_tool_use", "model": "m", "raw_payload": read,
+              "timestamp": "2026-01-02 10:00:00"}
+    db.insert_many([record], conn, sharded)
+    conn.commit()
+
+    [month] = db.shard_months()
+    assert db.shard_path(month).exists()
+    assert conn.execute("SELECT COUNT(*) FROM telemetry").fetchone() == (1,)
+    assert conn.execute("SELECT session_id, event_count FROM sessions ORDER BY 1").fetchall() == [("s1", 2), ("s2", 1)]
+
+    with db.telemetry_schemas(conn) as schemas:
+        assert schemas == ["main", db.attach_shard(conn, month)]
+        ids = [row[0] for row in conn.execute(f"SELECT id FROM {schemas[1]}.telemetry")]
+    assert min(ids) > int(month.replace("-", "")) * db.SHARD_ID_SPAN
+    assert [hit[1] for hit in db.search(conn, "sharded")] == ["s1", "s2"]
+    assert [hit[1] for hit in db.search(conn, "before")] == ["s1"]
+
+    schema = db.event_schema(conn, ids[0])
+    row = conn.execute(f"SELECT raw_payload, payload_codec, blob_refs FROM {schema}.telemetry WHERE id = ?", ids[:1])
+    assert db.load_payload(*row.fetchone(), conn=conn, schema=schema) == read
+    assert db.retain(conn, drop_after_days=1)["dropped"] == 3
+
+
+def test_migrations_that_change_shard_tables_also_run_on_shards(db_path, monkeypatch):
+    db.insert_telemetry("s1", "session_start", None, {}, storage={"shard_by_month": True})
+    [month] = db.shard_months()
+
+    def add_column(conn):
+        conn.execute("ALTER TABLE telemetry ADD COLUMN extra TEXT")
+
+    monkeypatch.setattr(db, "MIGRATIONS", [*db.MIGRATIONS, (add_column, None)])
+    monkeypatch.setattr(db, "SCHEMA_VERSION", len(db.MIGRATIONS))
+    monkeypatch.setattr(db, "SHARD_STEPS", {add_column})
+    conn = db.connect()
+
+    with closing(sqlite3.connect(db.shard_path(month))) as shard:
+        assert shard.execute("PRAGMA user_version").fetchone() == (db.SCHEMA_VERSION,)
+        assert "extra" in [row[1] for row in shard.execute("PRAGMA table_info(telemetry)")]
+        # A shard a migration stopped short of is caught up when it is attached
+        shard.execute("ALTER TABLE telemetry DROP COLUMN extra")
+        shard.execute(f"PRAGMA user_version = {db.SCHEMA_VERSION - 1}")
+        shard.commit()
+    schema = db.attach_shard(conn, month)
+    assert "extra" in [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(telemetry)")]
+    assert "extra" in [row[1] for row in conn.execute("PRAGMA main.table_info(telemetry)")]
+
+
+def test_snapshot_copies_main_and_shards_for_read_only_use(db_path):
+    db.insert_telemetry("s1", "user_prompt_submit", "opus", {"prompt": "in main"}, "2026-01-01 10:00:00")
+    db.insert_telemetry("s1", "user_prompt_submit", None, {"prompt": "in a shard"}, storage={"shard_by_month": True})
+
+    copy = db.snapshot()
+    [month] = db.shard_months()
+    shard_copy = db.shard_path(month, copy)
+    copied_at = shard_copy.stat().st_mtime_ns
+    db.insert_telemetry("s2", "session_start", "opus", {})
+
+    assert db.snapshot() == copy
+    assert shard_copy.stat().st_mtime_ns == copied_at
+    conn = db.connect_readonly(copy)
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    assert conn.execute("SELECT session_id FROM sessions ORDER BY 1").fetchall() == [("s1",), ("s2",)]
+    assert [hit[1] for hit in db.search(conn, "shard")] == ["s1"]
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        conn.execute("DELETE FROM sessions")
@@ -0,0 +1,80 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pyarrow")
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import db
+import export
+
+
+@pytest.fixture
+def events(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "data" / "telemetry.db")
+    db.insert_telemetry("s1", "session_start", "opus", {"cwd": "/src/cubicle"}, "2026-01-01 10:00:00", agent="claude")
+    db.insert_telemetry("s1", "pre_tool_use", None, {"tool_name": "Bash"}, "2026-01-01 10:01:00", agent="claude")
+    db.insert_telemetry("s2", "session_start", "gpt-5", {"cwd": "/src/other"}, "2026-01-02 09:00:00", agent="codex")
+
+
+def _telemetry(dest, fmt="parquet"):
+    dataset = ds.dataset(dest / export.TELEMETRY_DIR, format="ipc" if fmt == "arrow" else fmt, partitioning="hive")
+    return dataset.to_table().to_pandas().sort_values("id").reset_index(drop=True)
+
+
+def test_export_partitions_by_date_and_agent(events, tmp_path):
+    dest = tmp_path / "export"
+
+    report = export.export(dest, chunk_rows=2)
+
+    assert report["events"] == 3
+    assert sorted(p.relative_to(dest).as_posix() for p in dest.glob("telemetry/*/*/*")) == [
+        "telemetry/date=2026-01-01/agent=claude/part-1.parquet",
+        "telemetry/date=2026-01-02/agent=codex/part-3.parquet",
+    ]
+    telemetry = _telemetry(dest)
+    assert telemetry["event_type"].tolist() == ["session_start", "pre_tool_use", "session_start"]
+    assert telemetry["tool_name"].tolist()[1] == "Bash"
+    assert telemetry["repo"].tolist()[::2] == ["cubicle", "other"]
+    assert str(telemetry["timestamp"].iloc[0]) == "2026-01-01 10:00:00"
+    assert "payload" not in telemetry
+    assert report["tables"] == {"sessions": 2, "event_rollup": 3, "event_types": len(db.EVENT_TYPES)}
+    assert pq.read_table(dest / "sessions.parquet").column("model").to_pylist() == ["opus", "gpt-5"]
+
+
+def test_export_is_incremental_and_includes_payloads(events, tmp_path):
+    dest = tmp_path / "export"
+    export.export(dest, fmt="arrow", payloads=True)
+
+    output = "compressed output\n" * 1000
+    db.insert_telemetry("s2", "post_tool_use", None, {"tool_response": {"stdout": output}}, "2026-01-02 09:10:00")
+    db.insert_telemetry("s3", "session_start", None, {}, storage={"shard_by_month": True})
+    report = export.export(dest, fmt="arrow", payloads=True)
+
+    assert report["events"] == 2
+    assert set(report["last_ids"]) == {"main", *db.shard_months()}
+    telemetry = _telemetry(dest, "arrow")
+    assert telemetry["session_id"].tolist() == ["s1", "s1", "s2", "s2", "s3"]
+    assert json.loads(telemetry["payload"].iloc[3]) == {"tool_response": {"stdout": output}}
+    assert export.export(dest, fmt="arrow", payloads=True)["events"] == 0
+
+    with pytest.raises(ValueError, match="arrow export with payloads"):
+        export.export(dest)
+    assert export.export(dest, full=True)["events"] == 5
+
+
+def test_an_interrupted_export_is_redone(events, tmp_path, monkeypatch):
+    dest = tmp_path / "export"
+    monkeypatch.setattr(export, "_export_table", lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        export.export(dest)
+    monkeypatch.undo()
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "data" / "telemetry.db")
+
+    assert export.export(dest)["events"] == 3
+    assert len(_telemetry(dest)) == 3
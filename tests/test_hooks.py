@@ -1,6 +1,8 @@
 import json
 import sqlite3
 import subprocess
+import sys
+import time
 from pathlib import Path
 
 import yaml
@@ -9,14 +11,20 @@ SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
 CLAUDE_HOOK_PATH = SRC_DIR / "claude_hook.py"
 CODEX_HOOK_PATH = SRC_DIR / "codex_hook.py"
 AGY_HOOK_PATH = SRC_DIR / "agy_hook.py"
+INGESTD_PATH = SRC_DIR / "ingestd.py"
 
+# The hook runtime modules import each other by flat name, as they do once installed
+sys.path.insert(0, str(SRC_DIR))
+import ingestd
 
-def write_config(home_dir):
+
+def write_config(home_dir, **overrides):
     config_dir = home_dir / ".cubicle"
     config_dir.mkdir(parents=True, exist_ok=True)
     source_config = SRC_DIR / "default_config.yaml"
     with open(source_config) as f:
         config = yaml.safe_load(f)
+    config.update(overrides)
     with open(config_dir / "config.yaml", "w") as f:
         yaml.safe_dump(config, f)
 
@@ -164,6 +172,121 @@ def test_claude_hook_model_resolution_from_db():
     print("  ✅ Claude model correctly resolved from session_start record")
 
 
+def start_ingestd(home_dir):
+    env = {**subprocess.os.environ, "HOME": str(home_dir)}
+    process = subprocess.Popen(
+        ["python3", str(INGESTD_PATH)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+    )
+    socket_path = home_dir / ".cubicle" / "data" / "ingestd.sock"
+    deadline = time.time() + 10
+    while not socket_path.exists():
+        assert process.poll() is None, process.stdout.read().decode()
+        assert time.time() < deadline, "ingestd did not start"
+        time.sleep(0.05)
+    return process
+
+
+def test_hooks_forward_to_ingestd(tmp_path, monkeypatch):
+    write_config(tmp_path)
+    monkeypatch.setattr(ingestd, "SOCKET_PATH", tmp_path / ".cubicle" / "data" / "ingestd.sock")
+    assert ingestd.forward("codex", None, b"{}") == (False, None)
+
+    daemon = start_ingestd(tmp_path)
+    try:
+        assert ingestd.is_running()
+        # The daemon read the mappings at startup; a hook falling back to a direct
+        # insert would read this config instead and store the fallback_* names.
+        with open(SRC_DIR / "default_config.yaml") as f:
+            agents = yaml.safe_load(f)["agents"]
+        agents["claude"]["event_mapping"] = {
+            "SessionStart": "fallback_session_start",
+            "PreToolUse": "fallback_pre_tool_use",
+        }
+        write_config(tmp_path, agents=agents)
+
+        run_hook(
+            CLAUDE_HOOK_PATH,
+            {"hook_event_name": "SessionStart", "session_id": "daemon_test", "model": "claude-opus-4-6"},
+            tmp_path,
+        )
+        stdout, stderr, code = run_hook(
+            CLAUDE_HOOK_PATH,
+            {"hook_event_name": "PreToolUse", "session_id": "daemon_test", "tool_name": "Bash"},
+            tmp_path,
+        )
+        assert code == 0, stderr
+        assert stdout.strip() == "{}"
+    finally:
+        daemon.terminate()
+        output = daemon.communicate(timeout=10)[0].decode()
+
+    assert "ingestd listening on" in output
+    assert "failed to ingest" not in output
+    assert not (tmp_path / ".cubicle" / "data" / "ingestd.sock").exists()
+    with sqlite3.connect(db_path_for_home(tmp_path)) as conn:
+        rows = conn.execute(
+            "SELECT event_type, model FROM telemetry WHERE session_id='daemon_test' ORDER BY id"
+        ).fetchall()
+    assert rows == [("session_start", "claude-opus-4-6"), ("pre_tool_use", "claude-opus-4-6")]
+
+
+def test_spool_mode_defers_inserts_until_flush(tmp_path):
+    write_config(tmp_path, ingest={"mode": "spool"})
+    run_hook(
+        CLAUDE_HOOK_PATH,
+        {"hook_event_name": "SessionStart", "session_id": "spool_test", "model": "claude-opus-4-6"},
+        tmp_path,
+    )
+    stdout, stderr, code = run_hook(
+        CLAUDE_HOOK_PATH,
+        {"hook_event_name": "PreToolUse", "session_id": "spool_test", "tool_name": "Bash"},
+        tmp_path,
+    )
+    assert code == 0, stderr
+    assert stdout.strip() == "{}"
+
+    spool_dir = tmp_path / ".cubicle" / "data" / "spool"
+    assert [p.suffix for p in spool_dir.glob("*.spool")] == [".spool"]
+    assert not db_path_for_home(tmp_path).exists()
+
+    flush = subprocess.run(
+        ["python3", str(SRC_DIR / "spool.py")],
+        check=False,
+        capture_output=True,
+        env={**subprocess.os.environ, "HOME": str(tmp_path)},
+    )
+    assert flush.returncode == 0, flush.stderr.decode()
+    assert flush.stdout.decode().strip() == "Loaded 2 spooled events"
+    assert not list(spool_dir.glob("*.spool*"))
+
+    with sqlite3.connect(db_path_for_home(tmp_path)) as conn:
+        rows = conn.execute(
+            "SELECT event_type, model FROM telemetry WHERE session_id='spool_test' ORDER BY id"
+        ).fetchall()
+    assert rows == [("session_start", "claude-opus-4-6"), ("pre_tool_use", "claude-opus-4-6")]
+
+
+def test_hook_timings_are_recorded_only_when_enabled(tmp_path):
+    write_config(tmp_path)
+    timings_log = tmp_path / ".cubicle" / "data" / "hook_timings.log"
+    payload = {"hook_event_name": "PreToolUse", "session_id": "timed", "tool_name": "Bash"}
+
+    run_hook(CLAUDE_HOOK_PATH, payload, tmp_path)
+    assert not timings_log.exists()
+
+    _, stderr, code = run_hook(CLAUDE_HOOK_PATH, payload, tmp_path, env={"CUBICLE_HOOK_TIMINGS": "1"})
+    assert code == 0, stderr
+    [record] = [json.loads(line) for line in timings_log.read_text().splitlines()]
+    assert (record["agent"], record["event"], record["path"]) == ("claude", "PreToolUse", "direct")
+    assert record["bytes"] == len(json.dumps(payload))
+    phases = {"imports", "read", "forward", "yaml", "config", "parse", "model", "connect", "write", "total"}
+    assert phases <= set(record["ms"])
+    assert record["ms"]["total"] >= sum(record["ms"][name] for name in phases - {"total"})
+
+
 def test_minimal():
     """Run all hook tests."""
     print("Starting per-agent hook verification...")
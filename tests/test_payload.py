@@ -0,0 +1,57 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import db
+from payload import RawPayload
+
+
+def test_fields_decode_like_json_loads():
+    payload = {
+        "session_id": "s1",
+        "model": None,
+        "tool_input": {"command": 'echo "}" \\ [', "nested": [1, {"a": [2.5e3, -1]}]},
+        "prompt": "café \\\" ☃",
+        "ok": True,
+    }
+    raw = json.dumps(payload, indent=1).encode()
+
+    parsed = RawPayload(raw)
+
+    assert dict(parsed) == payload
+    assert list(parsed) == list(payload)
+    assert parsed.get("cwd") is None
+    assert parsed.text() == raw.decode()
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [b"", b"[]", b'{"a": 1', b'{"a": "x}', b'{"a": 1} {}', b'{"a" 1}', b'{"a": nope}',
+     b'{"session_id": "s", "extra": [1,,2]}', b'{"a": {"b" 1}}', b'{"a": ["\xff"]}'],
+)
+def test_malformed_payloads_are_rejected(raw):
+    with pytest.raises(ValueError):
+        RawPayload(raw)
+
+
+@pytest.mark.parametrize("raw", [b"{}", b"{}\n", b" { } ", b'{"a": {}}\r\n'])
+def test_surrounding_whitespace_is_accepted(raw):
+    assert dict(RawPayload(raw)) == json.loads(raw)
+
+
+def test_raw_payload_is_stored_verbatim(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "telemetry.db")
+    big = "line\n" * (db.SEARCH_DECODE_BYTES // 4)
+    raw = json.dumps({"tool_name": "Read", "cwd": "/src/cubicle", "tool_response": {"content": big}}).encode()
+
+    db.insert_telemetry("s1", "post_tool_use", None, RawPayload(raw), storage={"dedup_min_bytes": None})
+
+    with db.connect() as conn:
+        row = conn.execute("SELECT payload_json(raw_payload, payload_codec), tool_name, repo FROM telemetry").fetchone()
+        hits = db.search(conn, "line")
+    assert row == (raw.decode(), "Read", "cubicle")
+    assert [hit[4] for hit in hits] == ["Read"]
@@ -0,0 +1,66 @@
+import io
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import db
+import spool
+
+
+def frame(body, **header):
+    header = {"agent": "claude", "event": None, "ts": "2026-01-01 00:00:00", "len": len(body), **header}
+    return json.dumps(header).encode() + b"\n" + body + b"\n"
+
+
+def test_append_writes_framed_records(monkeypatch, tmp_path):
+    monkeypatch.setattr(spool, "SPOOL_DIR", tmp_path)
+
+    spool.append("agy", "PreToolUse", b'{"conversationId": "c1"}')
+    spool.append("codex", None, b'{"multi":\n"line"}')
+
+    [path] = tmp_path.glob("*.spool")
+    with open(path, "rb") as f:
+        frames = list(spool.read_frames(f, []))
+    assert [(h["agent"], h["event"], body) for h, body in frames] == [
+        ("agy", "PreToolUse", b'{"conversationId": "c1"}'),
+        ("codex", None, b'{"multi":\n"line"}'),
+    ]
+
+
+def test_read_frames_skips_only_the_bad_bytes():
+    corrupt = b'{"agent": "claude", "len": 900}\n{"trunc'
+    torn = b'{"agent": "claude", "event": null, "ts": "t", "len": 50}\n{"partial'
+    f = io.BytesIO(frame(b"{}") + corrupt + b"\n" + frame(b"[1]") + torn)
+    rejected = []
+
+    assert [body for _, body in spool.read_frames(f, rejected)] == [b"{}", b"[1]"]
+    assert rejected == [corrupt + b"\n", torn]
+
+
+@pytest.fixture
+def spool_home(monkeypatch, tmp_path):
+    monkeypatch.setattr(spool, "SPOOL_DIR", tmp_path / "spool")
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "telemetry.db")
+    monkeypatch.setattr(spool, "load_config", dict)
+    monkeypatch.setattr(
+        spool, "load_event_mappings", lambda hooks, cfg=None: {agent: {} for agent in hooks}
+    )
+    (tmp_path / "spool").mkdir()
+    return tmp_path / "spool"
+
+
+def test_flush_does_not_reload_a_committed_file(spool_home):
+    claimed = spool_home / "2026-01-01.spool.1.flushing"
+    claimed.write_bytes(frame(b'{"hook_event_name": "PreToolUse", "session_id": "s1"}'))
+    conn = db.connect()
+    with conn:
+        conn.execute("INSERT INTO spool_loads (file) VALUES (?)", (claimed.name,))
+
+    assert spool.flush() == 0
+    assert not claimed.exists()
+    assert conn.execute("SELECT COUNT(*) FROM telemetry").fetchone() == (0,)
+    assert conn.execute("SELECT COUNT(*) FROM spool_loads").fetchone() == (0,)
@@ -0,0 +1,44 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import db
+import stress
+
+SOAK_ENV = "CUBICLE_SOAK"
+
+
+def test_every_concurrent_hook_event_is_accounted_for(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "telemetry.db")
+
+    report = stress.run(agents=3, rate=30, duration=0.4)
+
+    assert db.DB_PATH == tmp_path / "telemetry.db"
+    assert report["sent"] == 12
+    assert (report["delivered"], report["lost"], report["duplicates"]) == (12, 0, 0)
+    assert report["latency"]["p50_ms"] > 0
+    assert report["write_retries"]["dropped"] == 0
+    assert report["write_ms"]["calls"] == 12
+
+
+def test_events_stored_in_monthly_shards_are_delivered(monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "DB_PATH", tmp_path / "telemetry.db")
+
+    report = stress.run(agents=2, rate=20, duration=0.2, storage={"shard_by_month": True})
+
+    assert (report["delivered"], report["lost"]) == (report["sent"], 0)
+
+
+@pytest.mark.skipif(not os.environ.get(SOAK_ENV), reason=f"soak test; set {SOAK_ENV}=1 to run")
+@pytest.mark.parametrize("mode, daemon", [("direct", False), ("direct", True), ("spool", False)])
+def test_soak_loses_no_events(mode, daemon):
+    duration = float(os.environ.get("CUBICLE_SOAK_SECONDS", "60"))
+
+    report = stress.run(agents=6, rate=60, duration=duration, mode=mode, daemon=daemon)
+
+    assert report["lost"] == 0, report["lost_sample"]
+    assert report["duplicates"] == 0
@@ -0,0 +1,40 @@
+import json
+import sys
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "cubicle"
+sys.path.insert(0, str(SRC_DIR))
+import timings
+
+
+def record(ts, agent, event, **ms):
+    return {"ts": ts, "agent": agent, "event": event, "path": "direct", "ms": ms}
+
+
+def test_log_is_a_ring_of_two_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(timings, "LOG_PATH", tmp_path / "hook_timings.log")
+    monkeypatch.setattr(timings, "MAX_LOG_BYTES", 300)
+    monkeypatch.setattr(timings, "_phases", {"read": 0.001})
+    monkeypatch.setattr(timings, "_notes", {"agent": "claude", "event": "Stop", "body": b"{}"})
+
+    for _ in range(10):
+        timings._write()
+
+    assert (tmp_path / "hook_timings.log.1").exists()
+    records = list(timings.read_log())
+    assert 2 < len(records) < 10
+    assert records[0]["ms"]["read"] == 1.0 and "body" not in records[0]
+    assert list(timings.read_log(since=records[-1]["ts"] + 1)) == []
+
+
+def test_summary_has_percentiles_per_phase_agent_and_event():
+    records = [record(i, "claude", "PreToolUse", read=1.0, total=float(i)) for i in range(1, 101)]
+    records.append(record(101, "codex", "Stop", total=500.0, write=3.0))
+
+    summary = timings.summarize(records)
+
+    assert list(summary["phases"]) == ["read", "write", "total"]
+    assert summary["phases"]["total"] == {"calls": 101, "p50": 51.0, "p95": 96.0, "p99": 100.0, "max": 500.0}
+    assert summary["agent"]["codex"]["p50"] == 500.0
+    assert summary["event"]["PreToolUse"]["calls"] == 100
+    assert json.dumps(summary)